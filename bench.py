@@ -0,0 +1,576 @@
+"""Offline benchmarks for gh_poller and control_bot on top of fake_telegram.
+
+    python bench.py [--sizes 100,1000,10000] [--latency 0.002] [--accounts 50] [--real-limits]
+                    [--commands 1000] [--seed 1] [--baseline old.json] [--threshold 0.2]
+
+Reports run wall time, sends/s, state-save cost and scheduling lateness as
+the queue grows, and replays a seeded stream of control commands (/sendin,
+/cancel, /queue, settings flips) through both bots' dispatch: ops/s, handler
+p50/p99, save bytes and time per op, memory per queued item. Results are
+printed and written to bench_output.txt and bench_output.json; --baseline
+compares against an earlier bench_output.json and flags the metrics that got
+worse by more than --threshold.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+from zoneinfo import ZoneInfo
+
+CONTROL_CHAT_ID = 100
+TARGET_CHAT_ID = 200
+OUTPUT = Path(__file__).with_name("bench_output.txt")
+JSON_OUTPUT = OUTPUT.with_suffix(".json")
+
+
+def configure_env(tmp: Path, real_limits: bool) -> None:
+    # Both entry points read their settings at import time.
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "bench")
+    os.environ.setdefault("SESSION_STRING", "")
+    os.environ["CONTROL_CHAT_ID"] = str(CONTROL_CHAT_ID)
+    os.environ["DAILY_CHAT_ID"] = str(TARGET_CHAT_ID)
+    os.environ["STATE_FILE"] = str(tmp / "state.json")
+    os.environ.setdefault("STATE_FLUSH_SECONDS", "0.05")
+    if not real_limits:
+        os.environ["SEND_GLOBAL_RATE"] = "1000000"
+        os.environ["SEND_PER_CHAT_RATE"] = "1000000"
+        os.environ["SEND_PER_CHAT_BURST"] = "1000000"
+        os.environ["SEND_CONCURRENCY"] = "64"
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def timed_flush(store) -> List[Tuple[float, int]]:
+    """(seconds, bytes written) for every flush of a file-backed store."""
+    flushes: List[Tuple[float, int]] = []
+    flush = store.flush
+
+    def size(p: Path) -> int:
+        return p.stat().st_size if p.exists() else 0
+
+    def wrapper(state, pending=None):
+        before = store.path.stat().st_mtime_ns if store.path.exists() else 0
+        journal = size(store.journal_path)
+        t0 = time.perf_counter()
+        flush(state, pending)
+        seconds = time.perf_counter() - t0
+        if store.path.exists() and store.path.stat().st_mtime_ns != before:
+            # Compacted: the snapshot was rewritten whole.
+            written = size(store.path) + size(store.journal_path)
+        else:
+            written = size(store.journal_path) - journal
+        flushes.append((seconds, written))
+
+    store.flush = wrapper
+    return flushes
+
+
+@contextlib.contextmanager
+def timed_dispatch(module):
+    """Time every command handler run through module.dispatch."""
+    times: List[float] = []
+    dispatch = module.dispatch
+
+    async def wrapper(ctx, message):
+        t0 = time.perf_counter()
+        try:
+            return await dispatch(ctx, message)
+        finally:
+            times.append(time.perf_counter() - t0)
+
+    module.dispatch = wrapper
+    try:
+        yield times
+    finally:
+        module.dispatch = dispatch
+
+
+def command_stream(count: int, seed: int, first_id: int) -> List[str]:
+    """A seeded mix of control commands; the same seed gives the same stream.
+
+    Half are /sendin with delays up to a day, the rest /cancel of random ids
+    (some already gone or never issued), /queue pages and filters, settings
+    flips and /state. Sending is left on at the end.
+    """
+    rng = random.Random(seed)
+    next_id = first_id
+    sending = True
+    texts = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.5:
+            texts.append(f"/sendin {rng.randint(1, 1440)} load {i}")
+            next_id += 1
+        elif roll < 0.7:
+            texts.append(f"/cancel {rng.randrange(1, next_id + 10)}")
+        elif roll < 0.85:
+            texts.append(
+                rng.choice(
+                    (
+                        "/queue",
+                        f"/queue {rng.randint(2, 5)}",
+                        f"/queue before:{rng.randint(0, 23):02d}:00",
+                        f"/queue chat:{TARGET_CHAT_ID}",
+                    )
+                )
+            )
+        elif roll < 0.95:
+            if rng.random() < 0.5:
+                sending = not sending
+                texts.append(f"/sending {'on' if sending else 'off'}")
+            else:
+                texts.append(f"/dailytime {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}")
+        else:
+            texts.append("/state")
+    if not sending:
+        texts.append("/sending on")
+    return texts
+
+
+def command_stats(texts: Sequence[str], handled: List[float], flushes, busy: float) -> Dict[str, float]:
+    ops = len(texts)
+    return {
+        "ops_per_s": ops / busy if busy else 0.0,
+        "handler_p50_ms": percentile(handled, 0.5) * 1000,
+        "handler_p99_ms": percentile(handled, 0.99) * 1000,
+        "save_bytes_per_op": sum(b for _, b in flushes) / ops,
+        "save_ms_per_op": sum((t for t, _ in flushes), 0.0) * 1000 / ops,
+    }
+
+
+def state_bytes(path: Path) -> int:
+    total = 0
+    for p in (path, path.with_name(path.name + ".journal")):
+        if p.exists():
+            total += p.stat().st_size
+    return total
+
+
+def make_rows(n: int, due: int, due_at: datetime, far: datetime) -> List[dict]:
+    return [
+        {
+            "id": i,
+            "chat_id": TARGET_CHAT_ID,
+            "text": f"bench message {i}",
+            "send_at": (due_at if i <= due else far).isoformat(),
+        }
+        for i in range(1, n + 1)
+    ]
+
+
+def write_snapshot(path: Path, state: dict) -> None:
+    for p in (path, path.with_name(path.name + ".journal")):
+        if p.exists():
+            p.unlink()
+    path.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+# --- gh_poller -------------------------------------------------------------
+
+
+async def poller_case(
+    tmp: Path,
+    queue: int,
+    due: int,
+    texts: Sequence[str],
+    latency: float,
+    flood_every: int = 0,
+) -> Dict[str, float]:
+    import gh_poller
+    from fake_telegram import FakeClient
+
+    path = tmp / f"poller_{queue}_{due}_{len(texts)}.json"
+    now = datetime.now(ZoneInfo(gh_poller.TIMEZONE))
+    state = gh_poller.default_state()
+    state["rules"] = []
+    state["scheduled"] = make_rows(queue, due, now, now + timedelta(days=30))
+    state["next_id"] = queue + 1
+    # Past the chat's first message, as after an earlier run: a fresh state
+    # would skip the commands as history.
+    state["last_command_id"] = 1
+    write_snapshot(path, state)
+
+    account = gh_poller.Account("bench", "", CONTROL_CHAT_ID, state_path=path)
+    flushes = timed_flush(account.store)
+    client = FakeClient(latency=latency, flood_every=flood_every)
+    client.preload(CONTROL_CHAT_ID, ["bench", *texts])
+
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), timed_dispatch(gh_poller) as handled:
+        await gh_poller.run(client, account=account)
+    wall = time.perf_counter() - t0
+
+    sends = [(ts, m) for ts, m in client.sent if m.chat_id == TARGET_CHAT_ID]
+    lateness = [ts - now.timestamp() for ts, _ in sends]
+    return {
+        "wall_s": wall,
+        "delivered": len(sends),
+        "sends_per_s": len(sends) / wall if wall else 0.0,
+        "requests": client.requests,
+        "flood_waits": client.flood_waits,
+        "save_ms": sum((t for t, _ in flushes), 0.0) * 1000,
+        "state_bytes": state_bytes(path),
+        "late_p50_ms": percentile(lateness, 0.5) * 1000,
+        "late_p99_ms": percentile(lateness, 0.99) * 1000,
+        # A single poll handles every command, so ops/s is over the run.
+        **(command_stats(texts, handled, flushes, wall) if texts else {}),
+    }
+
+
+async def fanout_case(tmp: Path, chats: int, latency: float) -> Dict[str, float]:
+    import gh_poller
+    from fake_telegram import FakeClient
+
+    path = tmp / f"fanout_{chats}.json"
+    state = gh_poller.default_state()
+    state["rules"] = []
+    state["groups"] = {"bench": [TARGET_CHAT_ID + i for i in range(chats)]}
+    state["last_command_id"] = 1
+    write_snapshot(path, state)
+
+    account = gh_poller.Account("bench", "", CONTROL_CHAT_ID, state_path=path)
+    result: Dict[str, float] = {}
+    # Two runs, each with a fresh client like the cron job: the first resolves
+    # every peer, the second finds them in the peer cache.
+    for run in ("cold", "warm"):
+        client = FakeClient(latency=latency)
+        client._next_id = 1000 if run == "cold" else 2000
+        client.preload(CONTROL_CHAT_ID, [f"/sendnow @bench bench broadcast {run}"])
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await gh_poller.run(client, account=account)
+        wall = time.perf_counter() - t0
+        sends = [m for _, m in client.sent if m.chat_id != CONTROL_CHAT_ID]
+        result[f"{run}_wall_s"] = wall
+        result[f"{run}_requests"] = client.requests
+        result[f"{run}_sends_per_s"] = len(sends) / wall if wall else 0.0
+    result["serial_s"] = chats * latency
+    return result
+
+
+async def accounts_case(tmp: Path, accounts: int, queue: int, latency: float) -> Dict[str, float]:
+    """One run_all over several accounts, each with its own state and client."""
+    import gh_poller
+    from fake_telegram import FakeClient
+
+    now = datetime.now(ZoneInfo(gh_poller.TIMEZONE))
+    members = []
+    for i in range(accounts):
+        path = tmp / f"accounts_{accounts}" / f"state_{i}.json"
+        path.parent.mkdir(exist_ok=True)
+        state = gh_poller.default_state()
+        state["rules"] = []
+        state["scheduled"] = make_rows(queue, queue // 10, now, now + timedelta(days=30))
+        state["next_id"] = queue + 1
+        write_snapshot(path, state)
+        members.append(gh_poller.Account(f"a{i}", "", CONTROL_CHAT_ID, state_path=path))
+    clients = [FakeClient(latency=latency) for _ in members]
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await gh_poller.run_all(members, clients)
+    wall = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start = sorted(gh_poller.metrics.timings["account_start"].recent)
+    delivered = sum(1 for c in clients for _, m in c.sent if m.chat_id == TARGET_CHAT_ID)
+    return {
+        "wall_s": wall,
+        "delivered": delivered,
+        "start_p50_ms": percentile(start, 0.5) * 1000,
+        "start_max_ms": start[-1] * 1000,
+        "peak_kb": peak / 1024,
+        "failed": gh_poller.metrics.gauges["accounts_failed"],
+    }
+
+
+def render_case(tmp: Path, renders: int) -> Dict[str, float]:
+    """$template renders through the compiled cache vs parsing every time."""
+    import templates
+    from metrics import metrics
+    from state_store import StateStore
+
+    source = "Привіт, {weekday} {date:%d.%m} #{counter} {random:так|ні|може}"
+    state = {"templates": {"bench": {"text": source, "counter": 0}}}
+    store = StateStore(tmp / "render.json", {})
+    at = datetime.now(ZoneInfo("Europe/Kyiv"))
+    metrics.reset()
+    t0 = time.perf_counter()
+    for _ in range(renders):
+        templates.render(state, store, "$bench", at)
+    cached = time.perf_counter() - t0
+    compiles = metrics.counters.get("template_compiles", 0)
+    t0 = time.perf_counter()
+    for _ in range(renders):
+        templates.forget(source)
+        templates.render(state, store, "$bench", at)
+    parsed = time.perf_counter() - t0
+    return {
+        "renders_per_s": renders / cached,
+        "reparse_per_s": renders / parsed,
+        "cached_compiles": compiles,
+    }
+
+
+# --- control_bot -----------------------------------------------------------
+
+
+async def bot_case(
+    tmp: Path, queue: int, due: int, texts: Sequence[str], latency: float
+) -> Dict[str, float]:
+    import control_bot
+    from fake_telegram import FakeClient, NewMessage
+    from outbox import Outbox
+    from state_store import DebouncedWriter, StateStore
+
+    path = tmp / f"bot_{queue}_{due}_{len(texts)}.json"
+    defaults = {
+        "sending_enabled": True,
+        "daily_chat_id": TARGET_CHAT_ID,
+        "groups": {},
+        "scheduled": [],
+        "rules": [],
+        "next_id": 1,
+        "next_rule_id": 1,
+    }
+    # Spread the due rows over the next second so the timer does real work;
+    # the rest wait a month.
+    start = time.time() + 0.5
+    tz = ZoneInfo(control_bot.TIMEZONE)
+    rows = make_rows(queue, due, datetime.now(tz), datetime.now(tz) + timedelta(days=30))
+    for i, row in enumerate(rows[:due]):
+        row["send_at"] = datetime.fromtimestamp(start + i / max(due, 1), tz).isoformat()
+    write_snapshot(path, dict(defaults, scheduled=rows, next_id=queue + 1))
+
+    control_bot.state.clear()
+    control_bot.state.update(defaults)
+    control_bot.store = StateStore(path, dict(defaults))
+    control_bot.writer = DebouncedWriter(control_bot.store, control_bot.state)
+    control_bot.outbox = control_bot.writer.outbox = Outbox(path)
+    control_bot.scheduled_heap.clear()
+    control_bot.scheduler_wakeup = asyncio.Event()
+    control_bot.rules_wakeup = asyncio.Event()
+    control_bot.serial_commands = asyncio.Queue(control_bot.COMMAND_QUEUE_SIZE)
+    control_bot.concurrent_commands = asyncio.Queue(control_bot.COMMAND_QUEUE_SIZE)
+    control_bot.serial_progress = asyncio.Condition()
+    control_bot.serial_seq = control_bot.serial_done = 0
+    control_bot.metrics.reset()
+    flushes = timed_flush(control_bot.store)
+
+    client = FakeClient(latency=latency)
+    control_bot.client = None
+    control_bot.attach(client, NewMessage(outgoing=True))
+
+    with contextlib.redirect_stdout(io.StringIO()), timed_dispatch(control_bot) as handled:
+        main = asyncio.create_task(control_bot.main())
+        deadline = time.time() + 30 + due / 100
+        while time.time() < deadline:
+            if sum(1 for _, m in client.sent if m.chat_id == TARGET_CHAT_ID) >= due:
+                break
+            await asyncio.sleep(0.01)
+        sends = [(ts, m) for ts, m in client.sent if m.chat_id == TARGET_CHAT_ID]
+        send_at = {row["text"]: datetime.fromisoformat(row["send_at"]).timestamp() for row in rows}
+        lateness = [ts - send_at[m.message] for ts, m in sends if m.message in send_at]
+
+        # Commands are queued by the handler and run by workers; type as fast
+        # as the queue accepts them and time each from queueing to done. The
+        # saves they cause are counted from here, the last one included.
+        await control_bot.writer.flush()
+        saved = len(flushes)
+        t0 = time.perf_counter()
+        for text in texts:
+            while control_bot.serial_commands.full():
+                await asyncio.sleep(0.001)
+            await client.type_message(CONTROL_CHAT_ID, text)
+        await control_bot.serial_commands.join()
+        await control_bot.concurrent_commands.join()
+        busy = time.perf_counter() - t0
+        await control_bot.writer.flush()
+        handle = control_bot.metrics.timings.get("command")
+        await client.disconnect()
+        await main
+
+    return {
+        "delivered": len(sends),
+        "late_p50_ms": percentile(lateness, 0.5) * 1000,
+        "late_p99_ms": percentile(lateness, 0.99) * 1000,
+        "cmd_p50_ms": percentile(list(handle.recent), 0.5) * 1000 if handle else 0.0,
+        "cmd_p99_ms": percentile(list(handle.recent), 0.99) * 1000 if handle else 0.0,
+        "writes": len(flushes),
+        "save_ms": sum((t for t, _ in flushes), 0.0) * 1000,
+        "state_bytes": state_bytes(path),
+        **(command_stats(texts, handled, flushes[saved:], busy) if texts else {}),
+    }
+
+
+def memory_case(tmp: Path, queue: int) -> Dict[str, float]:
+    """Heap taken by a loaded queue, per row, over that of an empty one."""
+    from scheduled_queue import attach_queue
+    from state_store import StateStore
+
+    now = datetime.now(ZoneInfo("Europe/Kyiv"))
+
+    def loaded(n: int) -> int:
+        path = tmp / f"memory_{n}.json"
+        write_snapshot(path, {"scheduled": make_rows(n, 0, now, now + timedelta(days=30)), "next_id": n + 1})
+        tracemalloc.start()
+        store = StateStore(path, {"scheduled": [], "next_id": 1})
+        state = store.load()
+        attach_queue(state, store)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del state, store
+        return size
+
+    empty = loaded(0)
+    full = loaded(queue)
+    return {"bytes_per_item": (full - empty) / max(queue, 1), "queue_kb": (full - empty) / 1024}
+
+
+# --- report ----------------------------------------------------------------
+
+
+def fmt_row(name: str, size: int, result: Dict[str, float]) -> str:
+    cells = " ".join(
+        f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items()
+    )
+    return f"{name:<18} n={size:<6} {cells}"
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return out.stdout.strip()
+
+
+def higher_is_better(metric: str) -> bool:
+    return metric.endswith("_per_s") or metric == "delivered"
+
+
+def compare(rows: Dict[str, Dict[str, float]], args, baseline: Path, threshold: float) -> List[str]:
+    """Lines for the metrics that moved more than threshold since baseline."""
+    old = json.loads(baseline.read_text(encoding="utf-8"))
+    lines = [f"# vs {baseline} (commit {old.get('commit')}), threshold {threshold:.0%}"]
+    for name in ("latency", "commands", "seed", "real_limits"):
+        if old["args"].get(name) != getattr(args, name):
+            lines.append(f"# {name} differs: {old['args'].get(name)} then, {getattr(args, name)} now")
+    worse = 0
+    for row, result in rows.items():
+        for metric, value in result.items():
+            before = old["rows"].get(row, {}).get(metric)
+            if not before or not isinstance(value, (int, float)):
+                continue
+            # Sub-millisecond timings and the like are mostly noise.
+            if abs(before) < 1 and abs(value) < 1:
+                continue
+            change = (value - before) / abs(before)
+            if abs(change) <= threshold:
+                continue
+            regressed = (change < 0) == higher_is_better(metric)
+            worse += regressed
+            mark = "WORSE" if regressed else "better"
+            lines.append(f"{mark:<6} {row:<28} {metric}: {before:.2f} -> {value:.2f} ({change:+.0%})")
+    lines.append(f"# {worse} metrics worse by more than {threshold:.0%}")
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--latency", type=float, default=0.002, help="fake request latency, s")
+    parser.add_argument("--commands", type=int, default=1000, help="commands per dispatch run")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the command stream")
+    parser.add_argument("--accounts", type=int, default=50, help="accounts in the multi-account run")
+    parser.add_argument("--real-limits", action="store_true", help="keep Telegram rate limits")
+    parser.add_argument("--baseline", type=Path, help="bench_output.json of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported by --baseline")
+    args = parser.parse_args()
+    sizes = [int(x) for x in args.sizes.split(",") if x]
+
+    tmp = Path(tempfile.mkdtemp(prefix="vognyk-bench-"))
+    configure_env(tmp, args.real_limits)
+    sys.path.insert(0, str(Path(__file__).parent))
+
+    commit = git_commit()
+    lines = [
+        f"# bench {datetime.now().isoformat(timespec='seconds')} commit={commit} "
+        f"latency={args.latency}s real_limits={args.real_limits} commands={args.commands} seed={args.seed}"
+    ]
+    rows: Dict[str, Dict[str, float]] = {}
+
+    def emit(name: str, size: int, result: Dict[str, float]) -> None:
+        line = fmt_row(name, size, result)
+        print(line, flush=True)
+        lines.append(line)
+        rows[f"{name} n={size}"] = result
+
+    for n in sizes:
+        emit("poller idle", n, asyncio.run(poller_case(tmp, n, 0, (), args.latency)))
+        emit("poller due 10%", n, asyncio.run(poller_case(tmp, n, n // 10, (), args.latency)))
+        emit("bot schedule", n, asyncio.run(bot_case(tmp, n, n, (), args.latency)))
+        emit("queue memory", n, memory_case(tmp, n))
+        # The same command stream against a queue of n rows; no fake latency,
+        # so the numbers are the handlers' own cost.
+        stream = command_stream(args.commands, args.seed, n + 1)
+        emit("poller dispatch", n, asyncio.run(poller_case(tmp, n, 0, stream, 0.0)))
+        emit("bot dispatch", n, asyncio.run(bot_case(tmp, n, 0, stream, 0.0)))
+    emit("poller floodwait", 200, asyncio.run(poller_case(tmp, 200, 200, (), args.latency, flood_every=50)))
+    emit("poller fanout", 200, asyncio.run(fanout_case(tmp, 200, args.latency)))
+    # Cost of each account beyond the first, from a run of one and of many.
+    one = asyncio.run(accounts_case(tmp, 1, 100, args.latency))
+    many = asyncio.run(accounts_case(tmp, args.accounts, 100, args.latency))
+    emit("poller accounts", 1, one)
+    emit("poller accounts", args.accounts, many)
+    extra = max(args.accounts - 1, 1)
+    emit(
+        "per extra account",
+        args.accounts,
+        {
+            "wall_ms": (many["wall_s"] - one["wall_s"]) * 1000 / extra,
+            "kb": (many["peak_kb"] - one["peak_kb"]) / extra,
+        },
+    )
+    emit("render templates", 100000, render_case(tmp, 100000))
+
+    if args.baseline:
+        for line in compare(rows, args, args.baseline, args.threshold):
+            print(line, flush=True)
+            lines.append(line)
+    OUTPUT.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    JSON_OUTPUT.write_text(
+        json.dumps({"commit": commit, "args": vars(args), "rows": rows}, default=str, indent=1),
+        encoding="utf-8",
+    )
+    print(f"Written {OUTPUT} and {JSON_OUTPUT}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Bulk import of scheduled messages from a JSONL or CSV file.
+
+Each row has send_at (ISO time) or delay (minutes from now), chat_id (a chat
+id or @group; empty means daily_chat_id) and text (or "$name" of a template).
+The file is streamed and validated row by row; accepted rows get consecutive
+ids from next_id and are recorded together, so the import costs a single
+state write.
+
+    python bulk_import.py messages.csv
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, List, Tuple
+from zoneinfo import ZoneInfo
+
+from metrics import metrics
+from scheduled_queue import attach_queue
+from targets import group_name, target_fields
+from templates import reference
+
+JSONL_SUFFIXES = (".jsonl", ".ndjson", ".json")
+MAX_TEXT = 4096
+# Ten years, in minutes: the furthest delay or send_at (either way) accepted.
+MAX_DELAY = 10 * 366 * 24 * 60
+# Rejections listed in the summary; the rest are only counted.
+MAX_REPORTED = 20
+
+
+def read_rows(path: Path) -> Iterator[Tuple[int, object]]:
+    """(line number, row) pairs; a line that does not parse yields its error."""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        first = f.read(1)
+        f.seek(0)
+        if path.suffix.lower() in JSONL_SUFFIXES or (path.suffix.lower() != ".csv" and first == "{"):
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_no, json.loads(line)
+                except ValueError:
+                    yield line_no, ValueError("bad JSON")
+        else:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+
+
+def parse_row(state: dict, raw, now: datetime) -> dict:
+    """Item fields (without id) for one row; ValueError says what is wrong."""
+    if not isinstance(raw, dict):
+        raise ValueError("not an object")
+    text = str(raw.get("text") or "").strip()
+    if not text:
+        raise ValueError("empty text")
+    if len(text) > MAX_TEXT:
+        raise ValueError(f"text longer than {MAX_TEXT}")
+    name = reference(text)
+    if name is not None and name not in (state.get("templates") or {}):
+        raise ValueError(f"no template ${name}")
+
+    value = str(raw.get("chat_id") or "").strip()
+    if value:
+        try:
+            target = target_fields(state, value)
+        except KeyError:
+            raise ValueError(f"no group @{group_name(value)}") from None
+        except ValueError:
+            raise ValueError(f"bad chat_id {value!r}") from None
+    elif state.get("daily_chat_id"):
+        target = {"chat_id": int(state["daily_chat_id"])}
+    else:
+        raise ValueError("no chat_id")
+
+    if raw.get("send_at"):
+        try:
+            send_at = datetime.fromisoformat(str(raw["send_at"]).strip())
+        except ValueError:
+            raise ValueError(f"bad send_at {raw['send_at']!r}") from None
+        if send_at.tzinfo is None:
+            send_at = send_at.replace(tzinfo=now.tzinfo)
+        # Times near year 1 or 9999 would overflow later, when the row is sent.
+        if abs((send_at - now).total_seconds()) > MAX_DELAY * 60:
+            raise ValueError(f"send_at out of range {raw['send_at']!r}")
+    elif raw.get("delay") not in (None, ""):
+        try:
+            delay = float(raw["delay"])
+        except ValueError:
+            delay = -1
+        # Written so that nan fails too.
+        if not 0 <= delay <= MAX_DELAY:
+            raise ValueError(f"bad delay {raw['delay']!r}")
+        send_at = now + timedelta(minutes=delay)
+    else:
+        raise ValueError("no send_at or delay")
+    return {**target, "text": text, "send_at": send_at.isoformat()}
+
+
+def import_rows(state: dict, store, rows, now: datetime) -> Tuple[List[dict], List[Tuple[int, str]]]:
+    """Validate rows and schedule the accepted ones; returns (items, rejected).
+
+    Nothing is applied until the whole input has been read, so a file that
+    fails half way leaves the queue untouched.
+    """
+    next_id = int(state["next_id"])
+    items = []
+    rejected = []
+    for line_no, raw in rows:
+        try:
+            if isinstance(raw, Exception):
+                raise raw
+            items.append({"id": next_id + len(items), **parse_row(state, raw, now)})
+        except (ValueError, TypeError, OverflowError) as e:
+            rejected.append((line_no, str(e)))
+    queue = state["scheduled"]
+    for item in items:
+        queue.append(item)
+        store.record("schedule", item=item)
+    if items:
+        store.set(state, "next_id", next_id + len(items))
+    metrics.inc("imported", len(items))
+    metrics.inc("import_rejected", len(rejected))
+    return items, rejected
+
+
+def import_file(state: dict, store, path: Path, now: datetime) -> Tuple[List[dict], List[Tuple[int, str]]]:
+    return import_rows(state, store, read_rows(Path(path)), now)
+
+
+def format_summary(items: List[dict], rejected: List[Tuple[int, str]]) -> str:
+    if items:
+        lines = [f"✅ Імпортовано {len(items)}: #{items[0]['id']}–#{items[-1]['id']}"]
+    else:
+        lines = ["Нічого не імпортовано."]
+    if rejected:
+        lines.append(f"⚠️ Відхилено {len(rejected)}:")
+        lines += [f"рядок {line_no}: {reason}" for line_no, reason in rejected[:MAX_REPORTED]]
+        if len(rejected) > MAX_REPORTED:
+            lines.append(f"... і ще {len(rejected) - MAX_REPORTED}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from lease import Lease, LeaseHeld
+    from state_store import open_store
+
+    parser = argparse.ArgumentParser(description="Schedule messages from a JSONL or CSV file.")
+    parser.add_argument("file", type=Path)
+    parser.add_argument("--state", default=os.environ.get("STATE_FILE", "control_state.json"))
+    parser.add_argument("--timezone", default=os.environ.get("TIMEZONE", "Europe/Kyiv"))
+    args = parser.parse_args()
+
+    store = open_store(args.state, {"groups": {}, "scheduled": [], "next_id": 1})
+    try:
+        store.lease = Lease(args.state).acquire()
+    except LeaseHeld as e:
+        sys.exit(f"Not importing: {e}")
+    saved = None
+    try:
+        state = store.load()
+        store.lease.verify(state)
+        attach_queue(state, store)
+        items, rejected = import_file(state, store, args.file, datetime.now(ZoneInfo(args.timezone)))
+        store.flush(state)
+        saved = state
+    finally:
+        store.lease.release(saved)
+    print(format_summary(items, rejected), flush=True)
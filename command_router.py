@@ -0,0 +1,664 @@
+import csv
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+from zoneinfo import ZoneInfo
+
+from bulk_import import format_summary, import_file
+from metrics import metrics
+from recurring import CATCHUP_POLICIES, cron, format_rules, new_rule, parse_spec
+from send_pipeline import SendJob, SendResult
+from state_store import StateStore
+from targets import check_group_name, group_name, recipients, target_fields, target_label, without
+from templates import compile_template, forget, reference, render
+
+
+QUEUE_PAGE_SIZE = int(os.environ.get("QUEUE_PAGE_SIZE", "20"))
+# Longer texts are cut in /queue listings.
+QUEUE_TEXT_LEN = 80
+
+
+class ArgError(ValueError):
+    """Bad command arguments; the message (if any) replaces the usage reply."""
+
+
+class CommandContext:
+    """What a command handler may touch; each entry point supplies its own.
+
+    Hooks default to no-ops so gh_poller and control_bot only override the
+    side effects they actually have (heap timers, server-side handoffs...).
+    """
+
+    def __init__(self, state: dict, store: StateStore, timezone: str):
+        self.state = state
+        self.store = store
+        self.tz = ZoneInfo(timezone)
+        # The Telethon message being handled, where the entry point has one.
+        self.message = None
+
+    def now(self) -> datetime:
+        return datetime.now(self.tz)
+
+    async def download_document(self) -> Optional[Path]:
+        """Save the file attached to the current message to a temp file."""
+        file = getattr(self.message, "file", None)
+        if file is None:
+            return None
+        fd, name = tempfile.mkstemp(suffix=Path(file.name or "").suffix or file.ext or "")
+        os.close(fd)
+        return Path(await self.message.download_media(file=name))
+
+    async def reply(self, text: str) -> None:
+        raise NotImplementedError
+
+    async def send(self, chat_id: int, text: str, **kwargs):
+        raise NotImplementedError
+
+    async def send_many(self, jobs: List[SendJob]) -> List[SendResult]:
+        raise NotImplementedError
+
+    async def on_scheduled(self, item: dict) -> None:
+        pass
+
+    async def on_cancelled(self, item: dict) -> Dict[int, int]:
+        """Called with a row just removed; returns {chat: message id} of its
+        handed-off messages that could not be pulled back."""
+        return {}
+
+    async def on_sending_changed(self) -> None:
+        pass
+
+    async def revoke_rule(self, rule: dict) -> list:
+        """Pull back the rule's handed-off runs; returns the ones that failed."""
+        return []
+
+    async def on_rules_changed(self) -> None:
+        pass
+
+
+Handler = Callable[..., Awaitable[None]]
+
+
+@dataclass
+class Command:
+    name: str
+    usage: str
+    args: Sequence[Callable[[str], object]]
+    handler: Handler
+    # Long-running and touches no settings: may run alongside other commands.
+    concurrent: bool = False
+
+    def parse(self, rest: str) -> List[object]:
+        if not self.args:
+            return []
+        if self.args[-1] in (text, words):
+            parts = rest.split(maxsplit=len(self.args) - 1)
+            if self.args[-1] is words and len(parts) == len(self.args) - 1:
+                parts.append("")
+        else:
+            parts = rest.split()
+        if len(parts) != len(self.args):
+            raise ArgError()
+        return [conv(part) for conv, part in zip(self.args, parts)]
+
+
+COMMANDS: Dict[str, Command] = {}
+
+
+def command(name: str, usage: str = "", *args: Callable[[str], object], concurrent: bool = False):
+    def register(handler: Handler) -> Handler:
+        COMMANDS[name] = Command(name, f"{name} {usage}".strip(), args, handler, concurrent)
+        return handler
+
+    return register
+
+
+# --- argument converters -------------------------------------------------
+
+
+def text(value: str) -> str:
+    return value
+
+
+def words(value: str) -> List[str]:
+    """Trailing options, possibly none."""
+    return value.split()
+
+
+def integer(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise ArgError() from None
+
+
+def minutes(value: str) -> int:
+    try:
+        mins = int(value)
+        # A day of slack covers any timezone the bot may add it to.
+        datetime.now() + timedelta(minutes=mins, days=1)
+    except (ValueError, OverflowError):
+        mins = -1
+    if mins < 0:
+        raise ArgError("minutes має бути числом >= 0")
+    return mins
+
+
+def choice(*options: str) -> Callable[[str], str]:
+    def convert(value: str) -> str:
+        value = value.lower()
+        if value not in options:
+            raise ArgError()
+        return value
+
+    return convert
+
+
+def hhmm(value: str):
+    try:
+        hh, mm = value.split(":")
+        h = int(hh)
+        m = int(mm)
+    except ValueError:
+        raise ArgError() from None
+    if not (0 <= h <= 23 and 0 <= m <= 59):
+        raise ArgError()
+    return h, m
+
+
+on_off_status = choice("on", "off", "status")
+
+
+# --- dispatch ------------------------------------------------------------
+
+
+def is_concurrent(message: str) -> bool:
+    cmd = COMMANDS.get(message.split(maxsplit=1)[0])
+    return cmd is not None and cmd.concurrent
+
+
+async def dispatch(ctx: CommandContext, message: str) -> bool:
+    head, *rest = message.split(maxsplit=1)
+    cmd = COMMANDS.get(head)
+    if cmd is None:
+        return False
+    metrics.inc("commands")
+    try:
+        await cmd.handler(ctx, *cmd.parse(rest[0] if rest else ""))
+    except ArgError as e:
+        metrics.inc("command_errors")
+        await ctx.reply(str(e) or f"Формат: {cmd.usage}")
+    except Exception as e:
+        # One broken command must not take the poll (or the bot) down with it.
+        metrics.inc("command_errors")
+        print(f"Command failed: {message}: {e!r}", flush=True)
+        await ctx.reply(f"⚠️ {head} не виконано: {e}")
+    return True
+
+
+def on_off(value: bool) -> str:
+    return "ON" if value else "OFF"
+
+
+def short(value: str, limit: int = QUEUE_TEXT_LEN) -> str:
+    value = " ".join(value.split())
+    return value if len(value) <= limit else value[: limit - 1] + "…"
+
+
+def format_queue(ctx: CommandContext, rows: List[dict], total: int, page: int, filtered: bool) -> str:
+    queue = ctx.state["scheduled"]
+    if not total:
+        return "Нічого не знайдено." if filtered else "Черга порожня."
+    pages = (total + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE
+    head = f"Черга: {len(queue)}" + (f", за фільтром {total}" if filtered else "")
+    head += f" | сторінка {page}/{pages}"
+    if not rows:
+        return head + "\nТакої сторінки немає."
+    lines = [head]
+    for row in rows:
+        send_at = datetime.fromtimestamp(queue.ts(row["id"]), ctx.tz).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"#{row['id']} | {send_at} | {target_label(row)} | {short(row['text'])}")
+    return "\n".join(lines)
+
+
+# --- commands ------------------------------------------------------------
+
+
+@command("/help")
+async def cmd_help(ctx: CommandContext) -> None:
+    await ctx.reply("Команди:\n" + "\n".join(cmd.usage for cmd in COMMANDS.values()))
+
+
+@command("/sending", "on|off|status", on_off_status)
+async def cmd_sending(ctx: CommandContext, arg: str) -> None:
+    if arg == "status":
+        await ctx.reply(f"Sending: {on_off(ctx.state['sending_enabled'])}")
+        return
+    ctx.store.set(ctx.state, "sending_enabled", arg == "on")
+    await ctx.on_sending_changed()
+    await ctx.reply("✅ Відправка увімкнена." if arg == "on" else "🛑 Відправка вимкнена.")
+
+
+@command("/daily", "on|off|status", on_off_status)
+async def cmd_daily(ctx: CommandContext, arg: str) -> None:
+    rule = daily_rule(ctx)
+    if arg == "status":
+        if rule is None:
+            await ctx.reply("Daily: OFF")
+            return
+        await ctx.reply(
+            f"Daily: {on_off(rule['enabled'])} | {rule['spec']} | chat {rule['chat_id']}"
+        )
+        return
+    if rule is None:
+        if arg == "on":
+            await add_rule(ctx, parse_spec("04:00"), "вогник", name="daily")
+    else:
+        await edit_rule(ctx, rule, enabled=arg == "on")
+    await ctx.reply(
+        "✅ Щоденна відправка увімкнена." if arg == "on" else "🛑 Щоденна відправка вимкнена."
+    )
+
+
+@command("/dailytime", "HH:MM", hhmm)
+async def cmd_dailytime(ctx: CommandContext, value) -> None:
+    h, m = value
+    spec = parse_spec(f"{h}:{m:02d}")
+    rule = daily_rule(ctx)
+    if rule is None:
+        await add_rule(ctx, spec, "вогник", name="daily")
+    else:
+        await edit_rule(ctx, rule, spec=spec)
+    await ctx.reply(f"✅ Новий час: {h:02d}:{m:02d}")
+
+
+@command("/dailytext", "<text | $template>", text)
+async def cmd_dailytext(ctx: CommandContext, msg: str) -> None:
+    check_template(ctx, msg)
+    rule = daily_rule(ctx)
+    if rule is None:
+        await add_rule(ctx, parse_spec("04:00"), msg, name="daily")
+    else:
+        await edit_rule(ctx, rule, text=msg)
+    await ctx.reply(f"✅ Щоденний текст: {msg}")
+
+
+@command("/dailychat", "<chat_id>", integer)
+async def cmd_dailychat(ctx: CommandContext, cid: int) -> None:
+    ctx.store.set(ctx.state, "daily_chat_id", cid)
+    rule = daily_rule(ctx)
+    if rule is not None:
+        await edit_rule(ctx, rule, chat_id=cid)
+    await ctx.reply(f"✅ Daily chat: {cid}")
+
+
+# --- recurring rules -----------------------------------------------------
+
+
+def daily_rule(ctx: CommandContext):
+    for rule in ctx.state["rules"]:
+        if rule.get("name") == "daily":
+            return rule
+    return None
+
+
+def get_rule(ctx: CommandContext, rid: int) -> dict:
+    rule = ctx.state["rules"].get(rid)
+    if rule is None:
+        raise ArgError("Немає такого правила")
+    return rule
+
+
+async def save_rule(ctx: CommandContext, rule: dict) -> None:
+    ctx.state["rules"].replace(rule)
+    ctx.store.record("rule", item=rule)
+    await ctx.on_rules_changed()
+
+
+async def add_rule(ctx: CommandContext, spec: str, msg: str, target=None, **fields) -> dict:
+    state = ctx.state
+    rid = int(state["next_rule_id"])
+    target = target or {"chat_id": int(state["daily_chat_id"])}
+    rule = new_rule(rid, spec, msg, target, ctx.now(), **fields)
+    ctx.store.set(state, "next_rule_id", rid + 1)
+    await save_rule(ctx, rule)
+    return rule
+
+
+async def edit_rule(ctx: CommandContext, rule: dict, **changes) -> dict:
+    # Any edit pulls back a handed-off run and re-derives next_at from now.
+    failed = await ctx.revoke_rule(rule)
+    rule = without(rule, "remote", "pending")
+    if failed:
+        # Left in Telegram: kept so a later edit can try again.
+        rule["remote"] = failed
+        await ctx.reply(f"⚠️ Правило #{rule['id']}: не вдалося видалити {len(failed)} повідомлень з Telegram")
+    if "chat_id" in changes or "group" in changes:
+        rule = without(rule, "chat_id", "group")
+    rule.update(changes)
+    rule["next_at"] = cron(rule["spec"]).next_after(ctx.now()).isoformat()
+    await save_rule(ctx, rule)
+    return rule
+
+
+def every_args(rest: str):
+    head, _, msg = rest.partition(" ")
+    if ":" not in head:
+        parts = rest.split(maxsplit=5)
+        head, msg = " ".join(parts[:5]), parts[5] if len(parts) == 6 else ""
+    if not msg.strip():
+        raise ArgError()
+    try:
+        return parse_spec(head), msg.strip()
+    except ValueError as e:
+        raise ArgError(f"⚠️ Розклад: {e}") from None
+
+
+@command("/every", "<HH:MM | m h dom mon dow> [@group] <text | $template>", text)
+async def cmd_every(ctx: CommandContext, rest: str) -> None:
+    spec, msg = every_args(rest)
+    target, msg = split_target(ctx, msg)
+    check_template(ctx, msg)
+    rule = await add_rule(ctx, spec, msg, target)
+    await ctx.reply(
+        f"✅ Правило #{rule['id']}: {spec}, наступне {rule['next_at']} у {target_label(rule)}"
+    )
+
+
+@command("/rules")
+async def cmd_rules(ctx: CommandContext) -> None:
+    await ctx.reply(format_rules(ctx.state["rules"]))
+
+
+@command("/rule", "<id> on|off|del", integer, choice("on", "off", "del"))
+async def cmd_rule(ctx: CommandContext, rid: int, arg: str) -> None:
+    rule = get_rule(ctx, rid)
+    if arg == "del":
+        failed = await ctx.revoke_rule(rule)
+        if failed:
+            await ctx.reply(f"⚠️ Правило #{rid}: не вдалося видалити {len(failed)} повідомлень з Telegram, спробуй ще раз")
+            return
+        ctx.state["rules"].remove(rid)
+        ctx.store.record("unrule", id=rid)
+        await ctx.on_rules_changed()
+        await ctx.reply(f"✅ Правило #{rid} видалено")
+        return
+    await edit_rule(ctx, rule, enabled=arg == "on")
+    await ctx.reply(f"✅ Правило #{rid}: {on_off(arg == 'on')}")
+
+
+@command("/rulechat", "<id> <chat_id|@group>", integer, text)
+async def cmd_rulechat(ctx: CommandContext, rid: int, value: str) -> None:
+    rule = await edit_rule(ctx, get_rule(ctx, rid), **parse_target(ctx, value))
+    await ctx.reply(f"✅ Правило #{rid}: {target_label(rule)}")
+
+
+@command("/rulecatchup", "<id> once|all|skip", integer, choice(*CATCHUP_POLICIES))
+async def cmd_rulecatchup(ctx: CommandContext, rid: int, policy: str) -> None:
+    await edit_rule(ctx, get_rule(ctx, rid), catchup=policy)
+    await ctx.reply(f"✅ Правило #{rid}: пропущені запуски — {policy}")
+
+
+# --- targets and groups --------------------------------------------------
+
+
+def parse_target(ctx: CommandContext, value: str) -> dict:
+    try:
+        return target_fields(ctx.state, value)
+    except KeyError:
+        raise ArgError(f"Немає групи @{group_name(value)}") from None
+    except ValueError:
+        raise ArgError() from None
+
+
+def split_target(ctx: CommandContext, msg: str):
+    """Peel an optional leading "@group" off a message; default is daily_chat_id."""
+    if msg.startswith("@"):
+        head, _, rest = msg.partition(" ")
+        if not rest.strip():
+            raise ArgError()
+        return parse_target(ctx, head), rest.strip()
+    return {"chat_id": int(ctx.state["daily_chat_id"])}, msg
+
+
+async def enqueue(ctx: CommandContext, target: dict, msg: str, send_at: datetime, **extra) -> dict:
+    state = ctx.state
+    item = {"id": int(state["next_id"]), **target, "text": msg, "send_at": send_at.isoformat(), **extra}
+    ctx.store.set(state, "next_id", item["id"] + 1)
+    state["scheduled"].append(item)
+    ctx.store.record("schedule", item=item)
+    await ctx.on_scheduled(item)
+    return item
+
+
+@command("/group", "<name> <chat_id> [chat_id ...]", text)
+async def cmd_group(ctx: CommandContext, rest: str) -> None:
+    name, *ids = rest.split()
+    if not ids:
+        raise ArgError()
+    try:
+        name = check_group_name(name)
+    except ValueError:
+        raise ArgError("Назва групи: літери, цифри або _") from None
+    groups = dict(ctx.state["groups"])
+    groups[name] = [integer(x) for x in ids]
+    ctx.store.set(ctx.state, "groups", groups)
+    await ctx.reply(f"✅ Група @{name}: {len(ids)} чатів")
+
+
+@command("/ungroup", "<name>", text)
+async def cmd_ungroup(ctx: CommandContext, name: str) -> None:
+    groups = dict(ctx.state["groups"])
+    if groups.pop(group_name(name), None) is None:
+        await ctx.reply(f"Немає групи @{group_name(name)}")
+        return
+    ctx.store.set(ctx.state, "groups", groups)
+    await ctx.reply(f"✅ Групу @{group_name(name)} видалено")
+
+
+@command("/groups")
+async def cmd_groups(ctx: CommandContext) -> None:
+    groups = ctx.state["groups"]
+    if not groups:
+        await ctx.reply("Груп немає.")
+        return
+    await ctx.reply(
+        "\n".join(f"@{name}: {', '.join(str(c) for c in chats)}" for name, chats in groups.items())
+    )
+
+
+# --- templates -----------------------------------------------------------
+
+
+def check_template(ctx: CommandContext, msg: str) -> None:
+    name = reference(msg)
+    if name is not None and name not in (ctx.state.get("templates") or {}):
+        raise ArgError(f"Немає шаблону ${name}")
+
+
+def template_users(ctx: CommandContext, name: str) -> List[str]:
+    rows = [f"#{row['id']}" for row in ctx.state["scheduled"] if reference(row["text"]) == name]
+    rules = [f"правило #{rule['id']}" for rule in ctx.state["rules"] if reference(rule["text"]) == name]
+    return rows + rules
+
+
+@command("/template", "<name> <text with {date} {time} {weekday} {counter} {random:a|b}>", text)
+async def cmd_template(ctx: CommandContext, rest: str) -> None:
+    name, _, source = rest.partition(" ")
+    name = reference("$" + name.lstrip("$"))
+    if name is None or not source.strip():
+        raise ArgError()
+    try:
+        template = compile_template(source.strip())
+    except ValueError as e:
+        raise ArgError(f"⚠️ Шаблон: {e}") from None
+    templates = dict(ctx.state.get("templates") or {})
+    old = templates.get(name)
+    if old is not None:
+        forget(old["text"])
+    counter = old.get("counter", 0) if old else 0
+    templates[name] = {"text": template.source, "counter": counter}
+    ctx.store.set(ctx.state, "templates", templates)
+    await ctx.reply(f"✅ Шаблон ${name}, приклад:\n{template.render(ctx.now(), counter + 1)}")
+
+
+@command("/templates")
+async def cmd_templates(ctx: CommandContext) -> None:
+    templates = ctx.state.get("templates") or {}
+    if not templates:
+        await ctx.reply("Шаблонів немає.")
+        return
+    await ctx.reply(
+        "\n".join(
+            f"${name}: {entry['text']}" + (f" (лічильник {entry['counter']})" if entry.get("counter") else "")
+            for name, entry in templates.items()
+        )
+    )
+
+
+@command("/untemplate", "<name>", text)
+async def cmd_untemplate(ctx: CommandContext, name: str) -> None:
+    name = name.lstrip("$").lower()
+    templates = dict(ctx.state.get("templates") or {})
+    if name not in templates:
+        await ctx.reply(f"Немає шаблону ${name}")
+        return
+    users = template_users(ctx, name)
+    if users:
+        more = f" і ще {len(users) - 10}" if len(users) > 10 else ""
+        await ctx.reply(f"⚠️ ${name} використовують: {', '.join(users[:10])}{more}")
+        return
+    forget(templates.pop(name)["text"])
+    ctx.store.set(ctx.state, "templates", templates)
+    await ctx.reply(f"✅ Шаблон ${name} видалено")
+
+
+@command("/sendin", "<minutes> [@group] <text | $template>", minutes, text)
+async def cmd_sendin(ctx: CommandContext, mins: int, msg: str) -> None:
+    target, msg = split_target(ctx, msg)
+    check_template(ctx, msg)
+    send_at = ctx.now() + timedelta(minutes=mins)
+    item = await enqueue(ctx, target, msg, send_at)
+    await ctx.reply(
+        f"✅ Заплановано #{item['id']} на {send_at.strftime('%Y-%m-%d %H:%M:%S')} "
+        f"у {target_label(item)}"
+    )
+
+
+def parse_before(ctx: CommandContext, value: str) -> float:
+    """"HH:MM" today or an ISO date/time, in the bot's timezone."""
+    try:
+        h, m = hhmm(value)
+        return ctx.now().replace(hour=h, minute=m, second=0, microsecond=0).timestamp()
+    except ArgError:
+        pass
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise ArgError("before: HH:MM або YYYY-MM-DD[THH:MM]") from None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=ctx.tz)
+    return when.timestamp()
+
+
+@command("/queue", "[page] [chat:<chat_id|@group>] [before:<HH:MM|YYYY-MM-DDTHH:MM>]", words)
+async def cmd_queue(ctx: CommandContext, opts: List[str]) -> None:
+    page, target, until = 1, None, None
+    for opt in opts:
+        key, _, value = opt.partition(":")
+        if opt.isdigit() and int(opt) > 0:
+            page = int(opt)
+        elif key == "chat" and value:
+            target = value if value.startswith("@") else str(integer(value))
+        elif key == "before" and value:
+            until = parse_before(ctx, value)
+        else:
+            raise ArgError()
+    start = (page - 1) * QUEUE_PAGE_SIZE
+    rows, total = ctx.state["scheduled"].page(start, QUEUE_PAGE_SIZE, until, target)
+    await ctx.reply(format_queue(ctx, rows, total, page, bool(target or until)))
+
+
+@command("/cancel", "<id>", integer)
+async def cmd_cancel(ctx: CommandContext, sid: int) -> None:
+    item = ctx.state["scheduled"].remove(sid)
+    if item is None:
+        await ctx.reply("Немає такого id")
+        return
+    failed = await ctx.on_cancelled(item)
+    if failed:
+        # Still scheduled in Telegram: keep the row and its message ids so
+        # another /cancel can try again.
+        row = dict(without(item, "remote_id"), pending=[], remote={str(c): m for c, m in failed.items()})
+        ctx.state["scheduled"].append(row)
+        ctx.store.record("schedule", item=row)
+        await ctx.reply(f"⚠️ #{sid}: не вдалося видалити {len(failed)} повідомлень з Telegram, спробуй /cancel ще раз")
+        return
+    ctx.store.record("cancel", id=sid)
+    await ctx.reply(f"✅ Скасовано #{sid}")
+
+
+@command("/import")
+async def cmd_import(ctx: CommandContext) -> None:
+    path = await ctx.download_document()
+    if path is None:
+        await ctx.reply("Надішли CSV або JSONL файлом з підписом /import")
+        return
+    try:
+        items, rejected = import_file(ctx.state, ctx.store, path, ctx.now())
+    except (OSError, ValueError, OverflowError, csv.Error) as e:
+        await ctx.reply(f"⚠️ Не вдалося прочитати файл: {e}")
+        return
+    finally:
+        path.unlink(missing_ok=True)
+    for item in items:
+        await ctx.on_scheduled(item)
+    await ctx.reply(format_summary(items, rejected))
+
+
+@command("/sendnow", "[@group] <text | $template>", text, concurrent=True)
+async def cmd_sendnow(ctx: CommandContext, msg: str) -> None:
+    target, msg = split_target(ctx, msg)
+    check_template(ctx, msg)
+    if not ctx.state["sending_enabled"]:
+        await ctx.reply("🛑 Не відправлено: sending=OFF")
+        return
+    chats = recipients(ctx.state, target)
+    # Rendered once: every recipient of a group gets the same text.
+    body = render(ctx.state, ctx.store, msg, ctx.now())
+    results = await ctx.send_many([SendJob((0, chat), chat, body) for chat in chats])
+    ctx.store.log_deliveries("sendnow", results)
+    failed = [res for res in results if not res.ok]
+    if not failed:
+        await ctx.reply(
+            "✅ Відправлено зараз." if len(chats) < 2 else f"✅ Відправлено: {len(chats)} чатів."
+        )
+    elif "group" not in target:
+        await ctx.reply(f"⚠️ Не відправлено: {failed[0].error}")
+    else:
+        # Only the recipients that failed are retried, from the queue.
+        item = await enqueue(ctx, target, msg, ctx.now(), pending=[res.chat_id for res in failed])
+        await ctx.reply(
+            f"⚠️ Відправлено {len(chats) - len(failed)}/{len(chats)}; "
+            f"решту повторю як #{item['id']}: {failed[0].error}"
+        )
+
+
+@command("/state")
+async def cmd_state(ctx: CommandContext) -> None:
+    state = ctx.state
+    rule = daily_rule(ctx)
+    await ctx.reply(
+        f"sending={on_off(state['sending_enabled'])}\n"
+        f"daily={on_off(bool(rule and rule['enabled']))}"
+        + (f" ({rule['spec']})" if rule else "")
+        + f"\ndaily_chat={state['daily_chat_id']}\n"
+        f"queue={len(state['scheduled'])}\n"
+        f"rules={len(state['rules'])}\n"
+        f"groups={len(state['groups'])}\n"
+        f"templates={len(state.get('templates') or {})}"
+        + (f"\nquarantine={len(state['quarantine'])}" if state.get("quarantine") else "")
+    )
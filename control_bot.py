@@ -1,13 +1,23 @@
 import asyncio
-import json
+import heapq
 import os
-from dataclasses import dataclass
-from datetime import datetime, timedelta
-from typing import Dict, List
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
-from telethon import TelegramClient, events
-from telethon.sessions import StringSession
+from command_router import CommandContext, dispatch, is_concurrent
+from lease import Lease, LeaseLost
+from metrics import metrics
+from outbox import Outbox
+from peer_cache import PeerCache
+from recurring import advance, migrate_daily
+from replies import chunk_text
+from scheduled_queue import attach_queue
+from send_pipeline import SendJob, SendPipeline
+from state_store import DebouncedWriter, open_store
+from targets import recipients, split_results, without
+from templates import render
 
 API_ID = int(os.environ["API_ID"])
 API_HASH = os.environ["API_HASH"]
@@ -18,304 +28,430 @@ DEFAULT_TARGET_CHAT_ID = int(os.environ.get("DAILY_CHAT_ID", "986095695"))
 TIMEZONE = os.environ.get("TIMEZONE", "Europe/Kyiv")
 
 STATE_FILE = os.environ.get("STATE_FILE", "control_state.json")
+PEERS_FILE = STATE_FILE + ".peers"
+RETRY_SECONDS = 60
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", "300"))
+COMMAND_WORKERS = int(os.environ.get("COMMAND_WORKERS", "4"))
+COMMAND_QUEUE_SIZE = int(os.environ.get("COMMAND_QUEUE_SIZE", "100"))
 
 
-@dataclass
-class ScheduledItem:
-    id: int
-    chat_id: int
-    text: str
-    send_at: str  # ISO datetime
-
-
-client = TelegramClient(StringSession(SESSION_STRING), API_ID, API_HASH)
+client = None
+pipeline: Optional[SendPipeline] = None
 state = {
     "sending_enabled": True,
-    "daily_enabled": True,
     "daily_chat_id": DEFAULT_TARGET_CHAT_ID,
-    "daily_hour": 4,
-    "daily_minute": 0,
+    "groups": {},
     "scheduled": [],
     "next_id": 1,
+    "next_rule_id": 1,
 }
-scheduled_tasks: Dict[int, asyncio.Task] = {}
+store = open_store(STATE_FILE, state)
+peers = PeerCache(PEERS_FILE)
+writer = DebouncedWriter(store, state)
+writer.outbox = outbox = Outbox(STATE_FILE)
+lease: Optional[Lease] = None
+# One timer for the whole queue: a min-heap of (epoch, id); state["scheduled"]
+# is the id index. Cancelled ids stay in the heap as tombstones and are
+# skipped when popped.
+scheduled_heap: List[Tuple[float, int]] = []
+scheduler_wakeup = asyncio.Event()
+rules_wakeup = asyncio.Event()
+# Rules with failed recipients keep their next_at; they are retried (only to
+# those recipients) no earlier than this: rule id -> epoch.
+rule_retry: Dict[int, float] = {}
+# Control commands are queued instead of handled inside the update handler.
+# Settings commands run one at a time in arrival order; concurrent ones
+# (/sendnow) go to a pool of workers and wait until every settings command
+# received before them is done (a later one, e.g. /sending off, may still
+# overtake them). Items: (queued_at, seq, event, text).
+serial_commands: asyncio.Queue = asyncio.Queue(COMMAND_QUEUE_SIZE)
+concurrent_commands: asyncio.Queue = asyncio.Queue(COMMAND_QUEUE_SIZE)
+serial_progress = asyncio.Condition()
+serial_seq = 0  # last settings command queued
+serial_done = 0  # last settings command handled
 
 
 def load_state() -> None:
-    if not os.path.exists(STATE_FILE):
-        return
+    global lease
+    # LeaseHeld here means another bot or poller run owns this state file.
+    lease = Lease(store.path).acquire()
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            saved = json.load(f)
-        state.update(saved)
-    except Exception:
-        pass
+        state.update(store.load())
+        lease.verify(state)
+        store.lease = lease
+        outbox.load()
+        peers.load()
+        migrate_daily(state, store, datetime.now(ZoneInfo(TIMEZONE)))
+        for row in attach_queue(state, store) + attach_queue(state, store, "rules", "next_at"):
+            print(f"Quarantined (bad id/time): {row}", flush=True)
+    except BaseException:
+        lease.release()
+        raise
 
 
 def save_state() -> None:
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    writer.mark_dirty()
+    # Only written when a send resolved a peer the cache did not know.
+    peers.save()
 
 
-def parse_iso(dt_str: str) -> datetime:
-    return datetime.fromisoformat(dt_str)
+async def reply(event, text: str) -> None:
+    try:
+        await pipeline.send(event.chat_id, text, reply_to=event.id)
+    except Exception as e:
+        print(f"Reply failed: {e}", flush=True)
+
+
+async def fire_due(items: List[dict]) -> None:
+    if state["sending_enabled"]:
+        queue = state["scheduled"]
+        jobs = []
+        tz = ZoneInfo(TIMEZONE)
+        for item in items:
+            sid = item["id"]
+            ts = queue.ts(sid)
+            body = render(state, store, item["text"], datetime.fromtimestamp(ts, tz))
+            jobs += [SendJob((sid, chat), chat, body, not_before=ts) for chat in recipients(state, item)]
+        claim_key = lambda job: f"scheduled:{job.key[0]}"
+        wanted = {job.key[0] for job in jobs}
+        jobs = lease.claimed(jobs, claim_key)
+        # Rows claimed by another owner are left as they are, for it to send.
+        skipped = wanted - {job.key[0] for job in jobs}
+        results = await outbox.send_many(pipeline, jobs, lambda job: f"scheduled:{job.key[0]}:{job.chat_id}")
+        lease.settle(jobs, results, claim_key)
+        store.log_deliveries("scheduled", results)
+        results = split_results(results)
+    else:
+        for item in items:
+            print(f"Scheduled skipped (sending disabled): #{item['id']}", flush=True)
+        metrics.inc("skips", len(items))
+        results = {}
+        skipped = set()
+
+    # Recipients that failed after the pipeline's own retries stay pending and
+    # the item is re-armed later; delivered recipients are not sent again.
+    queue = state["scheduled"]
+    retry_at = time.time() + RETRY_SECONDS
+    for item in items:
+        sid = item["id"]
+        if sid in skipped:
+            # Looked at again once the claim has had time to be settled.
+            heapq.heappush(scheduled_heap, (retry_at, sid))
+            continue
+        sent, failed = results.get(sid, ({}, {}))
+        for chat, error in failed.items():
+            print(f"Scheduled failed: #{sid} -> {chat}: {error}", flush=True)
+        if failed and queue.get(sid) is not None:
+            row = dict(queue.get(sid), pending=list(failed))
+            queue.replace(row)
+            store.record("schedule", item=row)
+            metrics.inc("requeued", len(failed))
+            heapq.heappush(scheduled_heap, (retry_at, sid))
+            continue
+        if sent:
+            print(f"Scheduled sent: #{sid} ({len(sent)} chats)", flush=True)
+        if queue.remove(sid) is not None:
+            store.record("fire", id=sid)
+    save_state()
 
 
-def next_daily_run(tz: ZoneInfo) -> datetime:
-    now = datetime.now(tz)
-    run_at = now.replace(
-        hour=int(state["daily_hour"]),
-        minute=int(state["daily_minute"]),
-        second=0,
-        microsecond=0,
-    )
-    if run_at <= now:
-        run_at += timedelta(days=1)
-    return run_at
+def compact_heap() -> None:
+    global scheduled_heap
+    queue = state["scheduled"]
+    if len(scheduled_heap) <= 2 * len(queue) + 64:
+        return
+    scheduled_heap = [(ts, sid) for ts, sid in scheduled_heap if queue.get(sid) is not None]
+    heapq.heapify(scheduled_heap)
+
 
+def schedule_item(item: dict) -> None:
+    heapq.heappush(scheduled_heap, (state["scheduled"].ts(item["id"]), item["id"]))
+    scheduler_wakeup.set()
 
-def fmt_queue(rows: List[dict]) -> str:
-    if not rows:
-        return "Черга порожня."
-    lines = []
-    for row in rows:
-        lines.append(
-            f"#{row['id']} -> chat {row['chat_id']} | {row['send_at']} | {row['text']}"
-        )
-    return "\n".join(lines)
 
+def cancel_item(sid: int) -> None:
+    compact_heap()
+    scheduler_wakeup.set()
 
-async def send_if_enabled(chat_id: int, text: str) -> bool:
-    if not state["sending_enabled"]:
-        return False
-    await client.send_message(chat_id, text)
-    return True
 
+async def scheduler_loop() -> None:
+    while True:
+        scheduler_wakeup.clear()
+        now = time.time()
+        due = []
+        while scheduled_heap and scheduled_heap[0][0] <= now:
+            _, sid = heapq.heappop(scheduled_heap)
+            item = state["scheduled"].get(sid)
+            if item is not None:
+                due.append(item)
+        if due:
+            with metrics.phase("scheduled"):
+                await fire_due(due)
+            continue
 
-async def run_scheduled(item: dict) -> None:
-    try:
-        send_at = parse_iso(item["send_at"])
-        now = datetime.now(ZoneInfo(TIMEZONE))
-        delay = (send_at - now).total_seconds()
-        if delay > 0:
-            await asyncio.sleep(delay)
-        ok = await send_if_enabled(item["chat_id"], item["text"])
-        if ok:
-            print(f"Scheduled sent: #{item['id']}", flush=True)
+        timeout = scheduled_heap[0][0] - now if scheduled_heap else None
+        try:
+            await asyncio.wait_for(scheduler_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def fire_rules(rules: List[dict], now: datetime) -> None:
+    queue = state["rules"]
+    jobs = []
+    advanced = {}
+    for rule in rules:
+        runs, following = advance(rule, now)
+        if not (rule["enabled"] and state["sending_enabled"]):
+            runs = 0
+        if not runs:
+            metrics.inc("skips")
+        advanced[rule["id"]] = following
+        at = queue.ts(rule["id"])
+        chats = recipients(state, rule)
+        for n in range(runs):
+            body = render(state, store, rule["text"], datetime.fromtimestamp(at, now.tzinfo))
+            jobs += [SendJob((rule["id"], chat, n), chat, body, not_before=at) for chat in chats]
+    claim_key = lambda job: f"rule:{job.key[0]}:{queue.get(job.key[0])['next_at']}"
+    wanted = {job.key[0] for job in jobs}
+    jobs = lease.claimed(jobs, claim_key)
+    # A run claimed by another owner is its to send: next_at stays.
+    skipped = wanted - {job.key[0] for job in jobs}
+    results = await outbox.send_many(
+        pipeline, jobs, lambda job: claim_key(job) + "".join(f":{part}" for part in job.key[1:])
+    )
+    lease.settle(jobs, results, claim_key)
+    store.log_deliveries("rule", results)
+    for res in results:
+        mark = "sent" if res.ok else f"failed: {res.error}"
+        print(f"Rule #{res.key[0]} -> {res.chat_id} {mark}", flush=True)
+
+    # A partial failure keeps next_at and retries only the pending recipients.
+    results = split_results(results)
+    retry_at = time.time() + RETRY_SECONDS
+    for rid, following in advanced.items():
+        rule = queue.get(rid)
+        if rule is None:
+            continue
+        if rid in skipped:
+            rule_retry[rid] = retry_at
+            continue
+        sent, failed = results.get(rid, ({}, {}))
+        if failed:
+            rule = dict(rule, pending=list(failed))
+            metrics.inc("requeued", len(failed))
+            rule_retry[rid] = retry_at
         else:
-            print(f"Scheduled skipped (sending disabled): #{item['id']}", flush=True)
-    except asyncio.CancelledError:
-        return
-    finally:
-        state["scheduled"] = [x for x in state["scheduled"] if x["id"] != item["id"]]
-        save_state()
-        scheduled_tasks.pop(item["id"], None)
+            rule = dict(without(rule, "pending"), next_at=following.isoformat())
+            rule_retry.pop(rid, None)
+        queue.replace(rule)
+        store.record("rule", item=rule)
+    save_state()
 
 
-def schedule_item(item: dict) -> None:
-    task = asyncio.create_task(run_scheduled(item))
-    scheduled_tasks[item["id"]] = task
+async def rules_loop() -> None:
+    tz = ZoneInfo(TIMEZONE)
+    while True:
+        rules_wakeup.clear()
+        now = datetime.now(tz)
+        now_ts = now.timestamp()
+        due = [rule for rule in state["rules"].window(now_ts) if rule_retry.get(rule["id"], 0) <= now_ts]
+        if due:
+            with metrics.phase("rules"):
+                await fire_rules(due, now)
+            continue
 
+        # Due rules left are waiting for their retry.
+        wake = [ts for ts in rule_retry.values() if ts > now_ts]
+        next_ts = state["rules"].next_ts(after=now_ts)
+        if next_ts is not None:
+            wake.append(next_ts)
+        timeout = max(min(wake) - time.time(), 0) if wake else None
+        try:
+            # Rule commands re-arm the timer.
+            await asyncio.wait_for(rules_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-async def daily_loop() -> None:
-    tz = ZoneInfo(TIMEZONE)
+
+async def metrics_loop() -> None:
+    # Counters are cumulative since start, like any long-running exporter.
     while True:
-        run_at = next_daily_run(tz)
-        wait_seconds = (run_at - datetime.now(tz)).total_seconds()
-        await asyncio.sleep(max(wait_seconds, 0))
+        await asyncio.sleep(METRICS_INTERVAL)
+        metrics.set("scheduled", len(state["scheduled"]))
+        metrics.set("rules", len(state["rules"]))
+        metrics.set("heap", len(scheduled_heap))
+        metrics.set("command_queue", serial_commands.qsize() + concurrent_commands.qsize())
+        metrics.set("peer_hits", peers.hits)
+        metrics.set("peer_misses", peers.misses)
+        metrics.emit("control_bot")
 
-        if not state["daily_enabled"]:
-            continue
 
-        ok = await send_if_enabled(int(state["daily_chat_id"]), "вогник")
-        mark = "sent" if ok else "skipped (sending disabled)"
-        print(f"Daily message {mark} at {datetime.now(tz)}", flush=True)
+async def lease_loop() -> None:
+    while True:
+        await asyncio.sleep(lease.ttl / 3)
+        try:
+            lease.renew()
+        except LeaseLost as e:
+            # Someone else writes this state now; stop before sending anything.
+            print(f"Stopping: {e}", flush=True)
+            await client.disconnect()
+            return
+
+
+class BotContext(CommandContext):
+    def __init__(self, event):
+        super().__init__(state, store, TIMEZONE)
+        self.event = event
+        self.message = event.message
+
+    async def reply(self, text: str) -> None:
+        for chunk in chunk_text([text]):
+            await reply(self.event, chunk)
+
+    async def send(self, chat_id: int, text: str, **kwargs):
+        return await pipeline.send(chat_id, text, **kwargs)
+
+    async def send_many(self, jobs):
+        return await pipeline.send_many(jobs)
+
+    async def on_scheduled(self, item: dict) -> None:
+        schedule_item(item)
+
+    async def on_cancelled(self, item: dict) -> Dict[int, int]:
+        cancel_item(item["id"])
+        return {}
+
+    async def on_rules_changed(self) -> None:
+        # An edited rule gets a fresh start.
+        rule_retry.clear()
+        rules_wakeup.set()
 
 
-@client.on(events.NewMessage(outgoing=True))
 async def commands(event) -> None:
+    global serial_seq
     text = (event.raw_text or "").strip()
     if not text.startswith("/"):
         return
     if event.chat_id != CONTROL_CHAT_ID:
         return
 
-    if text == "/help":
-        await event.reply(
-            "/sending on|off|status\n"
-            "/daily on|off|status\n"
-            "/dailytime HH:MM\n"
-            "/dailychat <chat_id>\n"
-            "/sendin <minutes> <text>\n"
-            "/queue\n"
-            "/cancel <id>\n"
-            "/sendnow <text>\n"
-            "/state"
-        )
+    concurrent = is_concurrent(text)
+    lane = concurrent_commands if concurrent else serial_commands
+    seq = serial_seq if concurrent else serial_seq + 1
+    try:
+        lane.put_nowait((time.perf_counter(), seq, event, text))
+    except asyncio.QueueFull:
+        metrics.inc("commands_busy")
+        await reply(event, "⏳ Зайнято: забагато команд у черзі, спробуй трохи пізніше")
         return
+    if not concurrent:
+        serial_seq = seq
+    depth = serial_commands.qsize() + concurrent_commands.qsize()
+    metrics.set("command_queue_peak", max(depth, metrics.gauges.get("command_queue_peak", 0)))
 
-    if text.startswith("/sending "):
-        arg = text.split(maxsplit=1)[1].strip().lower()
-        if arg == "on":
-            state["sending_enabled"] = True
-            save_state()
-            await event.reply("✅ Відправка увімкнена.")
-        elif arg == "off":
-            state["sending_enabled"] = False
-            save_state()
-            await event.reply("🛑 Відправка вимкнена.")
-        elif arg == "status":
-            val = "ON" if state["sending_enabled"] else "OFF"
-            await event.reply(f"Sending: {val}")
-        else:
-            await event.reply("Формат: /sending on|off|status")
-        return
 
-    if text.startswith("/daily "):
-        arg = text.split(maxsplit=1)[1].strip().lower()
-        if arg == "on":
-            state["daily_enabled"] = True
-            save_state()
-            await event.reply("✅ Щоденна відправка о 04:00 увімкнена.")
-        elif arg == "off":
-            state["daily_enabled"] = False
+async def handle_command(queued_at: float, event, text: str) -> None:
+    try:
+        with metrics.phase("commands"):
+            await dispatch(BotContext(event), text)
+        if store.dirty:
             save_state()
-            await event.reply("🛑 Щоденна відправка вимкнена.")
-        elif arg == "status":
-            val = "ON" if state["daily_enabled"] else "OFF"
-            await event.reply(
-                f"Daily: {val} | time {state['daily_hour']:02d}:{state['daily_minute']:02d} "
-                f"| chat {state['daily_chat_id']}"
-            )
-        else:
-            await event.reply("Формат: /daily on|off|status")
-        return
+    except Exception as e:
+        print(f"Command failed: {text}: {e!r}", flush=True)
+    metrics.observe("command", time.perf_counter() - queued_at)
 
-    if text.startswith("/dailytime "):
-        arg = text.split(maxsplit=1)[1].strip()
-        try:
-            hh, mm = arg.split(":")
-            hh_i = int(hh)
-            mm_i = int(mm)
-            if not (0 <= hh_i <= 23 and 0 <= mm_i <= 59):
-                raise ValueError
-        except Exception:
-            await event.reply("Формат: /dailytime HH:MM")
-            return
-        state["daily_hour"] = hh_i
-        state["daily_minute"] = mm_i
-        save_state()
-        await event.reply(f"✅ Новий час: {hh_i:02d}:{mm_i:02d}")
-        return
 
-    if text.startswith("/dailychat "):
-        arg = text.split(maxsplit=1)[1].strip()
+async def serial_worker() -> None:
+    global serial_done
+    while True:
+        queued_at, seq, event, text = await serial_commands.get()
         try:
-            cid = int(arg)
-        except ValueError:
-            await event.reply("Формат: /dailychat <chat_id>")
-            return
-        state["daily_chat_id"] = cid
-        save_state()
-        await event.reply(f"✅ Daily chat: {cid}")
-        return
+            await handle_command(queued_at, event, text)
+        finally:
+            serial_done = seq
+            async with serial_progress:
+                serial_progress.notify_all()
+            serial_commands.task_done()
 
-    if text.startswith("/sendin "):
-        parts = text.split(maxsplit=2)
-        if len(parts) < 3:
-            await event.reply("Формат: /sendin <minutes> <text>")
-            return
+
+async def concurrent_worker() -> None:
+    while True:
+        queued_at, seq, event, text = await concurrent_commands.get()
         try:
-            mins = int(parts[1])
-            if mins < 0:
-                raise ValueError
-        except ValueError:
-            await event.reply("minutes має бути числом >= 0")
-            return
-        msg = parts[2]
-        send_at = datetime.now(ZoneInfo(TIMEZONE)) + timedelta(minutes=mins)
-        item = {
-            "id": int(state["next_id"]),
-            "chat_id": int(state["daily_chat_id"]),
-            "text": msg,
-            "send_at": send_at.isoformat(),
-        }
-        state["next_id"] = int(state["next_id"]) + 1
-        state["scheduled"].append(item)
-        save_state()
-        schedule_item(item)
-        await event.reply(
-            f"✅ Заплановано #{item['id']} через {mins} хв у chat {item['chat_id']}"
-        )
-        return
+            async with serial_progress:
+                await serial_progress.wait_for(lambda: serial_done >= seq)
+            await handle_command(queued_at, event, text)
+        finally:
+            concurrent_commands.task_done()
 
-    if text == "/queue":
-        await event.reply(fmt_queue(state["scheduled"]))
-        return
 
-    if text.startswith("/cancel "):
-        arg = text.split(maxsplit=1)[1].strip()
-        try:
-            sid = int(arg)
-        except ValueError:
-            await event.reply("Формат: /cancel <id>")
-            return
-        task = scheduled_tasks.get(sid)
-        if task and not task.done():
-            task.cancel()
-        before = len(state["scheduled"])
-        state["scheduled"] = [x for x in state["scheduled"] if x["id"] != sid]
-        save_state()
-        if len(state["scheduled"]) < before:
-            await event.reply(f"✅ Скасовано #{sid}")
-        else:
-            await event.reply("Немає такого id")
-        return
+def make_client():
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
 
-    if text.startswith("/sendnow "):
-        msg = text.split(maxsplit=1)[1]
-        ok = await send_if_enabled(int(state["daily_chat_id"]), msg)
-        if ok:
-            await event.reply("✅ Відправлено зараз.")
-        else:
-            await event.reply("🛑 Не відправлено: sending=OFF")
-        return
+    return TelegramClient(StringSession(SESSION_STRING), API_ID, API_HASH)
 
-    if text == "/state":
-        await event.reply(
-            f"sending={'ON' if state['sending_enabled'] else 'OFF'}\n"
-            f"daily={'ON' if state['daily_enabled'] else 'OFF'}\n"
-            f"time={state['daily_hour']:02d}:{state['daily_minute']:02d}\n"
-            f"daily_chat={state['daily_chat_id']}\n"
-            f"queue={len(state['scheduled'])}"
-        )
-        return
+
+def attach(c, new_message=None) -> None:
+    global client, pipeline
+    client = c
+    pipeline = SendPipeline(c, peers=peers)
+    if new_message is None:
+        from telethon import events
+
+        new_message = events.NewMessage(outgoing=True)
+    c.add_event_handler(commands, new_message)
 
 
 async def main() -> None:
     print("Starting control_bot...", flush=True)
     load_state()
-
-    await client.connect()
-    if not await client.is_user_authorized():
-        raise RuntimeError("Session is not authorized. Regenerate SESSION_STRING.")
-
-    me = await client.get_me()
-    print(f"Logged in as: {me.id}", flush=True)
-    print(f"Control chat: {CONTROL_CHAT_ID}", flush=True)
-    print(
-        f"Daily: {'ON' if state['daily_enabled'] else 'OFF'} at "
-        f"{state['daily_hour']:02d}:{state['daily_minute']:02d}, "
-        f"chat {state['daily_chat_id']}",
-        flush=True,
-    )
-
-    for item in list(state["scheduled"]):
-        schedule_item(item)
-
-    asyncio.create_task(daily_loop())
-    await client.run_until_disconnected()
+    tasks = []
+    try:
+        if client is None:
+            attach(make_client())
+
+        await client.connect()
+        if not await client.is_user_authorized():
+            raise RuntimeError("Session is not authorized. Regenerate SESSION_STRING.")
+        await outbox.reconcile(client, pipeline.peer)
+
+        me = await client.get_me()
+        print(f"Logged in as: {me.id}", flush=True)
+        print(f"Control chat: {CONTROL_CHAT_ID}", flush=True)
+        print(f"Rules: {len(state['rules'])}, scheduled: {len(state['scheduled'])}", flush=True)
+
+        # The queue is already in send_at order, which is a valid heap.
+        queue = state["scheduled"]
+        scheduled_heap[:] = [(queue.ts(item["id"]), item["id"]) for item in queue]
+
+        tasks = [
+            asyncio.create_task(scheduler_loop()),
+            asyncio.create_task(rules_loop()),
+            asyncio.create_task(metrics_loop()),
+            asyncio.create_task(lease_loop()),
+            asyncio.create_task(serial_worker()),
+        ]
+        tasks += [asyncio.create_task(concurrent_worker()) for _ in range(COMMAND_WORKERS)]
+        await client.run_until_disconnected()
+    finally:
+        # Also on Ctrl+C: asyncio.run cancels main() and this still runs.
+        for task in tasks:
+            task.cancel()
+        saved = None
+        try:
+            if not lease.lost:
+                await writer.close()
+                saved = state
+        finally:
+            lease.release(saved)
+            peers.save()
+            metrics.emit("control_bot")
 
 
 if __name__ == "__main__":
-    client.loop.run_until_complete(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
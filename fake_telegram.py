@@ -0,0 +1,268 @@
+"""In-process stand-in for the part of TelegramClient that the bots use.
+
+Used by bench.py to run gh_poller.run() and control_bot offline. Latency is
+charged per request and FloodWait can be injected every N sends. Like a
+fresh StringSession, a bare chat id costs one resolution request the first
+time it is used; input peers (dicts here) are used as-is.
+"""
+
+import asyncio
+import bisect
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from peer_cache import telethon_api
+
+PAGE_SIZE = 100
+
+
+@dataclass
+class FakeMessage:
+    id: int
+    chat_id: int
+    message: str
+    out: bool = True
+    date: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    schedule: Optional[datetime] = None
+
+    @property
+    def raw_text(self) -> str:
+        return self.message
+
+
+class NewMessage:
+    def __init__(self, outgoing: Optional[bool] = None, chats=None):
+        self.outgoing = outgoing
+        self.chats = chats
+
+    def matches(self, msg: FakeMessage) -> bool:
+        if self.outgoing is not None and msg.out != self.outgoing:
+            return False
+        if self.chats is not None and msg.chat_id not in self.chats:
+            return False
+        return True
+
+
+class FakeEvent(SimpleNamespace):
+    async def reply(self, text: str, **kwargs):
+        return await self.client.send_message(self.chat_id, text, reply_to=self.id, **kwargs)
+
+
+class FakeClient:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        flood_every: int = 0,
+        flood_seconds: int = 1,
+        me_id: int = 1,
+        authorized: bool = True,
+    ):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.me_id = me_id
+        self.authorized = authorized
+        self.connected = False
+        self.chats: Dict[int, List[FakeMessage]] = defaultdict(list)
+        self.scheduled: Dict[int, FakeMessage] = {}
+        self.sent: List[tuple] = []  # (epoch seconds, message)
+        self.requests = 0
+        self.send_calls = 0
+        self.flood_waits = 0
+        self._next_id = 1
+        self._resolved: set = set()
+        self.access_hashes: Dict[int, int] = {}
+        self._handlers: List[tuple] = []
+        self._disconnected = asyncio.Event()
+
+    async def _request(self) -> None:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _new_message(self, chat_id: int, text: str, out: bool = True, **kwargs) -> FakeMessage:
+        msg = FakeMessage(self._next_id, chat_id, text, out, **kwargs)
+        self._next_id += 1
+        return msg
+
+    # --- connection ------------------------------------------------------
+
+    async def connect(self) -> None:
+        await self._request()
+        self.connected = True
+        self._disconnected.clear()
+
+    async def disconnect(self) -> None:
+        self.connected = False
+        self._disconnected.set()
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    async def is_user_authorized(self) -> bool:
+        await self._request()
+        return self.authorized
+
+    async def get_me(self):
+        await self._request()
+        return SimpleNamespace(id=self.me_id)
+
+    async def run_until_disconnected(self) -> None:
+        await self._disconnected.wait()
+
+    # --- peers -----------------------------------------------------------
+
+    def access_hash(self, chat_id: int) -> int:
+        return self.access_hashes.setdefault(chat_id, chat_id * 7919 % 1000003)
+
+    def input_peer(self, chat_id: int) -> dict:
+        return {"_": "InputPeerUser", "user_id": chat_id, "access_hash": self.access_hash(chat_id)}
+
+    async def _peer_id(self, entity) -> int:
+        if isinstance(entity, dict):
+            chat_id = entity["user_id"]
+            if entity.get("access_hash") != self.access_hash(chat_id):
+                raise telethon_api().errors.PeerIdInvalidError(request=None)
+            return chat_id
+        if entity not in self._resolved:
+            await self._request()
+            self._resolved.add(entity)
+        return entity
+
+    async def get_input_entity(self, chat_id: int) -> dict:
+        await self._request()
+        self._resolved.add(chat_id)
+        return self.input_peer(chat_id)
+
+    async def iter_dialogs(self):
+        await self._request()
+        for chat_id in list(self.chats):
+            yield SimpleNamespace(id=chat_id, input_entity=self.input_peer(chat_id))
+
+    # --- messages --------------------------------------------------------
+
+    def preload(self, chat_id: int, texts, out: bool = True) -> None:
+        for text in texts:
+            self.chats[chat_id].append(self._new_message(chat_id, text, out))
+
+    async def get_messages(self, chat_id: int, limit: int = PAGE_SIZE, min_id: int = 0, **kwargs):
+        await self._request()
+        rows = [m for m in self.chats[chat_id] if m.id > min_id]
+        return list(reversed(rows[-limit:])) if limit else []
+
+    async def iter_messages(
+        self,
+        entity,
+        limit: Optional[int] = None,
+        offset_id: int = 0,
+        min_id: int = 0,
+        reverse: bool = False,
+        scheduled: bool = False,
+        **kwargs,
+    ):
+        chat_id = await self._peer_id(entity)
+        if scheduled:
+            await self._request()
+            for m in sorted(self.scheduled.values(), key=lambda m: m.schedule):
+                if m.chat_id == chat_id:
+                    yield m
+            return
+        rows = self.chats[chat_id]
+        yielded = 0
+        if reverse:
+            cursor = max(offset_id, min_id)
+            while limit is None or yielded < limit:
+                await self._request()
+                start = bisect.bisect_right(rows, cursor, key=lambda m: m.id)
+                page = rows[start:start + PAGE_SIZE]
+                for m in page:
+                    yield m
+                    yielded += 1
+                if len(page) < PAGE_SIZE:
+                    return
+                cursor = page[-1].id
+        else:
+            cursor = offset_id or float("inf")
+            while limit is None or yielded < limit:
+                await self._request()
+                page = [m for m in reversed(rows) if min_id < m.id < cursor][:PAGE_SIZE]
+                for m in page:
+                    yield m
+                    yielded += 1
+                if len(page) < PAGE_SIZE:
+                    return
+                cursor = page[-1].id
+
+    async def send_message(self, entity, text: str, schedule=None, **kwargs) -> FakeMessage:
+        self.send_calls += 1
+        # Numbered before any await, so concurrent sends cannot share a number.
+        call = self.send_calls
+        chat_id = await self._peer_id(entity)
+        await self._request()
+        if self.flood_every and call % self.flood_every == 0:
+            self.flood_waits += 1
+            raise telethon_api().errors.FloodWaitError(request=None, capture=self.flood_seconds)
+        if schedule is not None:
+            # Like Telegram, a scheduled message is dated when it is due.
+            msg = self._new_message(chat_id, text, date=schedule, schedule=schedule)
+            self.scheduled[msg.id] = msg
+            return msg
+        msg = self._new_message(chat_id, text)
+        self.chats[chat_id].append(msg)
+        self.sent.append((time.time(), msg))
+        if self._handlers:
+            # Telegram echoes our own sends as updates; deliver them like Telethon
+            # does, outside the caller's await.
+            asyncio.ensure_future(self._emit(msg))
+        return msg
+
+    async def __call__(self, request):
+        await self._request()
+        for msg_id in getattr(request, "id", []) or []:
+            self.scheduled.pop(msg_id, None)
+        return True
+
+    # --- events ----------------------------------------------------------
+
+    def add_event_handler(self, callback: Callable, event=None) -> None:
+        self._handlers.append((callback, event or NewMessage()))
+
+    def on(self, event):
+        def register(callback):
+            self.add_event_handler(callback, event)
+            return callback
+
+        return register
+
+    async def _emit(self, msg: FakeMessage) -> None:
+        for callback, builder in self._handlers:
+            if builder.matches(msg):
+                event = FakeEvent(
+                    client=self,
+                    id=msg.id,
+                    chat_id=msg.chat_id,
+                    raw_text=msg.message,
+                    message=msg,
+                    out=msg.out,
+                )
+                await callback(event)
+
+    async def type_message(self, chat_id: int, text: str, out: bool = True) -> FakeMessage:
+        """Simulate the account owner writing a message (fires NewMessage)."""
+        msg = self._new_message(chat_id, text, out)
+        self.chats[chat_id].append(msg)
+        await self._emit(msg)
+        return msg
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "send_calls": self.send_calls,
+            "flood_waits": self.flood_waits,
+            "delivered": len(self.sent),
+            "scheduled": len(self.scheduled),
+        }
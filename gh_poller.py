@@ -1,273 +1,622 @@
+import argparse
+import asyncio
 import json
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Tuple
 from zoneinfo import ZoneInfo
 
-from telethon import TelegramClient
-from telethon.sessions import StringSession
+from command_router import CommandContext, dispatch
+from lease import Lease, LeaseHeld, LeaseLost
+from metrics import metrics
+from outbox import Outbox
+from peer_cache import PeerCache
+from recurring import advance, cron, migrate_daily
+from replies import ReplyBuffer
+from scheduled_queue import attach_queue
+from send_pipeline import SendJob, SendPipeline
+from state_store import DebouncedWriter, open_store
+from targets import recipients, remote_map, split_results, without
+from templates import render
 
 API_ID = int(os.environ["API_ID"])
 API_HASH = os.environ["API_HASH"]
-SESSION_STRING = os.environ["SESSION_STRING"]
 
-CONTROL_CHAT_ID = int(os.environ["CONTROL_CHAT_ID"])
 DEFAULT_TARGET_CHAT_ID = int(os.environ.get("DAILY_CHAT_ID", "986095695"))
 TIMEZONE = os.environ.get("TIMEZONE", "Europe/Kyiv")
 
 STATE_PATH = Path(os.environ.get("STATE_FILE", "control_state.json"))
-
-
-def now_tz() -> datetime:
-    return datetime.now(ZoneInfo(TIMEZONE))
-
-
-def default_state() -> dict:
+# JSON list of accounts to run in one process instead of the single one
+# configured by SESSION_STRING/CONTROL_CHAT_ID.
+ACCOUNTS_FILE = os.environ.get("ACCOUNTS_FILE")
+# With several accounts, one still running this long after its --duration is
+# cancelled so it cannot hold up the rest.
+ACCOUNT_GRACE_SECONDS = float(os.environ.get("ACCOUNT_GRACE_SECONDS", "120"))
+# Anything due before the next cron run is handed to Telegram's server-side
+# scheduler; 0 disables the lookahead.
+LOOKAHEAD_SECONDS = int(os.environ.get("LOOKAHEAD_SECONDS", "660"))
+# Telegram rejects schedule dates that are too close; those are sent directly.
+MIN_HANDOFF_SECONDS = 15
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "10"))
+
+
+def default_state(daily_chat_id: int = DEFAULT_TARGET_CHAT_ID) -> dict:
     return {
         "sending_enabled": True,
-        "daily_enabled": True,
-        "daily_chat_id": DEFAULT_TARGET_CHAT_ID,
-        "daily_hour": 4,
-        "daily_minute": 0,
+        "daily_chat_id": daily_chat_id,
+        "groups": {},
         "scheduled": [],
         "next_id": 1,
+        "next_rule_id": 1,
         "last_command_id": 0,
-        "last_daily_date": "",
     }
 
 
-def load_state() -> dict:
-    if not STATE_PATH.exists():
-        return default_state()
-    try:
-        data = json.loads(STATE_PATH.read_text(encoding="utf-8"))
-        base = default_state()
-        base.update(data)
-        return base
-    except Exception:
-        return default_state()
-
-
-def save_state(state: dict) -> None:
-    STATE_PATH.write_text(
-        json.dumps(state, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
-
-
-def parse_hhmm(value: str):
-    hh, mm = value.split(":")
-    h = int(hh)
-    m = int(mm)
-    if not (0 <= h <= 23 and 0 <= m <= 59):
-        raise ValueError
-    return h, m
-
-
-def format_queue(rows: List[dict]) -> str:
-    if not rows:
-        return "Черга порожня."
-    lines = []
-    for row in rows:
-        lines.append(f"#{row['id']} | {row['send_at']} | chat {row['chat_id']} | {row['text']}")
-    return "\n".join(lines)
-
-
-async def run() -> None:
-    state = load_state()
-    client = TelegramClient(StringSession(SESSION_STRING), API_ID, API_HASH)
-    await client.connect()
-    if not await client.is_user_authorized():
-        raise RuntimeError("Session is not authorized. Regenerate SESSION_STRING.")
-
-    now = now_tz()
-    changed = False
-
-    async def reply(text: str) -> None:
-        await client.send_message(CONTROL_CHAT_ID, text)
+class Account:
+    """One session with its own control chat, timezone and state file."""
+
+    def __init__(
+        self,
+        name: str,
+        session: str,
+        control_chat_id: int,
+        timezone: str = TIMEZONE,
+        state_path=STATE_PATH,
+        daily_chat_id: int = DEFAULT_TARGET_CHAT_ID,
+    ):
+        self.name = name
+        self.session = session
+        self.control_chat_id = int(control_chat_id)
+        self.timezone = timezone
+        self.state_path = Path(state_path)
+        self.peers_path = self.state_path.with_name(self.state_path.name + ".peers")
+        self.store = open_store(self.state_path, default_state(int(daily_chat_id)))
+        # Prefix for this account's log lines; empty for a single account.
+        self.tag = ""
+
+    @classmethod
+    def from_env(cls) -> "Account":
+        return cls("default", os.environ["SESSION_STRING"], int(os.environ["CONTROL_CHAT_ID"]))
+
+    @classmethod
+    def from_config(cls, data: dict) -> "Account":
+        """An ACCOUNTS_FILE entry: name, session (or session_env naming the
+        variable that holds it), control_chat_id and optionally timezone,
+        state (control_state.<name>.json by default) and daily_chat_id."""
+        name = data["name"]
+        state_path = data.get("state") or STATE_PATH.with_name(
+            f"{STATE_PATH.stem}.{name}{STATE_PATH.suffix}"
+        )
+        account = cls(
+            name,
+            data.get("session") or os.environ[data["session_env"]],
+            int(data["control_chat_id"]),
+            data.get("timezone", TIMEZONE),
+            state_path,
+            int(data.get("daily_chat_id", DEFAULT_TARGET_CHAT_ID)),
+        )
+        account.tag = f"[{name}] "
+        return account
+
+
+def load_accounts(path) -> List[Account]:
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    accounts = [Account.from_config(entry) for entry in data["accounts"]]
+    if len({a.name for a in accounts}) != len(accounts):
+        raise ValueError(f"duplicate account names in {path}")
+    if len({a.state_path.resolve() for a in accounts}) != len(accounts):
+        raise ValueError(f"accounts in {path} share a state file")
+    return accounts
+
+
+class PollerContext(CommandContext):
+    def __init__(
+        self,
+        client,
+        account: Account,
+        state: dict,
+        pipeline: SendPipeline,
+        replies: ReplyBuffer,
+        lease: Lease,
+        outbox: Outbox,
+    ):
+        super().__init__(state, account.store, account.timezone)
+        self.account = account
+        self.client = client
+        self.pipeline = pipeline
+        self.replies = replies
+        self.lease = lease
+        self.outbox = outbox
+
+    async def reply(self, text: str) -> None:
+        await self.replies.add(text)
+
+    async def send(self, chat_id: int, text: str, **kwargs):
+        return await self.pipeline.send(chat_id, text, **kwargs)
+
+    async def send_many(self, jobs):
+        return await self.pipeline.send_many(jobs)
+
+    async def delete_remote(self, chat_id: int, msg_id: int) -> bool:
+        """Pull a handed-off message back from Telegram; False if that failed."""
+        try:
+            from telethon.tl.functions.messages import DeleteScheduledMessagesRequest
 
-    async def send_if_enabled(chat_id: int, text: str) -> bool:
-        if not state["sending_enabled"]:
+            peer = await self.pipeline.peer(chat_id)
+            await self.client(DeleteScheduledMessagesRequest(peer=peer, id=[msg_id]))
+        except Exception as e:
+            print(f"Failed to delete scheduled message {msg_id}: {e}", flush=True)
             return False
-        await client.send_message(chat_id, text)
         return True
 
-    # 1) Process new commands from control chat (your own outgoing messages)
-    msgs = await client.get_messages(CONTROL_CHAT_ID, limit=100)
-    commands = []
-    for m in msgs:
-        if not m or not m.out or not m.message:
-            continue
-        if m.id <= int(state["last_command_id"]):
-            continue
-        text = m.message.strip()
-        if text.startswith("/"):
-            commands.append(m)
+    async def revoke_rule(self, rule: dict) -> list:
+        """Delete the rule's handed-off runs that are still pending; returns
+        the ones left in Telegram because the delete failed."""
+        return (await self._revoke(rule))[1]
+
+    async def _revoke(self, rule: dict) -> Tuple[list, list]:
+        now = self.now()
+        revoked, failed = [], []
+        for r in rule.get("remote") or []:
+            if datetime.fromisoformat(r["at"]) > now:
+                deleted = await self.delete_remote(int(r["chat_id"]), int(r["id"]))
+                (revoked if deleted else failed).append(r)
+        return revoked, failed
+
+    async def on_cancelled(self, item: dict) -> Dict[int, int]:
+        return {
+            chat: msg_id
+            for chat, msg_id in remote_map(item).items()
+            if not await self.delete_remote(chat, msg_id)
+        }
+
+    async def on_sending_changed(self) -> None:
+        if self.state["sending_enabled"]:
+            return
+        # Handed-off messages would still go out; pull them back from Telegram.
+        # Only the ones actually deleted are owed again once sending is back
+        # on; the rest stay recorded as handed off.
+        rules = self.state["rules"]
+        for rule in [rule for rule in rules if rule.get("remote")]:
+            revoked, failed = await self._revoke(rule)
+            rule = without(rule, "remote", "pending")
+            if revoked:
+                # The revoked runs are due again once sending is back on.
+                first = min(revoked, key=lambda r: datetime.fromisoformat(r["at"]))["at"]
+                rule["next_at"] = first
+                if failed:
+                    rule["pending"] = [int(r["chat_id"]) for r in revoked if r["at"] == first]
+            if failed:
+                rule["remote"] = failed
+                await self.reply(f"⚠️ Правило #{rule['id']}: не вдалося видалити {len(failed)} повідомлень з Telegram")
+            rules.replace(rule)
+            self.store.record("rule", item=rule)
+        queue = self.state["scheduled"]
+        for row in [row for row in queue if remote_map(row)]:
+            remote = remote_map(row)
+            failed = {
+                chat: msg_id for chat, msg_id in remote.items() if not await self.delete_remote(chat, msg_id)
+            }
+            owed = [chat for chat in recipients(self.state, row) if chat not in remote]
+            pending = owed + [chat for chat in remote if chat not in failed]
+            row = dict(without(row, "remote", "remote_id"), pending=pending)
+            if failed:
+                row["remote"] = {str(chat): msg_id for chat, msg_id in failed.items()}
+                await self.reply(f"⚠️ #{row['id']}: не вдалося видалити {len(failed)} повідомлень з Telegram")
+            queue.replace(row)
+            self.store.record("schedule", item=row)
+
+
+def plan(state: dict, now: float) -> dict:
+    """Which of the time-based phases have work, from local state alone.
+
+    Only the queue heads up to the lookahead horizon are looked at. A row
+    already handed off to Telegram is work only once it is due (to leave the
+    queue); a rule is work when it is due or can be handed off.
+    """
+    due_until = now + MIN_HANDOFF_SECONDS
+    horizon = max(due_until, now + LOOKAHEAD_SECONDS)
+    queue = state["scheduled"]
+    rules = state["rules"]
+    return {
+        "scheduled": any(
+            queue.ts(row["id"]) <= due_until or (state["sending_enabled"] and recipients(state, row))
+            for row in queue.window(horizon)
+        ),
+        "rules": any(
+            rules.ts(rule["id"]) <= due_until
+            or (rule["enabled"] and state["sending_enabled"] and recipients(state, rule))
+            for rule in rules.window(horizon)
+        ),
+    }
 
-    commands.sort(key=lambda x: x.id)
-    for m in commands:
-        text = m.message.strip()
-        handled = True
 
-        if text == "/help":
-            await reply(
-                "/sending on|off|status\n"
-                "/daily on|off|status\n"
-                "/dailytime HH:MM\n"
-                "/dailychat <chat_id>\n"
-                "/sendin <minutes> <text>\n"
-                "/queue\n"
-                "/cancel <id>\n"
-                "/sendnow <text>\n"
-                "/state"
-            )
-        elif text.startswith("/sending "):
-            arg = text.split(maxsplit=1)[1].lower()
-            if arg == "on":
-                state["sending_enabled"] = True
-                await reply("✅ Sending ON")
-                changed = True
-            elif arg == "off":
-                state["sending_enabled"] = False
-                await reply("🛑 Sending OFF")
-                changed = True
-            elif arg == "status":
-                await reply(f"Sending: {'ON' if state['sending_enabled'] else 'OFF'}")
-            else:
-                await reply("Формат: /sending on|off|status")
-        elif text.startswith("/daily "):
-            arg = text.split(maxsplit=1)[1].lower()
-            if arg == "on":
-                state["daily_enabled"] = True
-                await reply("✅ Daily ON")
-                changed = True
-            elif arg == "off":
-                state["daily_enabled"] = False
-                await reply("🛑 Daily OFF")
-                changed = True
-            elif arg == "status":
-                await reply(
-                    f"Daily: {'ON' if state['daily_enabled'] else 'OFF'} | "
-                    f"{state['daily_hour']:02d}:{state['daily_minute']:02d} | chat {state['daily_chat_id']}"
-                )
-            else:
-                await reply("Формат: /daily on|off|status")
-        elif text.startswith("/dailytime "):
-            try:
-                h, mm = parse_hhmm(text.split(maxsplit=1)[1].strip())
-                state["daily_hour"] = h
-                state["daily_minute"] = mm
-                changed = True
-                await reply(f"✅ Daily time: {h:02d}:{mm:02d}")
-            except Exception:
-                await reply("Формат: /dailytime HH:MM")
-        elif text.startswith("/dailychat "):
-            try:
-                cid = int(text.split(maxsplit=1)[1].strip())
-                state["daily_chat_id"] = cid
-                changed = True
-                await reply(f"✅ Daily chat: {cid}")
-            except Exception:
-                await reply("Формат: /dailychat <chat_id>")
-        elif text.startswith("/sendin "):
-            parts = text.split(maxsplit=2)
-            if len(parts) < 3:
-                await reply("Формат: /sendin <minutes> <text>")
+async def poll(ctx: PollerContext, own_ids: set) -> None:
+    with metrics.phase("commands"):
+        await poll_commands(ctx, own_ids)
+    # After the commands, which may have scheduled something. When nothing is
+    # due the poll costs the one command request: no claims, no sends.
+    with metrics.phase("plan"):
+        todo = plan(ctx.state, time.time())
+    if todo["scheduled"]:
+        with metrics.phase("scheduled"):
+            await poll_scheduled(ctx)
+    if todo["rules"]:
+        with metrics.phase("rules"):
+            await poll_rules(ctx)
+    if not any(todo.values()):
+        metrics.inc("idle_polls")
+    metrics.inc("polls")
+
+
+async def poll_commands(ctx: PollerContext, own_ids: set) -> None:
+    state = ctx.state
+    store = ctx.store
+    pipeline = ctx.pipeline
+
+    # 1) Stream control-chat messages newer than the watermark, oldest first.
+    # Telethon pages through them, so an idle run is a single empty request.
+    last_seen = int(state["last_command_id"])
+    control = await pipeline.peer(ctx.account.control_chat_id)
+    if not last_seen:
+        # A fresh state starts at the chat's latest message: its history holds
+        # old commands (/sendnow, /sending off...) that must not run again.
+        # Ids start at 1, so an empty chat still lets every new message in.
+        last_seen = 1
+        async for m in ctx.client.iter_messages(control, limit=1):
+            last_seen = max(last_seen, int(m.id))
+        print(f"Fresh state: commands up to message {last_seen} are skipped", flush=True)
+    try:
+        async for m in ctx.client.iter_messages(control, offset_id=last_seen, reverse=True):
+            # Past this message even if its handler fails: the effects of the
+            # ones handled so far are saved, so none of them may run twice.
+            last_seen = max(last_seen, int(m.id))
+            if m.id not in own_ids and m.out and m.message:
+                text = m.message.strip()
+                if text.startswith("/"):
+                    ctx.message = m
+                    try:
+                        await dispatch(ctx, text)
+                    finally:
+                        ctx.message = None
+    finally:
+        # Also when the stream breaks off part way.
+        if last_seen != int(state["last_command_id"]):
+            store.set(state, "last_command_id", last_seen)
+
+
+async def poll_scheduled(ctx: PollerContext) -> None:
+    state = ctx.state
+    store = ctx.store
+    pipeline = ctx.pipeline
+    reply = ctx.reply
+
+    # 2) Execute due scheduled messages; hand the ones due before the next
+    # run to Telegram's own scheduler so they go out on time. The queue is
+    # ordered by send_at, so only the head up to the horizon is visited.
+    # Group items fan out into one job per recipient.
+    queue = state["scheduled"]
+    tz = ctx.tz
+    now = time.time()
+    due_until = now + MIN_HANDOFF_SECONDS
+    horizon = max(due_until, now + LOOKAHEAD_SECONDS)
+    jobs = []
+    handoffs = set()
+    for row in queue.window(horizon):
+        sid = row["id"]
+        ts = queue.ts(sid)
+        chats = recipients(state, row)
+        if not chats:
+            # Everything was handed off to Telegram (or the group is empty).
+            if ts <= now:
+                queue.remove(sid)
+                store.record("fire", id=sid)
+        elif ts <= due_until:
+            if state["sending_enabled"]:
+                body = render(state, store, row["text"], datetime.fromtimestamp(ts, tz))
+                jobs += [SendJob((sid, c), c, body, not_before=ts) for c in chats]
             else:
-                try:
-                    mins = int(parts[1])
-                    if mins < 0:
-                        raise ValueError
-                    send_at = now_tz() + timedelta(minutes=mins)
-                    item = {
-                        "id": int(state["next_id"]),
-                        "chat_id": int(state["daily_chat_id"]),
-                        "text": parts[2],
-                        "send_at": send_at.isoformat(),
-                    }
-                    state["next_id"] = int(state["next_id"]) + 1
-                    state["scheduled"].append(item)
-                    changed = True
-                    await reply(f"✅ Заплановано #{item['id']} на {send_at.strftime('%Y-%m-%d %H:%M:%S')}")
-                except Exception:
-                    await reply("minutes має бути числом >= 0")
-        elif text == "/queue":
-            await reply(format_queue(state["scheduled"]))
-        elif text.startswith("/cancel "):
-            try:
-                sid = int(text.split(maxsplit=1)[1].strip())
-                before = len(state["scheduled"])
-                state["scheduled"] = [x for x in state["scheduled"] if x["id"] != sid]
-                if len(state["scheduled"]) < before:
-                    await reply(f"✅ Скасовано #{sid}")
-                    changed = True
-                else:
-                    await reply("Немає такого id")
-            except Exception:
-                await reply("Формат: /cancel <id>")
-        elif text.startswith("/sendnow "):
-            msg = text.split(maxsplit=1)[1]
-            ok = await send_if_enabled(int(state["daily_chat_id"]), msg)
-            await reply("✅ Відправлено зараз." if ok else "🛑 Не відправлено: sending=OFF")
-        elif text == "/state":
+                queue.remove(sid)
+                store.record("fire", id=sid)
+                metrics.inc("skips")
+                await reply(f"🛑 Scheduled #{sid} skipped")
+        elif state["sending_enabled"]:
+            handoffs.add(sid)
+            send_at = datetime.fromtimestamp(ts, tz)
+            body = render(state, store, row["text"], send_at)
+            jobs += [SendJob((sid, c), c, body, {"schedule": send_at}) for c in chats]
+
+    # Delivered items leave the queue; failed recipients stay pending for the
+    # next run and the ones already delivered are not sent again. Rows are
+    # claimed first, so one claimed by another run is left to it.
+    claim_key = lambda job: f"scheduled:{job.key[0]}"
+    jobs = ctx.lease.claimed(jobs, claim_key)
+    results = await ctx.outbox.send_many(pipeline, jobs, lambda job: f"scheduled:{job.key[0]}:{job.chat_id}")
+    ctx.lease.settle(jobs, results, claim_key)
+    store.log_deliveries("scheduled", results)
+    for sid, (sent, failed) in split_results(results).items():
+        row = queue.get(sid)
+        remote = remote_map(row)
+        if sid in handoffs:
+            remote.update((c, m.id) for c, m in sent.items())
+        if not failed and not remote:
+            queue.remove(sid)
+            store.record("fire", id=sid)
+            count = f" ({len(sent)} чатів)" if len(sent) > 1 else ""
+            await reply(f"✅ Scheduled #{sid} sent{count}")
+            continue
+        row = dict(
+            without(row, "remote_id"),
+            pending=list(failed),
+            remote={str(c): m for c, m in remote.items()},
+        )
+        queue.replace(row)
+        store.record("schedule", item=row)
+        if failed:
+            metrics.inc("requeued", len(failed))
+            total = len(sent) + len(failed)
+            error = next(iter(failed.values()))
             await reply(
-                f"sending={'ON' if state['sending_enabled'] else 'OFF'}\n"
-                f"daily={'ON' if state['daily_enabled'] else 'OFF'}\n"
-                f"time={state['daily_hour']:02d}:{state['daily_minute']:02d}\n"
-                f"daily_chat={state['daily_chat_id']}\n"
-                f"queue={len(state['scheduled'])}"
+                f"⚠️ Scheduled #{sid}: {len(failed)}/{total} failed, retry next run: {error}"
             )
         else:
-            handled = False
-
-        if handled:
-            state["last_command_id"] = max(int(state["last_command_id"]), int(m.id))
-            changed = True
-
-    # 2) Execute due scheduled messages
-    due = []
-    keep = []
-    for row in state["scheduled"]:
-        try:
-            send_at = datetime.fromisoformat(row["send_at"])
-        except Exception:
+            send_at = datetime.fromtimestamp(queue.ts(sid), tz)
+            await reply(f"⏱ Scheduled #{sid} handed off for {send_at.strftime('%H:%M:%S')}")
+
+
+async def poll_rules(ctx: PollerContext) -> None:
+    state = ctx.state
+    store = ctx.store
+    pipeline = ctx.pipeline
+    reply = ctx.reply
+
+    # 3) Recurring rules. Each keeps its next fire time cached, so only the
+    # rules due before the lookahead horizon are visited at all. A partial
+    # failure keeps next_at and retries only the pending recipients.
+    rules = state["rules"]
+    tz = ctx.tz
+    now_dt = datetime.now(tz)
+    now = now_dt.timestamp()
+    due_until = now + MIN_HANDOFF_SECONDS
+    jobs = []
+    advanced = {}
+    handoffs = {}
+    for rule in rules.window(max(due_until, now + LOOKAHEAD_SECONDS)):
+        rid = rule["id"]
+        at = datetime.fromtimestamp(rules.ts(rid), tz)
+        active = rule["enabled"] and state["sending_enabled"]
+        chats = recipients(state, rule)
+        if at.timestamp() <= due_until:
+            runs, following = advance(rule, now_dt)
+            advanced[rid] = (runs if active else 0, following)
+            if not advanced[rid][0]:
+                metrics.inc("skips")
+            for n in range(advanced[rid][0]):
+                body = render(state, store, rule["text"], at)
+                jobs += [SendJob((rid, c, n), c, body, not_before=at.timestamp()) for c in chats]
+        elif active and chats:
+            handoffs[rid] = at
+            body = render(state, store, rule["text"], at)
+            jobs += [SendJob((rid, c), c, body, {"schedule": at}) for c in chats]
+
+    claim_key = lambda job: f"rule:{job.key[0]}:{rules.get(job.key[0])['next_at']}"
+    wanted = {job.key[0] for job in jobs}
+    jobs = ctx.lease.claimed(jobs, claim_key)
+    # A run claimed by another owner is its to send: next_at stays.
+    skipped = wanted - {job.key[0] for job in jobs}
+    results = await ctx.outbox.send_many(
+        pipeline, jobs, lambda job: claim_key(job) + "".join(f":{part}" for part in job.key[1:])
+    )
+    ctx.lease.settle(jobs, results, claim_key)
+    store.log_deliveries("rule", results)
+    results = split_results(results)
+    for rid, (runs, following) in advanced.items():
+        if rid in skipped:
+            continue
+        rule = rules.get(rid)
+        label = rule.get("name") or f"#{rid}"
+        sent, failed = results.get(rid, ({}, {}))
+        if failed:
+            rule = dict(rule, pending=list(failed))
+            metrics.inc("requeued", len(failed))
+            rules.replace(rule)
+            store.record("rule", item=rule)
+            error = next(iter(failed.values()))
+            await reply(f"⚠️ Rule {label}: {len(failed)} failed, retry next run: {error}")
+            continue
+        rule = dict(without(rule, "pending"), next_at=following.isoformat())
+        rules.replace(rule)
+        store.record("rule", item=rule)
+        if runs and sent:
+            count = f" x{runs}" if runs > 1 else ""
+            chats = f" ({len(sent)} чатів)" if len(sent) > 1 else ""
+            await reply(f"✅ Rule {label} sent{count}{chats}")
+    for rid, at in handoffs.items():
+        if rid in skipped:
             continue
-        if send_at <= now_tz():
-            due.append(row)
+        rule = rules.get(rid)
+        label = rule.get("name") or f"#{rid}"
+        sent, failed = results.get(rid, ({}, {}))
+        remote = [r for r in rule.get("remote") or [] if datetime.fromisoformat(r["at"]) > now_dt]
+        remote += [{"id": m.id, "chat_id": c, "at": at.isoformat()} for c, m in sent.items()]
+        if failed:
+            # Handed-off recipients are done; the rest are retried next run.
+            rule = dict(rule, pending=list(failed), remote=remote)
+            metrics.inc("requeued", len(failed))
+            error = next(iter(failed.values()))
+            await reply(f"⚠️ Rule {label} handoff failed for {len(failed)}: {error}")
         else:
-            keep.append(row)
-
-    for row in due:
-        ok = await send_if_enabled(int(row["chat_id"]), row["text"])
-        mark = "✅" if ok else "🛑"
-        await reply(f"{mark} Scheduled #{row['id']} {'sent' if ok else 'skipped'}")
-        changed = True
-    if due:
-        state["scheduled"] = keep
-
-    # 3) Daily message once per local date
-    today = now_tz().date().isoformat()
-    if state["daily_enabled"] and state["sending_enabled"]:
-        at_or_after = (
-            now.hour > int(state["daily_hour"]) or
-            (now.hour == int(state["daily_hour"]) and now.minute >= int(state["daily_minute"]))
-        )
-        if at_or_after and state.get("last_daily_date", "") != today:
-            await client.send_message(int(state["daily_chat_id"]), "вогник")
-            state["last_daily_date"] = today
-            changed = True
-            await reply("✅ Daily 'вогник' sent")
-
-    if changed:
-        save_state(state)
-        print("State updated", flush=True)
-    else:
-        print("No changes", flush=True)
+            next_at = cron(rule["spec"]).next_after(at).isoformat()
+            rule = dict(without(rule, "pending"), next_at=next_at, remote=remote)
+            await reply(f"⏱ Rule {label} handed off for {at.strftime('%H:%M')}")
+        rules.replace(rule)
+        store.record("rule", item=rule)
+
 
-    await client.disconnect()
+def make_client(session: str):
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
+
+    return TelegramClient(StringSession(session), API_ID, API_HASH)
+
+
+async def run(client=None, duration: float = 0, interval: float = POLL_INTERVAL, account=None) -> None:
+    metrics.reset()
+    try:
+        await run_account(account or Account.from_env(), client, duration, interval)
+    finally:
+        metrics.emit("gh_poller")
+
+
+async def run_all(accounts: List[Account], clients=None, duration: float = 0, interval: float = POLL_INTERVAL) -> None:
+    """Run every account in this one event loop.
+
+    Each account keeps its own client, send pipeline, lease and state, so one
+    that is slow or failing only delays itself; a run that hangs past its
+    duration plus ACCOUNT_GRACE_SECONDS is cancelled (and still saves).
+    """
+    metrics.reset()
+    clients = clients or [None] * len(accounts)
+    timeout = duration + interval + ACCOUNT_GRACE_SECONDS
+    results = await asyncio.gather(
+        *(
+            asyncio.wait_for(run_account(account, client, duration, interval), timeout)
+            for account, client in zip(accounts, clients)
+        ),
+        return_exceptions=True,
+    )
+    failed = 0
+    for account, result in zip(accounts, results):
+        if isinstance(result, BaseException):
+            failed += 1
+            print(f"{account.tag}Run failed: {result!r}", flush=True)
+    metrics.set("accounts", len(accounts))
+    metrics.set("accounts_failed", failed)
+    metrics.emit("gh_poller")
+    if failed == len(accounts):
+        raise RuntimeError("every account failed")
+
+
+async def run_account(account: Account, client=None, duration: float = 0, interval: float = POLL_INTERVAL) -> None:
+    started = time.perf_counter()
+    store = account.store
+    tag = account.tag
+    # One writer per state file: a run that overlaps another one's lease
+    # does nothing. Taken before loading, which may repair the journal.
+    lease = Lease(store.path)
+    try:
+        lease.acquire()
+    except LeaseHeld as e:
+        print(f"{tag}Skipping run: {e}", flush=True)
+        return
+    try:
+        with metrics.phase("load"):
+            # Parsing a large state would hold up the other accounts' polls.
+            state = await asyncio.to_thread(store.load)
+            lease.verify(state)
+            store.lease = lease
+            outbox = Outbox(store.path).load()
+            migrate_daily(state, store, datetime.now(ZoneInfo(account.timezone)))
+            quarantined = attach_queue(state, store) + attach_queue(state, store, "rules", "next_at")
+        if client is None:
+            client = make_client(account.session)
+        with metrics.phase("connect"):
+            await client.connect()
+            if not await client.is_user_authorized():
+                raise RuntimeError("Session is not authorized. Regenerate SESSION_STRING.")
+        metrics.observe("account_start", time.perf_counter() - started)
+
+        peers = PeerCache(account.peers_path).load()
+        pipeline = SendPipeline(client, peers=peers)
+        writer = DebouncedWriter(store, state)
+        writer.outbox = outbox
+        # Sends a crashed run made without saving them: found in Telegram or
+        # sent again.
+        await outbox.reconcile(client, pipeline.peer)
+    except BaseException:
+        # Nothing was sent yet; the poll loop below cleans up after itself.
+        lease.release()
+        if client is not None:
+            await client.disconnect()
+        raise
+    own_ids = set()
+
+    async def send_reply(text: str) -> None:
+        try:
+            sent = await pipeline.send(account.control_chat_id, text)
+        except Exception as e:
+            print(f"{tag}Reply failed: {e}", flush=True)
+            return
+        own_ids.add(sent.id)
+
+    # Replies are collected for the whole run and sent as a few consolidated
+    # messages; REPLY_PER_EVENT=1 sends each one immediately instead.
+    replies = ReplyBuffer(send_reply)
+    ctx = PollerContext(client, account, state, pipeline, replies, lease, outbox)
+    for row in quarantined:
+        await replies.add(f"⚠️ Row quarantined (bad id/time): {row}")
+    # With --duration the connected client is reused for repeated polls until
+    # the next poll would no longer fit in the remaining time.
+    deadline = time.monotonic() + duration
+    updated = False
+    try:
+        while not lease.lost:
+            try:
+                lease.renew()
+            except LeaseLost as e:
+                print(f"{tag}Stopping: {e}", flush=True)
+                break
+            await poll(ctx, own_ids)
+            with metrics.phase("replies"):
+                await replies.flush()
+            if store.dirty:
+                with metrics.phase("save"):
+                    await writer.flush()
+                updated = True
+            if deadline - time.monotonic() <= interval:
+                break
+            await asyncio.sleep(interval)
+    finally:
+        with metrics.phase("replies"):
+            await replies.flush()
+        # Persist whatever was delivered even if the run is cut short, unless
+        # another run has taken the state over.
+        if store.dirty and not lease.lost:
+            with metrics.phase("save"):
+                await writer.flush()
+            updated = True
+        # An unchanged state still has the hash recorded at acquire.
+        lease.release(state if updated else None)
+        print(f"{tag}State updated" if updated else f"{tag}No changes", flush=True)
+        print(f"{tag}Peer cache: {peers.hits} hits, {peers.misses} resolved", flush=True)
+        peers.save()
+        await client.disconnect()
+        # Totals over all accounts when several run together.
+        metrics.add("scheduled", len(state["scheduled"]))
+        metrics.add("rules", len(state["rules"]))
+        metrics.add("peer_hits", peers.hits)
+        metrics.add("peer_misses", peers.misses)
 
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(run())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=0,
+        help="keep polling for this many seconds over one connection (0 = single poll)",
+    )
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="seconds between polls")
+    parser.add_argument(
+        "--accounts",
+        default=ACCOUNTS_FILE,
+        help="JSON file listing several accounts to run in this process",
+    )
+    args = parser.parse_args()
+    if args.accounts:
+        main = run_all(load_accounts(args.accounts), duration=args.duration, interval=args.interval)
+    else:
+        main = run(duration=args.duration, interval=args.interval)
+    asyncio.run(main)
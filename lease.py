@@ -0,0 +1,238 @@
+"""Write lease and send claims for a state file.
+
+<state>.lease names the one process allowed to write the state and send from
+it, until an expiry it keeps renewing. It also carries a generation, bumped
+on every save and checked before the next one, the content hash of the state
+at release (checked on the next acquire), and claims: before a row is sent
+its key is claimed, and a row claimed by another owner that has not expired
+yet is skipped. A process whose lease was taken over can neither save nor
+claim anything, so it cannot send what the new owner is about to send.
+
+A claim is only kept while it protects something: one whose send failed is
+dropped at once so the next run retries the row, and one whose send went
+through is dropped once a saved state records it. Only a process that dies
+in between leaves its claims to expire.
+
+    python lease.py acquire|release [--owner NAME] [--ttl SECONDS]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows: the lease still works, without a file lock
+    fcntl = None
+
+from metrics import metrics
+from state_store import COLLECTIONS, encode_default
+
+LEASE_SECONDS = int(os.environ.get("LEASE_SECONDS", "900"))
+# Claims outlive the lease so a takeover cannot resend what was just sent.
+CLAIM_SECONDS = int(os.environ.get("CLAIM_SECONDS", "3600"))
+OWNER = os.environ.get("LEASE_OWNER") or f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseHeld(RuntimeError):
+    """Another live owner holds the lease."""
+
+
+class LeaseLost(RuntimeError):
+    """The lease was taken over (or saved by someone else) since we took it."""
+
+
+def state_hash(state: dict) -> str:
+    """Content hash that ignores row order and runtime containers."""
+    canon = {
+        key: sorted(json.dumps(row, sort_keys=True, ensure_ascii=False) for row in value)
+        if key in COLLECTIONS
+        else value
+        for key, value in state.items()
+    }
+    data = json.dumps(canon, sort_keys=True, ensure_ascii=False, default=encode_default)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def fmt_ts(ts: float) -> str:
+    return datetime.fromtimestamp(ts).isoformat(timespec="seconds")
+
+
+@contextmanager
+def locked(path: Path):
+    """The lease file's JSON, read and rewritten under an exclusive lock."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, "r+", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            data = json.loads(f.read() or "{}")
+        except ValueError:
+            data = {}
+        before = dict(data)
+        yield data
+        if data != before:
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(data, ensure_ascii=False, sort_keys=True, indent=2))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class Lease:
+    def __init__(self, state_path, owner: Optional[str] = None, ttl: int = LEASE_SECONDS):
+        state_path = Path(state_path)
+        self.path = state_path.with_name(state_path.name + ".lease")
+        # Looked up per lease, so a test can play a restarted process.
+        self.owner = owner or OWNER
+        self.ttl = ttl
+        self.generation = 0
+        self.lost = False
+        # Claims whose rows were sent but not saved yet: key -> sequence
+        # number, compared with mark() taken before a save.
+        self.unsaved: Dict[str, int] = {}
+        self.seq = 0
+
+    def _live(self, data: dict) -> bool:
+        return bool(data.get("owner")) and data.get("expires", 0) > time.time()
+
+    def _check(self, data: dict) -> None:
+        if data.get("owner") != self.owner or data.get("generation", 0) != self.generation:
+            self.lost = True
+        if self.lost:
+            raise LeaseLost(f"lease on {self.path} now belongs to {data.get('owner')}")
+
+    def acquire(self) -> "Lease":
+        """Take the lease; LeaseHeld if another owner's has not expired yet.
+
+        Taken before the state is loaded: loading may repair the journal,
+        which only the owner may touch. Then pass the state to verify().
+        """
+        with locked(self.path) as data:
+            if self._live(data) and data["owner"] != self.owner:
+                raise LeaseHeld(f"state is leased to {data['owner']} until {fmt_ts(data['expires'])}")
+            self.generation = data.get("generation", 0)
+            data.update(owner=self.owner, expires=time.time() + self.ttl, generation=self.generation)
+        self.lost = False
+        return self
+
+    def verify(self, state: dict) -> None:
+        """Report a loaded state that differs from the one last released."""
+        with locked(self.path) as data:
+            if not data.get("hash"):
+                return
+            current = state_hash(state)
+            if data["hash"] != current:
+                print(f"State differs from the one released at generation {self.generation}", flush=True)
+                # Reported once; a release that saved nothing keeps this hash.
+                data["hash"] = current
+
+    def renew(self) -> None:
+        with locked(self.path) as data:
+            self._check(data)
+            data["expires"] = time.time() + self.ttl
+
+    @contextmanager
+    def saving(self):
+        """Hold the lease across a state write; the generation moves on after it."""
+        with locked(self.path) as data:
+            self._check(data)
+            yield
+            self.generation += 1
+            data.update(generation=self.generation, expires=time.time() + self.ttl)
+
+    def claim(self, keys: Iterable[str], ttl: int = CLAIM_SECONDS) -> Set[str]:
+        """Claim keys before sending them; returns the ones granted to us.
+
+        Nothing is granted once the lease is lost (self.lost tells why).
+        """
+        keys = set(keys)
+        if not keys:
+            return keys
+        now = time.time()
+        with locked(self.path) as data:
+            try:
+                self._check(data)
+            except LeaseLost as e:
+                print(f"Not sending: {e}", flush=True)
+                return set()
+            claims = {k: c for k, c in data.get("claims", {}).items() if c[1] > now}
+            granted = {k for k in keys if k not in claims or claims[k][0] == self.owner}
+            claims.update((k, [self.owner, now + ttl]) for k in granted)
+            data["claims"] = claims
+        return granted
+
+    def claimed(self, jobs: List, key: Callable[[object], str]) -> List:
+        """The jobs whose row (key(job)) could be claimed; the rest are skipped."""
+        keys = {key(job) for job in jobs}
+        granted = self.claim(keys)
+        if len(granted) < len(keys):
+            metrics.inc("claim_skips", len(keys) - len(granted))
+            print(f"Skipped rows claimed elsewhere: {sorted(keys - granted)}", flush=True)
+        return [job for job in jobs if key(job) in granted]
+
+    def settle(self, jobs: List, results: List, key: Callable[[object], str]) -> None:
+        """After sending claimed jobs: drop the claims of rows with a failed
+        recipient (they are retried), keep the rest until saved()."""
+        ok = {(res.key, res.chat_id) for res in results if res.ok}
+        failed = {key(job) for job in jobs if (job.key, job.chat_id) not in ok}
+        for k in {key(job) for job in jobs} - failed:
+            self.seq += 1
+            self.unsaved[k] = self.seq
+        self.unclaim(failed)
+
+    def unclaim(self, keys: Iterable[str]) -> None:
+        keys = set(keys)
+        for k in keys:
+            self.unsaved.pop(k, None)
+        if not keys or self.lost:
+            return
+        with locked(self.path) as data:
+            claims = data.get("claims", {})
+            data["claims"] = {k: c for k, c in claims.items() if k not in keys or c[0] != self.owner}
+
+    def mark(self) -> int:
+        """Taken before a state save starts; pass it to saved() after."""
+        return self.seq
+
+    def saved(self, mark: int) -> None:
+        """Drop the claims of sends made before mark: the saved state has them."""
+        self.unclaim(k for k, seq in self.unsaved.items() if seq <= mark)
+
+    def release(self, state: Optional[dict] = None) -> None:
+        """Give the lease up; with state (just saved) also our claims."""
+        with locked(self.path) as data:
+            if data.get("owner") != self.owner:
+                return
+            data.update(owner=None, expires=0)
+            if state is not None:
+                data["hash"] = state_hash(state)
+                claims = data.get("claims", {})
+                data["claims"] = {k: c for k, c in claims.items() if c[0] != self.owner}
+                self.unsaved.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Take or drop the state lease by hand.")
+    parser.add_argument("action", choices=("acquire", "release"))
+    parser.add_argument("--state", default=os.environ.get("STATE_FILE", "control_state.json"))
+    parser.add_argument("--owner", default=OWNER)
+    parser.add_argument("--ttl", type=int, default=LEASE_SECONDS)
+    args = parser.parse_args()
+    lease = Lease(args.state, args.owner, args.ttl)
+    if args.action == "release":
+        lease.release()
+        sys.exit()
+    try:
+        lease.acquire()
+    except LeaseHeld as e:
+        sys.exit(str(e))
+    print(f"Leased {args.state} to {args.owner} for {args.ttl}s", flush=True)
@@ -0,0 +1,147 @@
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+
+from state_store import write_atomic
+
+# The JSON line always goes to stdout; these add a JSONL file (appended) and a
+# Prometheus textfile (rewritten on every emit).
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_PROM = os.environ.get("METRICS_PROM")
+PROM_PREFIX = "vognyk"
+# Percentiles are taken over the most recent samples of each timing only.
+TIMING_SAMPLES = 10000
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Timing:
+    """Count/sum/max since start plus percentiles over recent samples."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=TIMING_SAMPLES)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def summary(self) -> dict:
+        samples = sorted(self.recent)
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "avg": round(self.sum / self.count, 3) if self.count else 0.0,
+            "p50": round(percentile(samples, 0.5), 3),
+            "p95": round(percentile(samples, 0.95), 3),
+            "p99": round(percentile(samples, 0.99), 3),
+            "max": round(self.max, 3),
+        }
+
+
+class Metrics:
+    """Counters, gauges, per-phase wall time and timings (schedule lateness...)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.time()
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.phases: Dict[str, float] = {}
+        self.timings: Dict[str, Timing] = {}
+
+    def inc(self, name: str, n: float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def add(self, name: str, value: float) -> None:
+        """Add to a gauge, for totals over the accounts of one process."""
+        self.gauges[name] = self.gauges.get(name, 0) + value
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def observe(self, name: str, seconds: float) -> None:
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = Timing()
+        timing.add(seconds)
+
+    def late(self, seconds: float) -> None:
+        """Actual send time minus the time the message was due."""
+        self.observe("lateness", max(seconds, 0.0))
+
+    def snapshot(self, source: str) -> dict:
+        return {
+            "metrics": source,
+            "ts": round(time.time(), 3),
+            "uptime": round(time.time() - self.started, 3),
+            "phases": {k: round(v, 4) for k, v in self.phases.items()},
+            "counters": dict(sorted(self.counters.items())),
+            "gauges": dict(sorted(self.gauges.items())),
+            "timings": {k: t.summary() for k, t in sorted(self.timings.items())},
+        }
+
+    def emit(self, source: str, jsonl: Optional[str] = METRICS_FILE, prom: Optional[str] = METRICS_PROM) -> dict:
+        data = self.snapshot(source)
+        line = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        print(line, flush=True)
+        if jsonl:
+            with open(jsonl, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        if prom:
+            write_atomic(Path(prom), prometheus(data))
+        return data
+
+
+def prometheus(data: dict) -> str:
+    label = f'source="{data["metrics"]}"'
+    lines = []
+
+    def metric(name: str, kind: str, samples) -> None:
+        lines.append(f"# TYPE {PROM_PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{PROM_PREFIX}_{name}{{{labels}}} {value}")
+
+    metric("uptime_seconds", "gauge", [(label, data["uptime"])])
+    metric(
+        "phase_seconds_total",
+        "counter",
+        [(f'{label},phase="{k}"', v) for k, v in data["phases"].items()],
+    )
+    for name, value in data["counters"].items():
+        metric(f"{name}_total", "counter", [(label, value)])
+    for name, value in data["gauges"].items():
+        metric(name, "gauge", [(label, value)])
+    for timing, summary in data["timings"].items():
+        name = f"{PROM_PREFIX}_{timing}_seconds"
+        lines.append(f"# TYPE {name} summary")
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+            lines.append(f'{name}{{{label},quantile="{quantile}"}} {summary[key]}')
+        lines.append(f"{name}_sum{{{label}}} {summary['sum']}")
+        lines.append(f"{name}_count{{{label}}} {summary['count']}")
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
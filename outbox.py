@@ -0,0 +1,228 @@
+"""Crash-safe record of sends: <state>.outbox, one JSON record per line.
+
+Each send of a scheduled row or rule run is appended as pending (and
+fsynced) before its request goes out, and confirmed with the Telegram
+message id once it returns. A record only matters until the state that
+reflects its send has been saved; after that it is dropped.
+
+A process that dies between sending and saving leaves records behind. The
+next one answers a confirmed record's job from the record instead of sending
+again, and looks a still-pending one up among the chat's recent (or
+scheduled) messages before deciding to resend it.
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+from metrics import metrics
+from send_pipeline import SendJob, SendPipeline, SendResult
+from state_store import write_atomic
+
+# Records older than this are dropped on load whatever their state.
+OUTBOX_SECONDS = int(os.environ.get("OUTBOX_SECONDS", "86400"))
+# Recent messages per chat searched for an unconfirmed send.
+RECONCILE_LIMIT = int(os.environ.get("OUTBOX_RECONCILE_LIMIT", "200"))
+# Allowed difference between our clock and Telegram's message dates.
+RECONCILE_SLACK = 60
+
+
+def dumps(rec: dict) -> str:
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+class Outbox:
+    def __init__(self, state_path, ttl: int = OUTBOX_SECONDS):
+        state_path = Path(state_path)
+        self.path = state_path.with_name(state_path.name + ".outbox")
+        self.ttl = ttl
+        self.entries: Dict[str, dict] = {}
+        self.lines = 0
+        # Confirmations are numbered so a save can drop exactly the ones it
+        # covers (see mark/applied).
+        self.seq = 0
+
+    def load(self) -> "Outbox":
+        self.entries = {}
+        self.lines = 0
+        if not self.path.exists():
+            return self
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+                self.lines += 1
+                self._apply(rec)
+        # Drop a torn tail left by a crash mid-append.
+        if good < self.path.stat().st_size:
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+        cutoff = time.time() - self.ttl
+        self.entries = {k: e for k, e in self.entries.items() if e["ts"] > cutoff}
+        if self.entries:
+            print(f"Outbox: {len(self.entries)} sends from an earlier run not saved yet", flush=True)
+        return self
+
+    def _apply(self, rec: dict) -> None:
+        op = rec.pop("op")
+        if op == "pending":
+            self.entries[rec["key"]] = rec
+        elif op == "sent" and rec["key"] in self.entries:
+            self.entries[rec["key"]]["msg_id"] = rec["msg_id"]
+        elif op == "drop":
+            self.entries.pop(rec["key"], None)
+
+    def _append(self, records: List[dict], sync: bool) -> None:
+        if not records:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(dumps(rec) for rec in records))
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        self.lines += len(records)
+        for rec in records:
+            self._apply(dict(rec))
+
+    def _confirm(self, key: str) -> None:
+        self.seq += 1
+        self.entries[key]["seq"] = self.seq
+
+    async def send_many(
+        self, pipeline: SendPipeline, jobs: List[SendJob], key: Callable[[SendJob], str]
+    ) -> List[SendResult]:
+        """pipeline.send_many, except for jobs a record already confirms."""
+        results = []
+        todo = []
+        for job in jobs:
+            entry = self.entries.get(key(job))
+            if entry is not None and entry.get("msg_id"):
+                # Sent by a run that did not get to save it: report the
+                # delivery again so this run's state catches up.
+                self._confirm(key(job))
+                message = SimpleNamespace(id=entry["msg_id"])
+                results.append(SendResult(job.key, job.chat_id, True, message=message))
+            else:
+                todo.append(job)
+        if results:
+            metrics.inc("outbox_replayed", len(results))
+        now = time.time()
+        self._append(
+            [
+                {
+                    "op": "pending",
+                    "key": key(job),
+                    "chat_id": job.chat_id,
+                    "text": job.text,
+                    "schedule": job.kwargs["schedule"].isoformat() if "schedule" in job.kwargs else None,
+                    "ts": now,
+                }
+                for job in todo
+            ],
+            sync=True,
+        )
+        sent = await pipeline.send_many(todo)
+        # A confirmation lost in a crash only costs a lookup, so no fsync.
+        self._append(
+            [
+                {"op": "sent", "key": key(job), "msg_id": res.message.id}
+                if res.ok
+                else {"op": "drop", "key": key(job)}
+                for job, res in zip(todo, sent)
+            ],
+            sync=False,
+        )
+        for job, res in zip(todo, sent):
+            if res.ok:
+                self._confirm(key(job))
+        return results + sent
+
+    def mark(self) -> int:
+        """Taken before a state save starts; pass it to applied() after."""
+        return self.seq
+
+    def applied(self, mark: int) -> None:
+        """Drop the confirmations made before mark: the saved state has them."""
+        self.entries = {
+            k: e for k, e in self.entries.items() if not (e.get("msg_id") and e.get("seq", mark + 1) <= mark)
+        }
+        if not self.entries:
+            if self.lines:
+                self.path.unlink(missing_ok=True)
+                self.lines = 0
+        elif self.lines > 4 * len(self.entries) + 64:
+            self.rewrite()
+
+    def rewrite(self) -> None:
+        records = []
+        for entry in self.entries.values():
+            records.append({"op": "pending", **{k: v for k, v in entry.items() if k not in ("msg_id", "seq")}})
+            if entry.get("msg_id"):
+                records.append({"op": "sent", "key": entry["key"], "msg_id": entry["msg_id"]})
+        write_atomic(self.path, "".join(dumps(rec) for rec in records))
+        self.lines = len(records)
+
+    async def reconcile(self, client, peer: Callable) -> None:
+        """Settle sends an earlier process started but never confirmed.
+
+        Each is looked for among its chat's latest outgoing messages (or its
+        scheduled ones, for a handoff) by text and time; found ones count as
+        sent, the rest are dropped so they are sent again. peer(chat_id) gives
+        the input peer.
+        """
+        unconfirmed = defaultdict(list)
+        for entry in self.entries.values():
+            if not entry.get("msg_id"):
+                unconfirmed[entry["chat_id"]].append(entry)
+        if not unconfirmed:
+            return
+        records = []
+        found = 0
+        for chat_id, entries in unconfirmed.items():
+            try:
+                target = await peer(chat_id)
+                recent = [m async for m in client.iter_messages(target, limit=RECONCILE_LIMIT) if m.out]
+                scheduled = []
+                if any(e["schedule"] for e in entries):
+                    scheduled = [m async for m in client.iter_messages(target, scheduled=True)]
+            except Exception as e:
+                # Left pending: the next send of the row goes out again.
+                print(f"Outbox: cannot check chat {chat_id}: {e}", flush=True)
+                continue
+            taken = set()
+            for entry in sorted(entries, key=lambda e: e["ts"]):
+                msg = find_sent(entry, scheduled if entry["schedule"] else recent, taken)
+                if msg is None:
+                    records.append({"op": "drop", "key": entry["key"]})
+                    continue
+                taken.add(msg.id)
+                found += 1
+                records.append({"op": "sent", "key": entry["key"], "msg_id": msg.id})
+        self._append(records, sync=True)
+        total = sum(len(entries) for entries in unconfirmed.values())
+        metrics.inc("outbox_found", found)
+        metrics.inc("outbox_resend", len(records) - found)
+        print(f"Outbox: {found}/{total} unconfirmed sends found in Telegram, {len(records) - found} to resend", flush=True)
+
+
+def find_sent(entry: dict, messages: List, taken: set) -> Optional[object]:
+    """The message an unconfirmed send produced, if any: same text, and
+    sent after the record was written (or scheduled for the same time)."""
+    if entry["schedule"]:
+        due = datetime.fromisoformat(entry["schedule"]).timestamp()
+        fits = lambda m: abs(m.date.timestamp() - due) < 1
+    else:
+        fits = lambda m: m.date.timestamp() >= entry["ts"] - RECONCILE_SLACK
+    for m in messages:
+        if m.id not in taken and m.message == entry["text"] and fits(m):
+            return m
+    return None
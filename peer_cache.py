@@ -0,0 +1,140 @@
+import asyncio
+import json
+from functools import lru_cache
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, Union
+
+from state_store import write_atomic
+
+
+class PeerIdInvalidError(Exception):
+    def __init__(self, request=None):
+        self.request = request
+        super().__init__("An invalid Peer was used")
+
+
+class FloodWaitError(Exception):
+    def __init__(self, request=None, capture=0):
+        self.request = request
+        self.seconds = int(capture)
+        super().__init__(f"A wait of {self.seconds} seconds is required")
+
+
+@lru_cache(maxsize=None)
+def telethon_api() -> SimpleNamespace:
+    """Telethon's errors and TL types, imported on first use.
+
+    Importing Telethon takes longer than a whole idle run, so nothing imports
+    it until a client or one of its errors is actually needed.
+    """
+    try:
+        from telethon import errors
+        from telethon.tl import types
+    except ImportError:  # offline harness (fake_telegram) without Telethon installed
+        errors = SimpleNamespace(
+            PeerIdInvalidError=PeerIdInvalidError,
+            ChannelInvalidError=PeerIdInvalidError,
+            FloodWaitError=FloodWaitError,
+        )
+        types = None
+    return SimpleNamespace(errors=errors, types=types)
+
+
+def stale_peer_errors() -> tuple:
+    """What Telegram answers when a cached access hash no longer works;
+    ValueError is Telethon's "Could not find the input entity"."""
+    errors = telethon_api().errors
+    return (errors.PeerIdInvalidError, errors.ChannelInvalidError, ValueError)
+
+
+def encode_peer(peer) -> dict:
+    return peer.to_dict() if hasattr(peer, "to_dict") else dict(peer)
+
+
+def decode_peer(data: dict):
+    tl_types = telethon_api().types
+    if tl_types is None:
+        return data
+    cls = getattr(tl_types, data["_"])
+    return cls(**{k: v for k, v in data.items() if k != "_"})
+
+
+class PeerCache:
+    """chat id -> input peer, persisted next to the state file.
+
+    A fresh StringSession knows no access hashes, so every run would pay for
+    resolving its peers again. Cached peers are handed to send_message
+    directly; a stale one is evicted and resolved again on the next send.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._raw: Dict[str, dict] = {}
+        self._peers: Dict[int, Any] = {}
+        self._dialogs_loaded = False
+        self._lock = asyncio.Lock()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> "PeerCache":
+        try:
+            self._raw = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            self._raw = {}
+        except ValueError:
+            print(f"Peer cache {self.path} is corrupt, starting empty", flush=True)
+            self._raw = {}
+        return self
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        write_atomic(self.path, json.dumps(self._raw, ensure_ascii=False, sort_keys=True))
+        self.dirty = False
+
+    def put(self, chat_id: int, peer) -> None:
+        data = encode_peer(peer)
+        if self._raw.get(str(chat_id)) != data:
+            self._raw[str(chat_id)] = data
+            self.dirty = True
+        self._peers[chat_id] = peer
+
+    def evict(self, chat_id: int) -> None:
+        self._peers.pop(chat_id, None)
+        if self._raw.pop(str(chat_id), None) is not None:
+            self.dirty = True
+
+    def cached(self, chat_id: int):
+        peer = self._peers.get(chat_id)
+        if peer is None and str(chat_id) in self._raw:
+            peer = self._peers[chat_id] = decode_peer(self._raw[str(chat_id)])
+        return peer
+
+    async def get(self, client, chat_id: int):
+        """Input peer for chat_id; falls back to the raw id if unresolvable."""
+        peer = self.cached(chat_id)
+        if peer is not None:
+            self.hits += 1
+            return peer
+        self.misses += 1
+        try:
+            peer = await client.get_input_entity(chat_id)
+        except ValueError:
+            # Unknown to this session: one dialogs listing fills in every
+            # peer the account can see.
+            await self._load_dialogs(client)
+            peer = self.cached(chat_id)
+            if peer is None:
+                return chat_id
+        self.put(chat_id, peer)
+        return peer
+
+    async def _load_dialogs(self, client) -> None:
+        async with self._lock:
+            if self._dialogs_loaded:
+                return
+            self._dialogs_loaded = True
+            async for dialog in client.iter_dialogs():
+                self.put(dialog.id, dialog.input_entity)
@@ -0,0 +1,202 @@
+import bisect
+import os
+import re
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import FrozenSet, Optional, Tuple
+
+from state_store import StateStore
+from targets import target_label
+
+CATCHUP_POLICIES = ("once", "all", "skip")
+# "skip" still fires a run that is only this late; older runs are dropped.
+GRACE_SECONDS = int(os.environ.get("RULE_GRACE_SECONDS", "120"))
+# Upper bound for "all", so a long outage does not flood the chat.
+MAX_CATCHUP = int(os.environ.get("RULE_MAX_CATCHUP", "50"))
+
+LEGACY_DAILY_KEYS = ("daily_enabled", "daily_hour", "daily_minute", "last_daily_date", "daily_remote")
+
+FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+HHMM = re.compile(r"^(\d{1,2}):(\d{2})$")
+
+
+def parse_field(value: str, lo: int, hi: int) -> FrozenSet[int]:
+    values = set()
+    for part in value.split(","):
+        body, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if body == "*":
+            start, end = lo, hi
+        elif "-" in body:
+            start, end = (int(x) for x in body.split("-", 1))
+        else:
+            start = int(body)
+            end = hi if step != 1 else start
+        if step < 1 or not (lo <= start <= end <= hi):
+            raise ValueError(f"bad cron field: {value}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class Cron:
+    """Five-field cron spec (minute hour day month weekday), local wall time."""
+
+    def __init__(self, spec: str):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError("cron spec needs 5 fields")
+        minutes, hours, days, months, weekdays = (
+            parse_field(f, lo, hi) for f, (lo, hi) in zip(fields, FIELD_RANGES)
+        )
+        self.spec = " ".join(fields)
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        self.weekdays = frozenset(d % 7 for d in weekdays)  # 0 = Sunday
+        # Like cron: when both day fields are restricted, either may match.
+        self.either_day = fields[2] != "*" and fields[4] != "*"
+
+    def day_matches(self, day: date) -> bool:
+        if day.month not in self.months:
+            return False
+        dom = day.day in self.days
+        dow = day.isoweekday() % 7 in self.weekdays
+        return dom or dow if self.either_day else dom and dow
+
+    def matches(self, when: datetime) -> bool:
+        return (
+            when.minute in self.minutes
+            and when.hour in self.hours
+            and self.day_matches(when.date())
+        )
+
+    def next_after(self, after: datetime) -> datetime:
+        """First matching minute strictly after `after`, in its timezone."""
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.date()
+        # Five years covers every satisfiable spec, including Feb 29.
+        for _ in range(366 * 5):
+            if self.day_matches(day):
+                first_day = day == start.date()
+                for hour in self.hours:
+                    if first_day and hour < start.hour:
+                        continue
+                    i = 0
+                    if first_day and hour == start.hour:
+                        i = bisect.bisect_left(self.minutes, start.minute)
+                    if i < len(self.minutes):
+                        return datetime(
+                            day.year, day.month, day.day, hour, self.minutes[i], tzinfo=after.tzinfo
+                        )
+            day += timedelta(days=1)
+        raise ValueError(f"cron spec never fires: {self.spec}")
+
+
+@lru_cache(maxsize=256)
+def cron(spec: str) -> Cron:
+    return Cron(spec)
+
+
+def parse_spec(value: str) -> str:
+    """Normalize "HH:MM" or a 5-field cron spec; ValueError if invalid."""
+    m = HHMM.match(value.strip())
+    if m:
+        spec = f"{int(m.group(2))} {int(m.group(1))} * * *"
+    else:
+        spec = " ".join(value.split())
+    c = cron(spec)
+    c.next_after(datetime(2000, 1, 1))
+    return c.spec
+
+
+def new_rule(
+    rid: int,
+    spec: str,
+    text: str,
+    target: dict,
+    now: datetime,
+    name: Optional[str] = None,
+    catchup: str = "once",
+    enabled: bool = True,
+) -> dict:
+    rule = {
+        "id": rid,
+        "spec": spec,
+        "text": text,
+        **target,
+        "catchup": catchup,
+        "enabled": enabled,
+        "next_at": cron(spec).next_after(now).isoformat(),
+    }
+    if name:
+        rule["name"] = name
+    return rule
+
+
+def advance(rule: dict, now: datetime) -> Tuple[int, datetime]:
+    """For a due rule: how many sends to make now, and the next fire time."""
+    c = cron(rule["spec"])
+    # next_at keeps a fixed offset; in now's zone the next fire times follow
+    # the local clock across a DST change.
+    at = datetime.fromisoformat(rule["next_at"]).astimezone(now.tzinfo)
+    following = c.next_after(max(at, now))
+    policy = rule.get("catchup", "once")
+    if policy == "all":
+        runs = 1
+        at = c.next_after(at)
+        while at <= now and runs < MAX_CATCHUP:
+            runs += 1
+            at = c.next_after(at)
+    elif policy == "skip":
+        runs = 1 if (now - at).total_seconds() <= GRACE_SECONDS else 0
+    else:
+        runs = 1
+    return runs, following
+
+
+def format_rules(rules) -> str:
+    if not len(rules):
+        return "Правил немає."
+    lines = []
+    for r in rules:
+        name = f" ({r['name']})" if r.get("name") else ""
+        state = "ON" if r.get("enabled", True) else "OFF"
+        lines.append(
+            f"#{r['id']}{name} | {state} | {r['spec']} | next {r['next_at']} | "
+            f"{target_label(r)} | {r.get('catchup', 'once')} | {r['text']}"
+        )
+    return "\n".join(lines)
+
+
+def migrate_daily(state: dict, store: StateStore, now: datetime) -> Optional[dict]:
+    """Turn the old daily_* settings into a recurring rule named "daily".
+
+    Runs once: a state that already has "rules" only loses the legacy keys.
+    """
+    rule = None
+    if "rules" not in state:
+        spec = parse_spec(f"{int(state.get('daily_hour', 4))}:{int(state.get('daily_minute', 0)):02d}")
+        rid = int(state.get("next_rule_id", 1))
+        rule = new_rule(
+            rid,
+            spec,
+            "вогник",
+            {"chat_id": int(state["daily_chat_id"])},
+            now,
+            name="daily",
+            enabled=bool(state.get("daily_enabled", True)),
+        )
+        last = state.get("last_daily_date")
+        if last:
+            # Resume after the last day already covered, as the old code did.
+            done = datetime.fromisoformat(last).replace(hour=23, minute=59, tzinfo=now.tzinfo)
+            rule["next_at"] = cron(spec).next_after(done).isoformat()
+        remote = state.get("daily_remote")
+        if remote and datetime.fromisoformat(remote["at"]) > now:
+            rule["remote"] = [{k: remote[k] for k in ("id", "chat_id", "at")}]
+        store.set(state, "rules", [rule])
+        store.set(state, "next_rule_id", rid + 1)
+    for key in LEGACY_DAILY_KEYS:
+        store.unset(state, key)
+    return rule
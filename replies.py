@@ -0,0 +1,47 @@
+import os
+from typing import Awaitable, Callable, Iterable, List
+
+MAX_MESSAGE_LEN = 4096
+REPLY_PER_EVENT = os.environ.get("REPLY_PER_EVENT", "0") == "1"
+
+
+def chunk_text(parts: Iterable[str], limit: int = MAX_MESSAGE_LEN) -> List[str]:
+    chunks: List[str] = []
+    current = ""
+    for part in parts:
+        for line in part.split("\n"):
+            while len(line) > limit:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(line[:limit])
+                line = line[limit:]
+            if current and len(current) + 1 + len(line) > limit:
+                chunks.append(current)
+                current = line
+            else:
+                current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class ReplyBuffer:
+    """Collects control-chat replies and sends them as a few long messages."""
+
+    def __init__(self, send: Callable[[str], Awaitable[None]], per_event: bool = REPLY_PER_EVENT):
+        self.send = send
+        self.per_event = per_event
+        self._parts: List[str] = []
+
+    async def add(self, text: str) -> None:
+        if self.per_event:
+            for chunk in chunk_text([text]):
+                await self.send(chunk)
+        else:
+            self._parts.append(text)
+
+    async def flush(self) -> None:
+        parts, self._parts = self._parts, []
+        for chunk in chunk_text(parts):
+            await self.send(chunk)
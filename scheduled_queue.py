@@ -0,0 +1,135 @@
+import bisect
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from state_store import StateStore
+
+
+def parse_ts(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+def target_key(row: dict) -> str:
+    """"@group" or the chat id, as used by /queue chat:<...>."""
+    return f"@{row['group']}" if "group" in row else str(row.get("chat_id"))
+
+
+class ScheduledQueue:
+    """Scheduled rows kept in send_at order, with an id index.
+
+    send_at is parsed once on insert; due and near-term rows are found with
+    bisect, so a poll costs O(log n + due) instead of a walk over the queue.
+    Iteration yields rows in send_at order, which is also how they persist.
+    A second set of sorted keys per target serves filtered, paged listings.
+    Recurring rules reuse it keyed on their cached next_at.
+    """
+
+    def __init__(self, field: str = "send_at") -> None:
+        self.field = field
+        self._keys: List[Tuple[float, int]] = []
+        self._rows: Dict[int, dict] = {}
+        self._ts: Dict[int, float] = {}
+        self._targets: Dict[str, List[Tuple[float, int]]] = {}
+
+    @classmethod
+    def build(cls, rows, field: str = "send_at") -> Tuple["ScheduledQueue", List[dict]]:
+        queue = cls(field)
+        bad = []
+        for row in rows:
+            try:
+                sid = int(row["id"])
+                ts = parse_ts(row[field])
+            except Exception:
+                bad.append(row)
+                continue
+            queue._rows[sid] = row
+            queue._ts[sid] = ts
+            queue._keys.append((ts, sid))
+            queue._targets.setdefault(target_key(row), []).append((ts, sid))
+        queue._keys.sort()
+        for keys in queue._targets.values():
+            keys.sort()
+        return queue, bad
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self) -> Iterator[dict]:
+        return (self._rows[sid] for _, sid in self._keys)
+
+    def copy(self) -> List[dict]:
+        return list(self)
+
+    def get(self, sid: int) -> Optional[dict]:
+        return self._rows.get(sid)
+
+    def ts(self, sid: int) -> float:
+        return self._ts[sid]
+
+    def next_ts(self, after: Optional[float] = None) -> Optional[float]:
+        """The earliest send_at, or the earliest one later than after."""
+        i = 0 if after is None else bisect.bisect_right(self._keys, (after, float("inf")))
+        return self._keys[i][0] if i < len(self._keys) else None
+
+    def append(self, row: dict) -> None:
+        ts = parse_ts(row[self.field])
+        sid = int(row["id"])
+        if sid in self._rows:
+            self.remove(sid)
+        self._rows[sid] = row
+        self._ts[sid] = ts
+        bisect.insort(self._keys, (ts, sid))
+        bisect.insort(self._targets.setdefault(target_key(row), []), (ts, sid))
+
+    def replace(self, row: dict) -> None:
+        sid = int(row["id"])
+        old = self._rows.get(sid)
+        if old is not None and row[self.field] == old[self.field] and target_key(row) == target_key(old):
+            self._rows[sid] = row
+        else:
+            self.append(row)
+
+    def _unindex(self, row: dict, key: Tuple[float, int]) -> None:
+        target = target_key(row)
+        keys = self._targets[target]
+        del keys[bisect.bisect_left(keys, key)]
+        if not keys:
+            del self._targets[target]
+
+    def remove(self, sid: int) -> Optional[dict]:
+        row = self._rows.pop(sid, None)
+        if row is None:
+            return None
+        key = (self._ts.pop(sid), sid)
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        self._unindex(row, key)
+        return row
+
+    def window(self, until: float) -> List[dict]:
+        """Rows with send_at <= until, oldest first (not removed)."""
+        end = bisect.bisect_right(self._keys, (until, float("inf")))
+        return [self._rows[sid] for _, sid in self._keys[:end]]
+
+    def page(
+        self, start: int, count: int, until: Optional[float] = None, target: Optional[str] = None
+    ) -> Tuple[List[dict], int]:
+        """Rows [start, start + count) of the ordered view, and the view's size.
+
+        The view is the whole queue or one target's rows, cut at send_at <=
+        until; only the returned rows are touched.
+        """
+        keys = self._keys if target is None else self._targets.get(target, [])
+        total = len(keys) if until is None else bisect.bisect_right(keys, (until, float("inf")))
+        return [self._rows[sid] for _, sid in keys[start : min(start + count, total)]], total
+
+
+def attach_queue(
+    state: dict, store: StateStore, key: str = "scheduled", field: str = "send_at"
+) -> List[dict]:
+    """Swap state[key] for a ScheduledQueue; quarantine unparsable rows."""
+    queue, bad = ScheduledQueue.build(state.get(key) or [], field)
+    state[key] = queue
+    for row in bad:
+        state.setdefault("quarantine", []).append(row)
+        store.record("quarantine", key=key, item=row)
+    return bad
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+from metrics import metrics
+from peer_cache import PeerCache, stale_peer_errors, telethon_api
+
+SEND_CONCURRENCY = int(os.environ.get("SEND_CONCURRENCY", "8"))
+# Telegram allows roughly 30 messages/s per account and about one per second
+# in a single chat; stay a little under both.
+GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "25"))
+PER_CHAT_RATE = float(os.environ.get("SEND_PER_CHAT_RATE", "1"))
+PER_CHAT_BURST = float(os.environ.get("SEND_PER_CHAT_BURST", "3"))
+MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "3"))
+MAX_FLOOD_WAIT = int(os.environ.get("SEND_MAX_FLOOD_WAIT", "300"))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclass
+class SendJob:
+    key: Any
+    chat_id: int
+    text: str
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    not_before: Optional[float] = None  # epoch seconds
+
+
+@dataclass
+class SendResult:
+    key: Any
+    chat_id: int
+    ok: bool
+    message: Any = None
+    error: Optional[BaseException] = None
+
+
+class SendPipeline:
+    """Outbound sends with bounded concurrency, token buckets and FloodWait retry."""
+
+    def __init__(
+        self,
+        client,
+        concurrency: int = SEND_CONCURRENCY,
+        global_rate: float = GLOBAL_RATE,
+        per_chat_rate: float = PER_CHAT_RATE,
+        per_chat_burst: float = PER_CHAT_BURST,
+        max_retries: int = MAX_RETRIES,
+        max_flood_wait: int = MAX_FLOOD_WAIT,
+        peers: Optional[PeerCache] = None,
+    ):
+        self.client = client
+        self.peers = peers
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.max_flood_wait = max_flood_wait
+        self._global = TokenBucket(global_rate, max(global_rate, 1))
+        self._chats: Dict[int, TokenBucket] = {}
+        self._slots = asyncio.Semaphore(concurrency)
+        self._paused_until = 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def peer(self, chat_id: int):
+        if self.peers is None:
+            return chat_id
+        return await self.peers.get(self.client, chat_id)
+
+    async def send(self, chat_id: int, text: str, **kwargs):
+        attempt = 0
+        refreshed = False
+        while True:
+            # Wait for the chat's own budget before taking a slot, so one busy
+            # chat cannot occupy every slot while others are ready.
+            await self._chat_bucket(chat_id).acquire()
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            async with self._slots:
+                await self._global.acquire()
+                try:
+                    msg = await self.client.send_message(await self.peer(chat_id), text, **kwargs)
+                    metrics.inc("sends")
+                    return msg
+                # Evaluated only once something was raised, so Telethon is not
+                # imported before the first send.
+                except stale_peer_errors():
+                    if self.peers is None or refreshed:
+                        raise
+                    # The cached access hash went stale: resolve again, once.
+                    refreshed = True
+                    metrics.inc("retries")
+                    self.peers.evict(chat_id)
+                    print(f"Stale peer for chat {chat_id}, resolving again", flush=True)
+                except telethon_api().errors.FloodWaitError as e:
+                    attempt += 1
+                    if attempt > self.max_retries or e.seconds > self.max_flood_wait:
+                        raise
+                    # A flood wait applies to the whole account, so hold every sender.
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.seconds)
+                    metrics.inc("retries")
+                    metrics.inc("flood_wait_seconds", e.seconds)
+                    print(f"FloodWait {e.seconds}s on chat {chat_id}, retry {attempt}", flush=True)
+
+    async def _run(self, job: SendJob) -> SendResult:
+        if job.not_before is not None:
+            delay = job.not_before - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        try:
+            msg = await self.send(job.chat_id, job.text, **job.kwargs)
+        except Exception as e:
+            metrics.inc("send_failures")
+            return SendResult(job.key, job.chat_id, False, error=e)
+        if "schedule" in job.kwargs:
+            metrics.inc("handoffs")
+        elif job.not_before is not None:
+            metrics.late(time.time() - job.not_before)
+        return SendResult(job.key, job.chat_id, True, message=msg)
+
+    async def send_many(self, jobs: Iterable[SendJob]) -> List[SendResult]:
+        return list(await asyncio.gather(*(self._run(job) for job in jobs)))
@@ -2,8 +2,7 @@ import os
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
-from telethon import TelegramClient
-from telethon.sessions import StringSession
+from recurring import cron, parse_spec
 
 API_ID = int(os.environ["API_ID"])
 API_HASH = os.environ["API_HASH"]
@@ -12,13 +11,14 @@ DAILY_CHAT_ID = int(os.environ.get("DAILY_CHAT_ID", "986095695"))
 TIMEZONE = os.environ.get("TIMEZONE", "Europe/Kyiv")
 TARGET_HOUR = int(os.environ.get("TARGET_HOUR", "4"))
 TARGET_MINUTE = int(os.environ.get("TARGET_MINUTE", "0"))
+# "HH:MM" or a cron spec (m h dom mon dow); TARGET_HOUR/MINUTE are the fallback.
+SCHEDULE = parse_spec(os.environ.get("SCHEDULE") or f"{TARGET_HOUR}:{TARGET_MINUTE:02d}")
 MESSAGE_TEXT = os.environ.get("MESSAGE_TEXT", "вогник")
 FORCE_SEND = os.environ.get("FORCE_SEND", "0") == "1"
 
 
 def should_send_now() -> bool:
-    now = datetime.now(ZoneInfo(TIMEZONE))
-    return now.hour == TARGET_HOUR and now.minute == TARGET_MINUTE
+    return cron(SCHEDULE).matches(datetime.now(ZoneInfo(TIMEZONE)))
 
 
 def main() -> None:
@@ -26,6 +26,11 @@ def main() -> None:
         print("Skip: not target local time yet")
         return
 
+    # Imported only when there is something to send: Telethon alone takes
+    # longer to import than the rest of a skipped run.
+    from telethon import TelegramClient
+    from telethon.sessions import StringSession
+
     with TelegramClient(StringSession(SESSION_STRING), API_ID, API_HASH) as client:
         client.send_message(DAILY_CHAT_ID, MESSAGE_TEXT)
         print(f"Sent '{MESSAGE_TEXT}' successfully")
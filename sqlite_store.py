@@ -0,0 +1,247 @@
+"""SQLite state backend, used when STATE_FILE ends in .db/.sqlite/.sqlite3.
+
+Same interface as StateStore: callers record change ops and flush them, and
+each op becomes a row-level statement (one upsert or delete per record)
+instead of a rewrite of the whole document. Also keeps a delivery log.
+
+load() still reads every row once at startup: both bots keep the queue and
+rules in a ScheduledQueue and answer due scans, /queue pages and filters from
+that in-memory index, so only writes go to SQLite row by row. Reading due and
+page slices on demand would mean a second code path in every caller for the
+one backend; the in-memory copy costs a few hundred bytes a row (see
+bench.py, "queue memory").
+
+    python sqlite_store.py control_state.json control_state.db
+"""
+
+import copy
+import json
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from state_store import COLLECTIONS, ROW_OPS, StateStore, guarded
+
+# Column each collection is ordered and indexed by.
+SORT_FIELDS = {"scheduled": "send_at", "rules": "next_at"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scheduled (
+    id INTEGER PRIMARY KEY,
+    send_at REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scheduled_send_at ON scheduled (send_at, id);
+CREATE TABLE IF NOT EXISTS rules (
+    id INTEGER PRIMARY KEY,
+    next_at REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rules_next_at ON rules (next_at, id);
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    row_id INTEGER,
+    chat_id INTEGER,
+    ok INTEGER NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS deliveries_row ON deliveries (kind, row_id);
+"""
+
+
+def dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=list)
+
+
+def sort_key(row: dict, field: str) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(row[field]).timestamp()
+    except Exception:
+        return None
+
+
+class SqliteStore:
+    def __init__(self, path, defaults: dict):
+        self.path = Path(path)
+        self.defaults = defaults
+        self.lease = None
+        self._pending: List[dict] = []
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._con: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._con is None:
+            fresh = not self.path.exists()
+            # Flushes run in a worker thread (DebouncedWriter); _io_lock
+            # serializes every use of the connection.
+            self._con = sqlite3.connect(self.path, check_same_thread=False)
+            self._con.executescript(SCHEMA)
+            legacy = self.path.with_suffix(".json")
+            if fresh and legacy.exists():
+                import_state(self._con, StateStore(legacy, {}).load())
+                print(f"Migrated {legacy} -> {self.path}", flush=True)
+        return self._con
+
+    def load(self) -> dict:
+        state = copy.deepcopy(self.defaults)
+        with self._io_lock:
+            con = self._connect()
+            for key, value in con.execute("SELECT key, value FROM settings"):
+                state[key] = json.loads(value)
+            for key, field in SORT_FIELDS.items():
+                rows = con.execute(f"SELECT data FROM {key} ORDER BY {field}, id").fetchall()
+                if rows or key in state:
+                    state[key] = [json.loads(data) for (data,) in rows]
+        return state
+
+    def record(self, op: str, **fields) -> None:
+        with self._lock:
+            self._pending.append({"op": op, **fields})
+
+    def set(self, state: dict, key: str, value) -> None:
+        state[key] = value
+        self.record("set", key=key, value=value)
+
+    def unset(self, state: dict, key: str) -> None:
+        if key in state:
+            del state[key]
+            self.record("unset", key=key)
+
+    def log_deliveries(self, kind: str, results: Iterable) -> None:
+        now = time.time()
+        for res in results:
+            row_id = res.key[0] if isinstance(res.key, tuple) else res.key
+            error = None if res.ok else str(res.error)
+            self.record(
+                "delivery",
+                ts=now,
+                kind=kind,
+                row_id=row_id,
+                chat_id=res.chat_id,
+                ok=res.ok,
+                error=error,
+            )
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    def should_compact(self) -> bool:
+        return False
+
+    def take_pending(self) -> List[dict]:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        return pending
+
+    def flush(self, state: Optional[dict] = None, pending: Optional[List[dict]] = None) -> None:
+        if pending is None:
+            pending = self.take_pending()
+        if not pending:
+            return
+        with self._io_lock, guarded(self.lease):
+            con = self._connect()
+            with con:
+                for rec in pending:
+                    apply(con, rec)
+
+    def compact(self, state: dict) -> None:
+        pass
+
+    def deliveries(self, kind: str, row_id: int) -> List[tuple]:
+        with self._io_lock:
+            return self._connect().execute(
+                "SELECT ts, chat_id, ok, error FROM deliveries WHERE kind = ? AND row_id = ? "
+                "ORDER BY id",
+                (kind, row_id),
+            ).fetchall()
+
+
+def upsert_row(con: sqlite3.Connection, key: str, row: dict) -> None:
+    field = SORT_FIELDS[key]
+    con.execute(
+        f"INSERT OR REPLACE INTO {key} (id, {field}, data) VALUES (?, ?, ?)",
+        (int(row["id"]), sort_key(row, field), dumps(row)),
+    )
+
+
+def set_setting(con: sqlite3.Connection, key: str, value) -> None:
+    con.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, dumps(value)))
+
+
+def apply(con: sqlite3.Connection, rec: dict) -> None:
+    op = rec.get("op")
+    if op == "set":
+        key = rec["key"]
+        if key in COLLECTIONS:
+            # A null setting marks the collection as present even when empty
+            # (an absent "rules" is what triggers the daily migration).
+            set_setting(con, key, None)
+            con.execute(f"DELETE FROM {key}")
+            for row in rec["value"]:
+                upsert_row(con, key, row)
+        else:
+            set_setting(con, key, rec["value"])
+    elif op == "unset":
+        con.execute("DELETE FROM settings WHERE key = ?", (rec["key"],))
+    elif op in ROW_OPS:
+        key, upsert = ROW_OPS[op]
+        if upsert:
+            upsert_row(con, key, rec["item"])
+        else:
+            con.execute(f"DELETE FROM {key} WHERE id = ?", (rec["id"],))
+    elif op == "quarantine":
+        item = rec["item"]
+        if isinstance(item, dict) and isinstance(item.get("id"), int):
+            con.execute(f"DELETE FROM {rec.get('key', 'scheduled')} WHERE id = ?", (item["id"],))
+        found = con.execute("SELECT value FROM settings WHERE key = 'quarantine'").fetchone()
+        set_setting(con, "quarantine", (json.loads(found[0]) if found else []) + [item])
+    elif op == "delivery":
+        con.execute(
+            "INSERT INTO deliveries (ts, kind, row_id, chat_id, ok, error) VALUES (?, ?, ?, ?, ?, ?)",
+            (rec["ts"], rec["kind"], rec["row_id"], rec["chat_id"], int(rec["ok"]), rec["error"]),
+        )
+
+
+def import_state(con: sqlite3.Connection, state: dict) -> None:
+    """Write a loaded JSON state into an empty database, in one transaction."""
+    quarantine = list(state.get("quarantine") or [])
+    with con:
+        for key, value in state.items():
+            if key not in COLLECTIONS:
+                continue
+            set_setting(con, key, None)
+            for row in value or []:
+                try:
+                    upsert_row(con, key, row)
+                except (KeyError, TypeError, ValueError):
+                    quarantine.append(row)
+        for key, value in state.items():
+            if key not in COLLECTIONS and key != "quarantine":
+                set_setting(con, key, value)
+        if quarantine:
+            set_setting(con, "quarantine", quarantine)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python sqlite_store.py <state.json> <state.db>")
+    src, dst = Path(sys.argv[1]), Path(sys.argv[2])
+    if dst.exists():
+        sys.exit(f"{dst} already exists")
+    con = sqlite3.connect(dst)
+    con.executescript(SCHEMA)
+    import_state(con, StateStore(src, {}).load())
+    con.close()
+    print(f"Migrated {src} -> {dst}", flush=True)
@@ -0,0 +1,265 @@
+import asyncio
+import contextlib
+import copy
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+COMPACT_BYTES = int(os.environ.get("STATE_COMPACT_BYTES", str(64 * 1024)))
+FLUSH_SECONDS = float(os.environ.get("STATE_FLUSH_SECONDS", "1.0"))
+
+
+# Collections journalled row by row: key -> (upsert op, delete ops).
+COLLECTIONS = {
+    "scheduled": ("schedule", ("cancel", "fire")),
+    "rules": ("rule", ("unrule",)),
+}
+ROW_OPS = {
+    op: (key, op == upsert)
+    for key, (upsert, deletes) in COLLECTIONS.items()
+    for op in (upsert,) + deletes
+}
+
+
+def index_rows(rows) -> dict:
+    return {row.get("id"): row for row in rows or []}
+
+
+def replay(state: dict, records: Iterable[dict]) -> None:
+    rows = {key: index_rows(state[key]) for key in COLLECTIONS if key in state}
+    for rec in records:
+        op = rec.get("op")
+        if op == "set":
+            state[rec["key"]] = rec["value"]
+            if rec["key"] in COLLECTIONS:
+                rows[rec["key"]] = index_rows(rec["value"])
+        elif op == "unset":
+            state.pop(rec["key"], None)
+        elif op in ROW_OPS:
+            key, upsert = ROW_OPS[op]
+            coll = rows.setdefault(key, {})
+            if upsert:
+                coll[rec["item"]["id"]] = rec["item"]
+            else:
+                coll.pop(rec["id"], None)
+        elif op == "quarantine":
+            item = rec["item"]
+            if isinstance(item, dict):
+                rows.setdefault(rec.get("key", "scheduled"), {}).pop(item.get("id"), None)
+            # Compared whole, since a quarantined row may lack a usable id:
+            # replaying over a snapshot that already has it adds nothing.
+            quarantine = state.setdefault("quarantine", [])
+            if item not in quarantine:
+                quarantine.append(item)
+    for key, coll in rows.items():
+        state[key] = list(coll.values())
+
+
+def snapshot(state: dict) -> dict:
+    # Containers are copied one level deep; rows inside them are never mutated
+    # in place, so this is enough to serialize off the event loop.
+    return {k: v.copy() if hasattr(v, "copy") else v for k, v in state.items()}
+
+
+def encode_default(obj):
+    # Runtime containers such as ScheduledQueue persist as plain lists.
+    return list(obj)
+
+
+def guarded(lease):
+    """Context for a state write: the lease's save check, if the store has one."""
+    return lease.saving() if lease is not None else contextlib.nullcontext()
+
+
+def write_atomic(path: Path, data: str) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class StateStore:
+    """JSON snapshot plus an append-only journal of change records.
+
+    Records are idempotent (set / schedule / cancel / fire), so replaying a
+    journal over a snapshot that already contains it is harmless; that is what
+    makes compaction crash-safe without a two-phase commit.
+    """
+
+    def __init__(self, path, defaults: dict, compact_bytes: int = COMPACT_BYTES):
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + ".journal")
+        self.defaults = defaults
+        self.compact_bytes = compact_bytes
+        # Set to a lease.Lease to check ownership and bump its generation on
+        # every write.
+        self.lease = None
+        self._pending: List[dict] = []
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+
+    def load(self) -> dict:
+        state = copy.deepcopy(self.defaults)
+        if self.path.exists():
+            try:
+                state.update(json.loads(self.path.read_text(encoding="utf-8")))
+            except Exception:
+                pass
+        replay(state, self._read_journal())
+        return state
+
+    def _read_journal(self) -> List[dict]:
+        if not self.journal_path.exists():
+            return []
+        records = []
+        good = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                good += len(line)
+        # Drop a torn tail left by a crash mid-append so new records start clean.
+        if good < self.journal_path.stat().st_size:
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good)
+        return records
+
+    def record(self, op: str, **fields) -> None:
+        with self._lock:
+            self._pending.append({"op": op, **fields})
+
+    def set(self, state: dict, key: str, value) -> None:
+        state[key] = value
+        self.record("set", key=key, value=value)
+
+    def unset(self, state: dict, key: str) -> None:
+        if key in state:
+            del state[key]
+            self.record("unset", key=key)
+
+    def log_deliveries(self, kind: str, results) -> None:
+        # The JSON state keeps no delivery history; see SqliteStore.
+        pass
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    def should_compact(self) -> bool:
+        return (
+            self.journal_path.exists()
+            and self.journal_path.stat().st_size > self.compact_bytes
+        )
+
+    def take_pending(self) -> List[dict]:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        return pending
+
+    def flush(self, state: Optional[dict], pending: Optional[List[dict]] = None) -> None:
+        """Write the pending records, then compact into state if due.
+
+        A state snapshot must include exactly the records written with it:
+        a caller taking the snapshot elsewhere passes take_pending() taken
+        at the same moment.
+        """
+        if pending is None:
+            pending = self.take_pending()
+        if not pending and (state is None or not self.should_compact()):
+            return
+        with self._io_lock, guarded(self.lease):
+            if pending:
+                lines = "".join(
+                    json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n"
+                    for rec in pending
+                )
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+            if state is not None and self.should_compact():
+                self._compact(state)
+
+    def compact(self, state: dict) -> None:
+        with self._io_lock, guarded(self.lease):
+            self._compact(state)
+
+    def _compact(self, state: dict) -> None:
+        write_atomic(
+            self.path,
+            json.dumps(state, ensure_ascii=False, indent=2, default=encode_default),
+        )
+        if self.journal_path.exists():
+            self.journal_path.unlink()
+
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+
+def open_store(path, defaults: dict):
+    """StateStore for a JSON STATE_FILE, SqliteStore for .db/.sqlite ones."""
+    if Path(path).suffix in SQLITE_SUFFIXES:
+        from sqlite_store import SqliteStore
+
+        return SqliteStore(path, defaults)
+    return StateStore(path, defaults)
+
+
+class DebouncedWriter:
+    """Coalesces dirty notifications into at most one flush per window.
+
+    The journal append (and compaction, when due) runs in a worker thread so
+    the event loop never blocks on disk I/O.
+    """
+
+    def __init__(self, store: StateStore, state: dict, window: float = FLUSH_SECONDS):
+        self.store = store
+        self.state = state
+        self.window = window
+        self._task: Optional[asyncio.Task] = None
+        # An Outbox whose confirmed sends are dropped once a save covers them.
+        self.outbox = None
+
+    def mark_dirty(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        while True:
+            await asyncio.sleep(self.window)
+            await self.flush()
+            if not self.store.dirty:
+                return
+
+    async def flush(self) -> None:
+        if not self.store.dirty:
+            return
+        # The snapshot and the records it contains are taken together, on the
+        # loop: a record added while the thread writes goes to the next flush.
+        pending = self.store.take_pending()
+        state = snapshot(self.state) if self.store.should_compact() else None
+        lease = self.store.lease
+        marks = (
+            self.outbox.mark() if self.outbox is not None else None,
+            lease.mark() if lease is not None else None,
+        )
+        await asyncio.to_thread(self.store.flush, state, pending)
+        if self.outbox is not None:
+            self.outbox.applied(marks[0])
+        if lease is not None:
+            lease.saved(marks[1])
+
+    async def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
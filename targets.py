@@ -0,0 +1,74 @@
+import re
+from typing import Dict, Iterable, List, Tuple
+
+# A row (scheduled item or rule) targets either one "chat_id" or a named
+# "group" from state["groups"]. Once a send has been attempted, "pending"
+# holds the recipients still owed the message, so a retry skips the ones
+# already delivered. "remote" maps recipients to handed-off message ids.
+
+GROUP_NAME = re.compile(r"^\w+$")
+
+
+def group_name(value: str) -> str:
+    return value[1:] if value.startswith("@") else value
+
+
+def check_group_name(value: str) -> str:
+    """The group name in "@name" or "name"; ValueError unless letters, digits or _."""
+    name = group_name(value)
+    if not GROUP_NAME.match(name):
+        raise ValueError(f"bad group name {value!r}")
+    return name
+
+
+def target_fields(state: dict, value: str) -> dict:
+    """Row fields for "@group" or a chat id; KeyError/ValueError if unknown."""
+    if value.startswith("@"):
+        name = check_group_name(value)
+        if name not in state["groups"]:
+            raise KeyError(name)
+        return {"group": name}
+    return {"chat_id": int(value)}
+
+
+def target_label(row: dict) -> str:
+    if "group" in row:
+        return f"@{row['group']}"
+    return f"chat {row['chat_id']}"
+
+
+def recipients(state: dict, row: dict) -> List[int]:
+    if "pending" in row:
+        return list(row["pending"])
+    if "group" in row:
+        return [int(c) for c in state["groups"].get(row["group"], [])]
+    return [int(row["chat_id"])]
+
+
+def remote_map(row: dict) -> Dict[int, int]:
+    """Handed-off message ids by chat (old rows kept a single remote_id)."""
+    if row.get("remote_id"):
+        return {int(row["chat_id"]): int(row["remote_id"])}
+    return {int(chat): int(msg_id) for chat, msg_id in (row.get("remote") or {}).items()}
+
+
+def without(row: dict, *keys: str) -> dict:
+    return {k: v for k, v in row.items() if k not in keys}
+
+
+def split_results(results: Iterable) -> Dict[object, Tuple[Dict[int, object], Dict[int, BaseException]]]:
+    """Group fan-out results by row id: {id: ({chat: message}, {chat: error})}.
+
+    Job keys are tuples starting with the row id.
+    """
+    out: Dict[object, Tuple[Dict[int, object], Dict[int, BaseException]]] = {}
+    for res in results:
+        sent, failed = out.setdefault(res.key[0], ({}, {}))
+        if res.ok:
+            sent[res.chat_id] = res.message
+        else:
+            failed[res.chat_id] = res.error
+    for sent, failed in out.values():
+        for chat in failed:
+            sent.pop(chat, None)
+    return out
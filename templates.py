@@ -0,0 +1,114 @@
+"""Named message templates.
+
+state["templates"] maps a name to {"text": source, "counter": n}; a message
+whose whole text is "$name" is rendered from that template when it is sent.
+The source is literal text with variables in braces ("{{"/"}}" for braces):
+
+    {date} / {date:%d.%m}   the local date the message is due (default %d.%m.%Y)
+    {time} / {time:%H:%M}   the local time it is due
+    {weekday}               day of the week, in Ukrainian
+    {counter}               1, 2, 3... per template, counted on every render
+    {random:a|b|c}          one of the options, picked on every render
+
+A template is parsed once into a list of parts and kept in a cache keyed by
+its source, so rendering a fan-out or a bulk-scheduled batch is just joining
+the parts. Editing or deleting a template drops its old source from the cache.
+"""
+
+import random
+import re
+from datetime import datetime
+from string import Formatter
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from metrics import metrics
+
+NAME = re.compile(r"^\$(\w+)$")
+CACHE_SIZE = 256
+WEEKDAYS = ("понеділок", "вівторок", "середа", "четвер", "пʼятниця", "субота", "неділя")
+
+# (at, counter, arg) -> text
+Variable = Callable[[datetime, int, str], str]
+
+VARIABLES: Dict[str, Variable] = {
+    "date": lambda at, counter, arg: at.strftime(arg or "%d.%m.%Y"),
+    "time": lambda at, counter, arg: at.strftime(arg or "%H:%M"),
+    "weekday": lambda at, counter, arg: WEEKDAYS[at.weekday()],
+    "counter": lambda at, counter, arg: str(counter),
+    "random": lambda at, counter, arg: random.choice(arg.split("|")),
+}
+
+
+class Template:
+    def __init__(self, source: str):
+        self.source = source
+        self.parts: List[Union[str, Tuple[Variable, str]]] = []
+        self.counts = False
+        try:
+            parsed = list(Formatter().parse(source))
+        except ValueError as e:
+            raise ValueError(f"дужки: {e}") from None
+        for literal, name, arg, conversion in parsed:
+            if literal:
+                self.parts.append(literal)
+            if name is None:
+                continue
+            if name not in VARIABLES or conversion:
+                raise ValueError(f"невідома змінна {{{name}}}")
+            if name == "random" and not arg:
+                raise ValueError("{random:a|b|c} потребує варіантів")
+            self.counts = self.counts or name == "counter"
+            self.parts.append((VARIABLES[name], arg))
+
+    def render(self, at: datetime, counter: int = 0) -> str:
+        return "".join(
+            part if isinstance(part, str) else part[0](at, counter, part[1]) for part in self.parts
+        )
+
+
+_compiled: Dict[str, Template] = {}
+
+
+def compile_template(source: str) -> Template:
+    """The parsed template for source; ValueError says what is wrong."""
+    template = _compiled.get(source)
+    if template is None:
+        template = Template(source)
+        if len(_compiled) >= CACHE_SIZE:
+            _compiled.clear()
+        _compiled[source] = template
+        metrics.inc("template_compiles")
+    return template
+
+
+def forget(source: str) -> None:
+    _compiled.pop(source, None)
+
+
+def reference(text: str) -> Optional[str]:
+    """The template name if text is a "$name" reference."""
+    m = NAME.match(text.strip())
+    return m.group(1).lower() if m else None
+
+
+def render(state: dict, store, text: str, at: datetime) -> str:
+    """text itself, or the template it references rendered for time at.
+
+    A template with {counter} moves its counter on and records it.
+    """
+    name = reference(text)
+    if name is None:
+        return text
+    templates = state.get("templates") or {}
+    if name not in templates:
+        # /untemplate refuses while a row uses it, so only a hand-edited
+        # state gets here; the reference goes out as it is.
+        print(f"No template ${name}, sending the text as is", flush=True)
+        return text
+    entry = templates[name]
+    template = compile_template(entry["text"])
+    counter = entry.get("counter", 0)
+    if template.counts:
+        counter += 1
+        store.set(state, "templates", {**templates, name: dict(entry, counter=counter)})
+    return template.render(at, counter)
@@ -0,0 +1,109 @@
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import pytest
+
+# gh_poller and control_bot read their settings at import time.
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+os.environ.setdefault("SESSION_STRING", "")
+os.environ["CONTROL_CHAT_ID"] = "100"
+os.environ["DAILY_CHAT_ID"] = "200"
+os.environ["TIMEZONE"] = "Europe/Kyiv"
+os.environ["STATE_FILE"] = str(Path(tempfile.mkdtemp(prefix="vognyk-test-")) / "state.json")
+os.environ.pop("METRICS_FILE", None)
+os.environ.pop("METRICS_PROM", None)
+os.environ["SEND_GLOBAL_RATE"] = "1000000"
+os.environ["SEND_PER_CHAT_RATE"] = "1000000"
+os.environ["SEND_PER_CHAT_BURST"] = "1000000"
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+CONTROL_CHAT_ID = 100
+TARGET_CHAT_ID = 200
+TZ = ZoneInfo("Europe/Kyiv")
+
+
+def quiet(coro):
+    """asyncio.run without the bots' progress prints."""
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        result = asyncio.run(coro)
+    return result, out.getvalue()
+
+
+def row(sid: int, seconds: float, text: str = None, **fields) -> dict:
+    """A scheduled row due `seconds` from now."""
+    send_at = datetime.now(TZ) + timedelta(seconds=seconds)
+    return {"id": sid, "chat_id": TARGET_CHAT_ID, "text": text or f"msg {sid}", "send_at": send_at.isoformat(), **fields}
+
+
+@pytest.fixture
+def owner(monkeypatch):
+    """owner("b") makes leases taken from now on belong to process "b"."""
+    import lease
+
+    def switch(name: str) -> None:
+        monkeypatch.setattr(lease, "OWNER", name)
+
+    switch("a")
+    return switch
+
+
+@pytest.fixture
+def poller_state(tmp_path):
+    """write(rows, **settings) -> path of a gh_poller state file."""
+    import gh_poller
+    from state_store import write_atomic
+
+    def write(rows=(), **settings) -> Path:
+        import json
+
+        path = tmp_path / "state.json"
+        state = gh_poller.default_state()
+        # Past the control chat's first message, as after an earlier run.
+        state.update(rules=[], scheduled=list(rows), next_id=len(rows) + 1, last_command_id=1)
+        state.update(settings)
+        write_atomic(path, json.dumps(state, ensure_ascii=False))
+        return path
+
+    return write
+
+
+def control_client(*commands):
+    """A FakeClient whose control chat has one message already seen (see
+    poller_state), then commands typed since."""
+    from fake_telegram import FakeClient
+
+    client = FakeClient()
+    client.preload(CONTROL_CHAT_ID, ["старт", *commands])
+    return client
+
+
+def run_poller(path: Path, client):
+    """One gh_poller run over path; returns (exception or None, output)."""
+    import gh_poller
+
+    account = gh_poller.Account("test", "", CONTROL_CHAT_ID, state_path=path)
+    try:
+        _, out = quiet(gh_poller.run(client, account=account))
+    except Exception as e:
+        return e, ""
+    return None, out
+
+
+def load(path: Path) -> dict:
+    import gh_poller
+    from state_store import StateStore
+
+    return StateStore(path, gh_poller.default_state()).load()
+
+
+def delivered(client, chat_id: int = None):
+    return [m.message for _, m in client.sent if chat_id is None or m.chat_id == chat_id]
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from bulk_import import import_rows
+from conftest import TARGET_CHAT_ID, TZ
+from scheduled_queue import attach_queue
+from state_store import StateStore
+
+
+def test_out_of_range_rows_are_rejected(tmp_path):
+    store = StateStore(tmp_path / "state.json", {})
+    state = {"next_id": 1, "daily_chat_id": TARGET_CHAT_ID, "scheduled": []}
+    attach_queue(state, store)
+    rows = [
+        {"text": "inf", "delay": "inf"},
+        {"text": "nan", "delay": "nan"},
+        {"text": "huge", "delay": 1e12},
+        {"text": "far", "send_at": "9999-12-31T23:59:00"},
+        {"text": "early", "send_at": "0001-01-01T00:00:00"},
+        {"text": "ok", "delay": 5},
+    ]
+    items, rejected = import_rows(state, store, enumerate(rows, 1), datetime.now(TZ))
+    assert [line for line, _ in rejected] == [1, 2, 3, 4, 5]
+    assert [i["text"] for i in items] == ["ok"]
+    assert items[0]["id"] == 1 and state["next_id"] == 2
+    assert [r["text"] for r in state["scheduled"]] == ["ok"]
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+import command_router
+from command_router import ArgError, CommandContext, Command, dispatch, hhmm, minutes
+from conftest import TARGET_CHAT_ID, quiet
+from scheduled_queue import attach_queue
+from state_store import StateStore
+
+
+class Context(CommandContext):
+    def __init__(self, tmp_path):
+        import gh_poller
+
+        store = StateStore(tmp_path / "state.json", {})
+        state = dict(gh_poller.default_state(), rules=[])
+        attach_queue(state, store)
+        attach_queue(state, store, "rules", "next_at")
+        super().__init__(state, store, "Europe/Kyiv")
+        self.replies = []
+
+    async def reply(self, text: str) -> None:
+        self.replies.append(text)
+
+
+def run(ctx, *texts):
+    for text in texts:
+        quiet(dispatch(ctx, text))
+    return ctx.replies
+
+
+@pytest.mark.parametrize("value", ["-1", "abc", "1.5", "99999999999", str(10**30)])
+def test_minutes_rejects_bad_and_overflowing_values(value):
+    with pytest.raises(ArgError, match="minutes"):
+        minutes(value)
+
+
+def test_hhmm_range():
+    assert hhmm("04:05") == (4, 5)
+    for value in ("24:00", "12:60", "noon", "1:2:3"):
+        with pytest.raises(ArgError):
+            hhmm(value)
+
+
+def test_missing_arguments_reply_with_usage(tmp_path):
+    ctx = Context(tmp_path)
+    assert run(ctx, "/sendin", "/cancel") == [
+        f"Формат: {command_router.COMMANDS['/sendin'].usage}",
+        "Формат: /cancel <id>",
+    ]
+
+
+def test_bad_arguments(tmp_path):
+    ctx = Context(tmp_path)
+    replies = run(ctx, "/sendin 99999999999 x", "/cancel abc", "/queue bogus", "/sending maybe")
+    assert replies[0] == "minutes має бути числом >= 0"
+    assert replies[1] == "Формат: /cancel <id>"
+    assert replies[2].startswith("Формат: /queue")
+    assert replies[3].startswith("Формат: /sending")
+    assert len(ctx.state["scheduled"]) == 0
+
+
+def test_unknown_command_is_not_handled(tmp_path):
+    ctx = Context(tmp_path)
+    assert asyncio.run(dispatch(ctx, "/nope 1")) is False
+    assert ctx.replies == []
+
+
+def test_sendin_then_cancel(tmp_path):
+    ctx = Context(tmp_path)
+    replies = run(ctx, "/sendin 5 hello", "/cancel 1", "/cancel 1")
+    assert replies[0].startswith("✅ Заплановано #1")
+    assert f"chat {TARGET_CHAT_ID}" in replies[0]
+    assert replies[1:] == ["✅ Скасовано #1", "Немає такого id"]
+    assert ctx.store.take_pending()[-1] == {"op": "cancel", "id": 1}
+
+
+def test_handler_error_is_replied_not_raised(tmp_path, monkeypatch):
+    async def broken(ctx):
+        raise RuntimeError("boom")
+
+    monkeypatch.setitem(command_router.COMMANDS, "/broken", Command("/broken", "/broken", (), broken))
+    ctx = Context(tmp_path)
+    assert run(ctx, "/broken", "/sendin 1 after")[0] == "⚠️ /broken не виконано: boom"
+    # The next command still runs.
+    assert ctx.replies[1].startswith("✅ Заплановано #1")
+
+
+def test_empty_group_name_is_rejected(tmp_path):
+    ctx = Context(tmp_path)
+    replies = run(ctx, "/group @ 201", "/group a-b 201", "/sendin 0 @ hi", "/group @team 201 202", "/sendin 0 @team hi")
+    assert replies[:2] == ["Назва групи: літери, цифри або _"] * 2
+    assert replies[2].startswith("Формат: /sendin")
+    assert replies[3] == "✅ Група @team: 2 чатів"
+    assert ctx.state["groups"] == {"team": [201, 202]}
+    assert [r.get("group") for r in ctx.state["scheduled"]] == ["team"]
+
+
+def test_rows_with_an_empty_group_have_no_recipients():
+    from targets import recipients, target_label
+
+    row = {"id": 1, "group": "", "text": "x"}
+    assert recipients({"groups": {}}, row) == []
+    assert target_label(row) == "@"
@@ -0,0 +1,93 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import control_bot
+from conftest import TZ, quiet
+from fake_telegram import FakeClient
+from lease import Lease, locked
+from outbox import Outbox
+from recurring import new_rule
+from scheduled_queue import attach_queue
+from send_pipeline import SendPipeline
+from state_store import DebouncedWriter, StateStore
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch, owner):
+    store = StateStore(tmp_path / "state.json", {})
+    state = {"sending_enabled": True, "groups": {"g": [201, 202]}, "scheduled": [], "rules": [], "next_rule_id": 2}
+    attach_queue(state, store)
+    attach_queue(state, store, "rules", "next_at")
+    store.lease = Lease(store.path).acquire()
+    client = FakeClient()
+    for name, value in dict(
+        store=store,
+        state=state,
+        lease=store.lease,
+        outbox=Outbox(store.path),
+        writer=DebouncedWriter(store, state),
+        pipeline=SendPipeline(client),
+        rule_retry={},
+        scheduled_heap=[],
+    ).items():
+        monkeypatch.setattr(control_bot, name, value)
+    return client
+
+
+def test_failed_rule_recipient_is_retried_without_advancing(bot):
+    now = datetime.now(TZ)
+    rule = new_rule(1, "0 4 * * *", "вогник", {"group": "g"}, now - timedelta(days=1))
+    rules = control_bot.state["rules"]
+    rules.append(rule)
+
+    send = bot.send_message
+
+    async def down(entity, text, **kwargs):
+        if await bot._peer_id(entity) == 202:
+            raise ConnectionError("chat down")
+        return await send(entity, text, **kwargs)
+
+    async def fire(at):
+        await control_bot.fire_rules(rules.window(at.timestamp()), at)
+
+    bot.send_message = down
+    quiet(fire(now))
+    left = rules.get(1)
+    assert left["pending"] == [202]
+    assert left["next_at"] == rule["next_at"]
+    assert control_bot.rule_retry[1] > now.timestamp()
+
+    bot.send_message = send
+    quiet(fire(now + timedelta(seconds=control_bot.RETRY_SECONDS + 1)))
+    left = rules.get(1)
+    assert "pending" not in left
+    assert left["next_at"] > rule["next_at"]
+    assert control_bot.rule_retry == {}
+    assert sorted(m.chat_id for _, m in bot.sent) == [201, 202]
+
+
+def claim_elsewhere(*keys):
+    """Claims left by an owner that died before settling them."""
+    with locked(control_bot.lease.path) as data:
+        data["claims"] = {key: ["dead", time.time() + 3600] for key in keys}
+
+
+def test_rows_claimed_elsewhere_are_left_alone(bot):
+    now = datetime.now(TZ)
+    queue = control_bot.state["scheduled"]
+    queue.append({"id": 1, "group": "g", "text": "x", "send_at": (now - timedelta(seconds=5)).isoformat()})
+    rule = new_rule(1, "0 4 * * *", "вогник", {"group": "g"}, now - timedelta(days=1))
+    rules = control_bot.state["rules"]
+    rules.append(rule)
+    claim_elsewhere("scheduled:1", f"rule:1:{rule['next_at']}")
+
+    quiet(control_bot.fire_due([queue.get(1)]))
+    quiet(control_bot.fire_rules(rules.window(now.timestamp()), now))
+    assert bot.sent == []
+    assert queue.get(1) is not None
+    assert rules.get(1)["next_at"] == rule["next_at"]
+    # Both are looked at again later instead of being spun on.
+    assert [sid for _, sid in control_bot.scheduled_heap] == [1]
+    assert control_bot.rule_retry[1] > now.timestamp()
@@ -0,0 +1,223 @@
+import json
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from conftest import CONTROL_CHAT_ID, TARGET_CHAT_ID, TZ, control_client, delivered, load, row, run_poller
+from fake_telegram import FakeClient
+from lease import locked
+from recurring import new_rule
+
+
+def fail_for(client, test):
+    """Make client.send_message raise for the sends test(chat_id, text) picks."""
+    send = client.send_message
+
+    async def send_message(entity, text, **kwargs):
+        if test(await client._peer_id(entity), text):
+            raise ConnectionError("chat down")
+        return await send(entity, text, **kwargs)
+
+    client.send_message = send_message
+
+
+def claims(path: Path) -> dict:
+    return json.loads(Path(f"{path}.lease").read_text(encoding="utf-8")).get("claims", {})
+
+
+def test_due_row_is_sent_once(poller_state, owner):
+    path = poller_state([row(1, -5, "hello")])
+    client = FakeClient()
+    assert run_poller(path, client)[0] is None
+    assert run_poller(path, client)[0] is None
+    assert delivered(client, TARGET_CHAT_ID) == ["hello"]
+    assert len(load(path)["scheduled"]) == 0
+    assert claims(path) == {}
+
+
+def test_partial_fan_out_retries_only_the_failed_chat(poller_state, owner):
+    path = poller_state([row(1, -5, "вогник", group="g", chat_id=None)], groups={"g": [201, 202, 203]})
+    client = FakeClient()
+    fail_for(client, lambda chat, text: chat == 202)
+    assert run_poller(path, client)[0] is None
+    assert sorted(m.chat_id for _, m in client.sent if m.message == "вогник") == [201, 203]
+    (left,) = load(path)["scheduled"]
+    assert left["pending"] == [202]
+
+    client.send_message = FakeClient.send_message.__get__(client)
+    assert run_poller(path, client)[0] is None
+    assert sorted(m.chat_id for _, m in client.sent if m.message == "вогник") == [201, 202, 203]
+    assert len(load(path)["scheduled"]) == 0
+
+
+def test_failed_row_is_retried_by_another_owner(poller_state, owner):
+    path = poller_state([row(1, -5, "x"), row(2, -5, "y")])
+    client = FakeClient()
+    fail_for(client, lambda chat, text: text == "x")
+    run_poller(path, client)
+    assert delivered(client, TARGET_CHAT_ID) == ["y"]
+    # The sent row's claim went with the save, the failed one's at once.
+    assert claims(path) == {}
+
+    owner("b")
+    client.send_message = FakeClient.send_message.__get__(client)
+    _, out = run_poller(path, client)
+    assert "Skipped rows claimed elsewhere" not in out
+    assert delivered(client, TARGET_CHAT_ID) == ["y", "x"]
+
+
+def test_commands_survive_a_broken_message_stream(poller_state, owner):
+    path = poller_state()
+    client = control_client("/sendin 100 a", "/sendin 100 b")
+    iter_messages = client.iter_messages
+
+    def broken(*args, **kwargs):
+        async def messages():
+            async for n, m in aenumerate(iter_messages(*args, **kwargs)):
+                if n == 1:
+                    raise ConnectionError("net down")
+                yield m
+
+        return messages()
+
+    client.iter_messages = broken
+    exc, _ = run_poller(path, client)
+    assert isinstance(exc, ConnectionError)
+    assert [r["text"] for r in load(path)["scheduled"]] == ["a"]
+
+    client.iter_messages = iter_messages
+    assert run_poller(path, client)[0] is None
+    assert [r["text"] for r in load(path)["scheduled"]] == ["a", "b"]
+
+
+async def aenumerate(items):
+    n = 0
+    async for item in items:
+        yield n, item
+        n += 1
+
+
+def test_overflowing_sendin_does_not_abort_the_run(poller_state, owner):
+    path = poller_state()
+    client = control_client("/sendin 99999999999 x", "/sendin 5 ok")
+    assert run_poller(path, client)[0] is None
+    assert [r["text"] for r in load(path)["scheduled"]] == ["ok"]
+    replies = "\n".join(delivered(client, CONTROL_CHAT_ID))
+    assert "minutes має бути числом >= 0" in replies
+
+
+def test_lease_is_released_when_connect_fails(poller_state, owner):
+    path = poller_state([row(1, -5)])
+    client = FakeClient(authorized=False)
+    exc, _ = run_poller(path, client)
+    assert "not authorized" in str(exc)
+    assert not client.connected
+
+    async def refused():
+        raise ConnectionError("refused")
+
+    client = FakeClient()
+    client.connect = refused
+    assert isinstance(run_poller(path, client)[0], ConnectionError)
+
+    owner("b")
+    client = FakeClient()
+    _, out = run_poller(path, client)
+    assert "Skipping run" not in out
+    assert delivered(client, TARGET_CHAT_ID) == ["msg 1"]
+
+
+def test_rule_claimed_elsewhere_keeps_its_run(poller_state, owner):
+    rule = new_rule(1, "0 4 * * *", "вогник", {"chat_id": TARGET_CHAT_ID}, datetime.now(TZ) - timedelta(days=1))
+    path = poller_state(rules=[rule], next_rule_id=2)
+    key = f"rule:1:{rule['next_at']}"
+    with locked(Path(f"{path}.lease")) as data:
+        data["claims"] = {key: ["dead", time.time() + 3600]}
+
+    client = FakeClient()
+    assert run_poller(path, client)[0] is None
+    assert delivered(client, TARGET_CHAT_ID) == []
+    assert load(path)["rules"][0]["next_at"] == rule["next_at"]
+
+    with locked(Path(f"{path}.lease")) as data:
+        data["claims"] = {}
+    assert run_poller(path, client)[0] is None
+    assert delivered(client, TARGET_CHAT_ID) == ["вогник"]
+    assert load(path)["rules"][0]["next_at"] > rule["next_at"]
+
+
+def deletes_fail_for(monkeypatch, *chats):
+    import gh_poller
+
+    async def delete_remote(self, chat_id, msg_id):
+        return chat_id not in chats
+
+    monkeypatch.setattr(gh_poller.PollerContext, "delete_remote", delete_remote)
+
+
+def test_cancel_keeps_a_row_whose_delete_failed(poller_state, owner, monkeypatch):
+    handed_off = row(1, 3600, pending=[], remote={"201": 11, "202": 12})
+    path = poller_state([handed_off])
+    deletes_fail_for(monkeypatch, 202)
+    client = control_client("/cancel 1")
+    assert run_poller(path, client)[0] is None
+    assert "⚠️ #1: не вдалося видалити 1 повідомлень з Telegram" in "\n".join(delivered(client, CONTROL_CHAT_ID))
+    (left,) = load(path)["scheduled"]
+    assert left["remote"] == {"202": 12} and left["pending"] == []
+
+    deletes_fail_for(monkeypatch)
+    client.preload(CONTROL_CHAT_ID, ["/cancel 1"])
+    assert run_poller(path, client)[0] is None
+    assert "✅ Скасовано #1" in delivered(client, CONTROL_CHAT_ID)[-1]
+    assert len(load(path)["scheduled"]) == 0
+
+
+def test_sending_off_only_repends_deleted_chats(poller_state, owner, monkeypatch):
+    handed_off = row(1, 3600, group="g", chat_id=None, pending=[], remote={"201": 11, "202": 12})
+    path = poller_state([handed_off], groups={"g": [201, 202, 203]})
+    deletes_fail_for(monkeypatch, 202)
+    client = control_client("/sending off")
+    assert run_poller(path, client)[0] is None
+    (left,) = load(path)["scheduled"]
+    assert left["pending"] == [201]
+    assert left["remote"] == {"202": 12}
+
+
+def test_sending_off_revokes_rule_runs_it_can_delete(poller_state, owner, monkeypatch):
+    now = datetime.now(TZ)
+    at = (now + timedelta(hours=1)).replace(second=0, microsecond=0).isoformat()
+    rule = new_rule(1, "0 4 * * *", "вогник", {"group": "g"}, now)
+    rule["remote"] = [{"id": 11, "chat_id": 201, "at": at}, {"id": 12, "chat_id": 202, "at": at}]
+    path = poller_state(rules=[rule], next_rule_id=2, groups={"g": [201, 202]})
+    deletes_fail_for(monkeypatch, 202)
+    client = control_client("/sending off")
+    assert run_poller(path, client)[0] is None
+    (left,) = load(path)["rules"]
+    assert left["next_at"] == at
+    assert left["pending"] == [201]
+    assert left["remote"] == [{"id": 12, "chat_id": 202, "at": at}]
+
+
+def test_fresh_state_skips_the_control_chat_history(tmp_path, owner):
+    path = tmp_path / "state.json"
+    client = FakeClient()
+    client.preload(CONTROL_CHAT_ID, ["/sendnow old", "/sending off"])
+    assert run_poller(path, client)[0] is None
+    state = load(path)
+    assert state["sending_enabled"] and delivered(client, TARGET_CHAT_ID) == []
+    assert state["last_command_id"] == 2
+
+    client.preload(CONTROL_CHAT_ID, ["/sendin 5 new"])
+    assert run_poller(path, client)[0] is None
+    assert [r["text"] for r in load(path)["scheduled"]] == ["new"]
+
+
+def test_fresh_state_on_an_empty_chat_misses_nothing(tmp_path, owner):
+    path = tmp_path / "state.json"
+    client = FakeClient()
+    # Message ids are per account: the control chat's first one is not 1.
+    client.preload(TARGET_CHAT_ID, ["elsewhere"])
+    assert run_poller(path, client)[0] is None
+    client.preload(CONTROL_CHAT_ID, ["/sendin 5 new"])
+    assert run_poller(path, client)[0] is None
+    assert [r["text"] for r in load(path)["scheduled"]] == ["new"]
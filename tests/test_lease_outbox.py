@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import pytest
+
+from conftest import TARGET_CHAT_ID, delivered, load, quiet, row, run_poller
+from fake_telegram import FakeClient
+from lease import Lease, LeaseHeld, LeaseLost
+from outbox import Outbox
+from send_pipeline import SendJob, SendPipeline, SendResult
+from state_store import StateStore
+
+
+def job(sid, chat_id=TARGET_CHAT_ID, text=None):
+    return SendJob((sid, chat_id), chat_id, text or f"msg {sid}")
+
+
+key = lambda job: f"scheduled:{job.key[0]}"
+outbox_key = lambda job: f"scheduled:{job.key[0]}:{job.chat_id}"
+
+
+def test_lease_is_exclusive_until_released(tmp_path):
+    a = Lease(tmp_path / "state.json", "a").acquire()
+    with pytest.raises(LeaseHeld):
+        Lease(tmp_path / "state.json", "b").acquire()
+    a.release()
+    b = Lease(tmp_path / "state.json", "b").acquire()
+    with pytest.raises(LeaseLost):
+        a.renew()
+    b.renew()
+
+
+def test_claims_are_kept_until_the_save(tmp_path):
+    a = Lease(tmp_path / "state.json", "a").acquire()
+    jobs = [job(1), job(2)]
+    assert a.claimed(jobs, key) == jobs
+    results = [SendResult(jobs[0].key, TARGET_CHAT_ID, True), SendResult(jobs[1].key, TARGET_CHAT_ID, False)]
+    a.settle(jobs, results, key)
+    mark = a.mark()
+    a.release()
+
+    # Another owner may retry the failed row but not the sent, unsaved one.
+    b = Lease(tmp_path / "state.json", "b").acquire()
+    assert b.claim({"scheduled:1", "scheduled:2"}) == {"scheduled:2"}
+    b.release()
+
+    a.acquire()
+    a.saved(mark)
+    a.release()
+    b.acquire()
+    assert b.claim({"scheduled:1"}) == {"scheduled:1"}
+
+
+def test_release_with_state_drops_claims(tmp_path):
+    a = Lease(tmp_path / "state.json", "a").acquire()
+    a.claim({"scheduled:1"})
+    a.release({"scheduled": []})
+    assert Lease(tmp_path / "state.json", "b").acquire().claim({"scheduled:1"}) == {"scheduled:1"}
+
+
+def test_outbox_replays_confirmed_sends(tmp_path):
+    client = FakeClient()
+    outbox = Outbox(tmp_path / "state.json")
+    jobs = [job(1), job(2)]
+    results = asyncio.run(outbox.send_many(SendPipeline(client), jobs, outbox_key))
+    assert all(r.ok for r in results)
+
+    # A restart before the state was saved: nothing goes out again.
+    outbox = Outbox(tmp_path / "state.json").load()
+    quiet(outbox.send_many(SendPipeline(client), jobs, outbox_key))
+    assert delivered(client) == ["msg 1", "msg 2"]
+
+    outbox.applied(outbox.mark())
+    assert not outbox.path.exists()
+
+
+def test_reconcile_finds_or_resends_unconfirmed_sends(tmp_path):
+    client = FakeClient()
+    outbox = Outbox(tmp_path / "state.json")
+    # Written before the sends; the process died before confirming them.
+    outbox._append(
+        [
+            {"op": "pending", "key": outbox_key(j), "chat_id": j.chat_id, "text": j.text, "schedule": None, "ts": time.time()}
+            for j in (job(1), job(2))
+        ],
+        sync=True,
+    )
+    asyncio.run(client.send_message(TARGET_CHAT_ID, "msg 1"))
+
+    outbox = Outbox(tmp_path / "state.json")
+    quiet(outbox.load().reconcile(client, lambda chat_id: asyncio.sleep(0, chat_id)))
+    assert outbox.entries[outbox_key(job(1))]["msg_id"]
+    assert outbox_key(job(2)) not in outbox.entries
+
+    quiet(outbox.send_many(SendPipeline(client), [job(1), job(2)], outbox_key))
+    assert delivered(client) == ["msg 1", "msg 2"]
+
+
+def test_crash_before_the_save_does_not_resend(poller_state, owner, monkeypatch):
+    path = poller_state([row(1, -5, "once")])
+    client = FakeClient()
+
+    def crash(self, *args):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(StateStore, "flush", crash)
+        assert isinstance(run_poller(path, client)[0], OSError)
+    assert len(load(path)["scheduled"]) == 1
+
+    assert run_poller(path, client)[0] is None
+    assert delivered(client, TARGET_CHAT_ID) == ["once"]
+    assert len(load(path)["scheduled"]) == 0
@@ -0,0 +1,57 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import TZ
+from recurring import Cron, advance, parse_spec
+
+
+def at(*args):
+    return datetime(*args, tzinfo=TZ)
+
+
+def test_daily_spec_rolls_over_midnight():
+    c = Cron(parse_spec("04:00"))
+    assert c.spec == "0 4 * * *"
+    assert c.next_after(at(2030, 1, 1, 3, 59, 30)) == at(2030, 1, 1, 4, 0)
+    assert c.next_after(at(2030, 1, 1, 4, 0)) == at(2030, 1, 2, 4, 0)
+    assert c.next_after(at(2030, 12, 31, 23, 59)) == at(2031, 1, 1, 4, 0)
+
+
+def test_step_minutes_are_strictly_after():
+    c = Cron("*/15 * * * *")
+    assert c.next_after(at(2030, 1, 1, 10, 0)) == at(2030, 1, 1, 10, 15)
+    assert c.next_after(at(2030, 1, 1, 10, 14, 59)) == at(2030, 1, 1, 10, 15)
+    assert c.next_after(at(2030, 1, 1, 23, 45)) == at(2030, 1, 2, 0, 0)
+
+
+def test_weekday_spec():
+    # 2030-01-04 is a Friday.
+    c = Cron("30 9 * * 1-5")
+    assert c.next_after(at(2030, 1, 4, 9, 30)) == at(2030, 1, 7, 9, 30)
+    assert Cron("0 12 * * 0").next_after(at(2030, 1, 4, 0, 0)) == at(2030, 1, 6, 12, 0)
+
+
+def test_day_fields_match_either_when_both_set():
+    c = Cron("0 0 13 * 5")
+    # Fridays and the 13th both match; 2030-01-01 is a Tuesday.
+    assert c.next_after(at(2030, 1, 1, 0, 0)) == at(2030, 1, 4, 0, 0)
+
+
+@pytest.mark.parametrize("spec", ["25:00", "0 0 31 2 *", "* * *", "61 * * * *"])
+def test_bad_specs(spec):
+    with pytest.raises(ValueError):
+        parse_spec(spec)
+
+
+def test_advance_follows_the_local_clock_across_dst():
+    # Kyiv leaves summer time on 2026-10-25.
+    rule = {"spec": "0 4 * * *", "next_at": "2026-10-24T04:00:00+03:00", "catchup": "once"}
+    runs, following = advance(rule, at(2026, 10, 24, 3, 59, 50))
+    assert runs == 1
+    assert following.isoformat() == "2026-10-25T04:00:00+02:00"
+
+    rule = dict(rule, catchup="all")
+    runs, following = advance(rule, at(2026, 10, 26, 5, 0))
+    assert runs == 3
+    assert following.isoformat() == "2026-10-27T04:00:00+02:00"
@@ -0,0 +1,62 @@
+from scheduled_queue import ScheduledQueue, attach_queue, parse_ts
+from state_store import StateStore
+
+
+def item(sid, minute, chat_id=200, **fields):
+    return {"id": sid, "chat_id": chat_id, "text": f"t{sid}", "send_at": f"2030-01-01T10:{minute:02d}:00+00:00", **fields}
+
+
+def ids(rows):
+    return [r["id"] for r in rows]
+
+
+def test_rows_are_kept_in_send_at_order():
+    queue, bad = ScheduledQueue.build([item(1, 30), item(2, 10), item(3, 20)])
+    assert bad == []
+    queue.append(item(4, 5))
+    queue.append(item(5, 20))
+    assert ids(queue) == [4, 2, 3, 5, 1]
+    assert queue.next_ts() == parse_ts(item(4, 5)["send_at"])
+
+
+def test_window_replace_and_remove():
+    queue, _ = ScheduledQueue.build([item(1, 10), item(2, 20), item(3, 30)])
+    assert ids(queue.window(parse_ts(item(0, 20)["send_at"]))) == [1, 2]
+    queue.replace(item(1, 40))
+    assert ids(queue) == [2, 3, 1]
+    assert queue.remove(3)["id"] == 3
+    assert queue.remove(3) is None
+    assert ids(queue) == [2, 1]
+    assert len(queue) == 2
+
+
+def test_page_by_target_and_until():
+    queue, _ = ScheduledQueue.build(
+        [item(1, 10), item(2, 20, chat_id=300), item(3, 30), item(4, 40, group="team"), item(5, 50)]
+    )
+    rows, total = queue.page(0, 2)
+    assert (ids(rows), total) == ([1, 2], 5)
+    rows, total = queue.page(1, 5, target="200")
+    assert (ids(rows), total) == ([3, 5], 3)
+    rows, total = queue.page(0, 5, until=parse_ts(item(0, 30)["send_at"]), target="200")
+    assert (ids(rows), total) == ([1, 3], 2)
+    assert ids(queue.page(0, 5, target="@team")[0]) == [4]
+    assert queue.page(0, 5, target="999") == ([], 0)
+
+
+def test_next_ts_after():
+    queue, _ = ScheduledQueue.build([item(1, 10), item(2, 20), item(3, 20)])
+    ts = [parse_ts(item(0, m)["send_at"]) for m in (10, 20)]
+    assert queue.next_ts(after=ts[0] - 1) == ts[0]
+    assert queue.next_ts(after=ts[0]) == ts[1]
+    assert queue.next_ts(after=ts[1]) is None
+
+
+def test_unparsable_rows_are_quarantined(tmp_path):
+    store = StateStore(tmp_path / "state.json", {})
+    state = {"scheduled": [item(1, 10), {"id": 2, "send_at": "soon"}, {"text": "no id"}]}
+    bad = attach_queue(state, store)
+    assert len(bad) == 2
+    assert ids(state["scheduled"]) == [1]
+    assert state["quarantine"] == bad
+    assert [r["op"] for r in store.take_pending()] == ["quarantine", "quarantine"]